@@ -1,20 +1,30 @@
+import multiprocessing as mp
+import random
 import gym
 from gym import spaces
 import numpy as np
-from core.game import Game
-from bots.basic_bots import DummyBot
+from core.game import create_game
+from core.batched_game import BatchedGame
+from bots.basic_bots import DummyBot, BotController, BatchedBotController
 import config
 
 game_config = config.GameConfig()
 
 class AgarEnv(gym.Env):
-    def __init__(self, num_dummy_bots=12, dummy_lvl=1, max_frames_per_episode=3600):
+    def __init__(self, num_dummy_bots=12, dummy_lvl=1, max_frames_per_episode=3600, engine=None, frame_skip=1):
+        """frame_skip: game frames per step. The agent action is repeated for frame_skip frames (splitting only
+        on the first one), rewards are summed and the observation is only built after the last frame."""
         super(AgarEnv, self).__init__()
         self.num_dummy_bots = num_dummy_bots
         self.game = None
         self.player_idx = 0  # Assuming the main player is always at index 0
         self.dummy_bots = None
+        self.bot_controller = None
         self.dummy_lvl = dummy_lvl
+        self.engine = engine  # None uses game_config.ENGINE
+        if frame_skip < 1:
+            raise Exception("frame_skip must be at least 1")
+        self.frame_skip = frame_skip
 
         self.max_frames_per_episode=max_frames_per_episode  # could be None
         self.current_frame = 0
@@ -24,42 +34,52 @@ class AgarEnv(gym.Env):
         self.observation_space = spaces.Box(low=0, high=1, shape=(game_config.OBSERVATION_SIZE,), dtype=np.float32)
 
     def step(self, action):
-        # Convert action to game format
-        main_player_action = self._action_to_game_format(action)
-        
-        # Get actions for dummy bots
-        dummy_actions = [bot.get_action(self.game) for bot in self.dummy_bots]
-        
-        # Combine main player action with dummy bot actions
-        all_actions = [main_player_action] + dummy_actions
-        
-        # Update game state
-        reset_players = self.game.update(all_actions)
-        
-        # Get new state, reward, and done flag
-        state = self.game.get_RL_state(self.player_idx)
-        reward = self._calculate_reward()
-        done = self._is_episode_done(reset_players)
-
-        self.current_frame += 1
-
-        # Check if frame limit has been reached
-        if self.max_frames_per_episode is not None:
-            if self.current_frame >= self.max_frames_per_episode:
-                done = True
-        
-        return state, reward, done, {}
+        reward = 0
+        done = False
+        for frame in range(self.frame_skip):
+            # Convert action to game format, the direction follows the biggest cell on repeated frames
+            main_player_action = self._action_to_game_format(action)
+            if frame > 0:
+                main_player_action = main_player_action[:2] + (False, False)
+
+            # Get actions for dummy bots
+            dummy_actions = self.bot_controller.get_actions(self.game)
+
+            # Combine main player action with dummy bot actions
+            all_actions = [main_player_action] + dummy_actions
+
+            # Update game state
+            reset_players = self.game.update(all_actions)
+
+            reward += self._calculate_reward()
+            done = self._is_episode_done(reset_players)
+
+            self.current_frame += 1
+
+            # Check if frame limit has been reached
+            if self.max_frames_per_episode is not None:
+                if self.current_frame >= self.max_frames_per_episode:
+                    done = True
+            if done:
+                break
+
+        # Only the last frame is observed
+        state = self.game.get_RL_state_array(self.player_idx).copy()
+        return state, reward, done, {"frames": frame + 1}
 
     def reset(self):
         player_names = ["MainPlayer"] + [f"DummyBot{i}" for i in range(self.num_dummy_bots)]
-        self.game = Game(player_names, non_dummy_players=1)
+        self.game = create_game(player_names, non_dummy_players=1, engine=self.engine)
         self.dummy_bots = [DummyBot(name, self.dummy_lvl) for name in player_names[1:]]
+        self.bot_controller = BotController(self.dummy_bots)
         self.current_frame = 0
-        return self.game.get_RL_state(self.player_idx)
+        return self.game.get_RL_state_array(self.player_idx).copy()
 
-    def _action_to_game_format(self, action):
+    def _action_to_game_format(self, action, player_idx=None):
         # Convert discrete action to game format (px, py, do_split, do_feed)
-        biggest_cell = max(self.game.players[self.player_idx].cells, key=lambda c: c.radius)
+        if player_idx is None:
+            player_idx = self.player_idx
+        biggest_cell = self.game.players[player_idx].biggest_cell
         if action == 32:  # "Center" action
             return (biggest_cell.x, biggest_cell.y, False, False)
         else:
@@ -75,4 +95,234 @@ class AgarEnv(gym.Env):
         return self.game.players[self.player_idx].reward_after_update()
     
     def _is_episode_done(self, reset_players):
-        return self.game.players[self.player_idx].name in reset_players
\ No newline at end of file
+        return self.game.players[self.player_idx].name in reset_players
+
+
+class MultiAgentAgarEnv(AgarEnv):
+    """One game where the first num_agents players are controlled by policies and the rest are DummyBots.
+    step takes one action per agent and returns (num_agents, OBSERVATION_SIZE) float32 observations,
+    built together by get_RL_states, and (num_agents,) rewards and dones. An agent whose player died
+    gets done=True and goes on with its respawned player, the game ends for everyone at max_frames_per_episode."""
+    def __init__(self, num_agents=4, num_dummy_bots=12, dummy_lvl=1, max_frames_per_episode=3600, engine=None, frame_skip=1):
+        super(MultiAgentAgarEnv, self).__init__(num_dummy_bots, dummy_lvl, max_frames_per_episode, engine, frame_skip)
+        self.num_agents = num_agents
+        self.agent_indices = list(range(num_agents))
+        self.observations = np.zeros((num_agents, game_config.OBSERVATION_SIZE), dtype=np.float32)
+
+    def step(self, actions):
+        rewards = np.zeros(self.num_agents)
+        dones = np.zeros(self.num_agents, dtype=bool)
+        for frame in range(self.frame_skip):
+            agent_actions = [self._action_to_game_format(action, i) for i, action in zip(self.agent_indices, actions)]
+            if frame > 0:
+                agent_actions = [action[:2] + (False, False) for action in agent_actions]
+            dummy_actions = self.bot_controller.get_actions(self.game)
+
+            reset_players = self.game.update(agent_actions + dummy_actions)
+
+            players = self.game.players
+            rewards += [players[i].reward_after_update() for i in self.agent_indices]
+            dones |= [players[i].name in reset_players for i in self.agent_indices]
+
+            self.current_frame += 1
+            if self.max_frames_per_episode is not None and self.current_frame >= self.max_frames_per_episode:
+                dones[:] = True
+                break
+
+        self.game.get_RL_states(self.agent_indices, out=self.observations)
+        return self.observations.copy(), rewards, dones, {"frames": frame + 1}
+
+    def reset(self):
+        player_names = [f"Agent{i}" for i in range(self.num_agents)] + [f"DummyBot{i}" for i in range(self.num_dummy_bots)]
+        self.game = create_game(player_names, non_dummy_players=self.num_agents, engine=self.engine)
+        self.dummy_bots = [DummyBot(name, self.dummy_lvl) for name in player_names[self.num_agents:]]
+        self.bot_controller = BotController(self.dummy_bots)
+        self.current_frame = 0
+        return self.game.get_RL_states(self.agent_indices, out=self.observations).copy()
+
+
+class BatchedAgarEnv:
+    """num_envs AgarEnvs on the array engine, stepped together by a BatchedGame, the DummyBots of every world
+    deciding together in a BatchedBotController.
+    step takes a (num_envs,) action array and returns (num_envs, OBSERVATION_SIZE) float32
+    observations, (num_envs,) rewards and dones. Finished worlds are reset automatically,
+    their last observation is in info["terminal_observation"].
+    frame_skip works like in AgarEnv. A world that finishes before the last frame of a step is observed and its
+    rewards stop there, it runs along with the others until the step ends and is then reset."""
+    def __init__(self, num_envs, num_dummy_bots=12, dummy_lvl=1, max_frames_per_episode=3600, frame_skip=1):
+        self.num_envs = num_envs
+        self.num_dummy_bots = num_dummy_bots
+        self.dummy_lvl = dummy_lvl
+        self.player_idx = 0
+        self.max_frames_per_episode = max_frames_per_episode  # could be None
+        if frame_skip < 1:
+            raise Exception("frame_skip must be at least 1")
+        self.frame_skip = frame_skip
+
+        self.player_names = ["MainPlayer"] + [f"DummyBot{i}" for i in range(num_dummy_bots)]
+        self.game = None
+        self.bot_controller = None
+        self.current_frames = np.zeros(num_envs, dtype=np.int64)
+
+        self.action_space = spaces.Discrete(game_config.ACTION_SPACE)
+        self.observation_space = spaces.Box(low=0, high=1, shape=(game_config.OBSERVATION_SIZE,), dtype=np.float32)
+
+    def reset(self):
+        self.game = BatchedGame(self.num_envs, self.player_names, non_dummy_players=1)
+        self.bot_controller = BatchedBotController(self.num_envs, range(1, len(self.player_names)), self.dummy_lvl)
+        self.current_frames[:] = 0
+        return self.game.get_RL_states(self.player_idx).copy()
+
+    def step(self, actions):
+        shape = (self.num_envs, len(self.player_names))
+        px, py = np.empty(shape), np.empty(shape)
+        do_split, do_feed = np.zeros(shape, dtype=bool), np.zeros(shape, dtype=bool)
+        rewards = np.zeros(self.num_envs)
+        dones = np.zeros(self.num_envs, dtype=bool)
+        frames = np.zeros(self.num_envs, dtype=np.int64)
+        infos = [{} for _ in range(self.num_envs)]
+        for frame in range(self.frame_skip):
+            # the direction follows the biggest cell on repeated frames
+            px[:, 0], py[:, 0], do_split[:, 0] = self.game.discrete_to_targets(actions, self.player_idx)
+            if frame > 0:
+                do_split[:, 0] = False
+            px[:, 1:], py[:, 1:], do_split[:, 1:] = self.bot_controller.get_actions(self.game)
+
+            reset_players = self.game.update(px, py, do_split, do_feed)
+
+            playing = ~dones
+            rewards[playing] += self.game.rewards(self.player_idx)[playing]
+            frames[playing] += 1
+            self.current_frames[playing] += 1
+            ended = playing & np.array([self.player_names[self.player_idx] in names for names in reset_players])
+            if self.max_frames_per_episode is not None:
+                ended |= playing & (self.current_frames >= self.max_frames_per_episode)
+            dones |= ended
+            if frame < self.frame_skip - 1:
+                for b in np.flatnonzero(ended):
+                    infos[b]["terminal_observation"] = self.game.worlds[b].get_RL_state_array(self.player_idx).copy()
+                if dones.all():
+                    break
+
+        # Only the last frame is observed
+        observations = self.game.get_RL_states(self.player_idx).copy()
+        for b in np.flatnonzero(dones):
+            infos[b].setdefault("terminal_observation", observations[b].copy())
+            self.game.reset_world(b)
+            self.bot_controller.reset_world(b)
+            self.current_frames[b] = 0
+            observations[b] = self.game.worlds[b].get_RL_state_array(self.player_idx)
+        for info, world_frames in zip(infos, frames.tolist()):
+            info["frames"] = world_frames
+        return observations, rewards, dones, infos
+
+    def close(self):
+        pass
+
+
+def vec_env_worker(remote, parent_remote, index, env_kwargs, seed, auto_reset, observations, rewards, dones):
+    """Loop of an AgarVecEnv worker process: steps its AgarEnv on the commands received through remote
+    and writes the results into row index of the shared observations, rewards and dones."""
+    parent_remote.close()
+    # forked workers would otherwise all share the parent's random state, and play the same game
+    random.seed(seed)
+    np.random.seed(seed if seed is None else seed % 2**32)
+    env = AgarEnv(**env_kwargs)
+    observation = np.frombuffer(observations, dtype=np.float32).reshape(-1, game_config.OBSERVATION_SIZE)[index]
+    reward = np.frombuffer(rewards, dtype=np.float64)[index:index + 1]
+    done = np.frombuffer(dones, dtype=np.bool_)[index:index + 1]
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == "step":
+                observation[:], reward[0], done[0], info = env.step(data)
+                if done[0] and auto_reset:
+                    info["terminal_observation"] = observation.copy()
+                    observation[:] = env.reset()
+                remote.send(info)
+            elif command == "reset":
+                observation[:] = env.reset()
+                remote.send(None)
+            elif command == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        remote.close()
+
+
+class AgarVecEnv:
+    """num_envs AgarEnvs, each one in its own persistent worker process.
+    The workers write their observations, rewards and dones straight into shared memory, so a step only
+    sends the actions and the (small) infos through pipes. step_async starts a step of every env,
+    step_wait waits for it and returns (num_envs, OBSERVATION_SIZE) float32 observations, (num_envs,) rewards
+    and dones, and infos. With auto_reset, finished envs are reset right away, their last observation is in
+    info["terminal_observation"].
+    env_kwargs go to AgarEnv. Worker i seeds random and np.random with seed + i (from the OS if seed is None).
+    start_method is a multiprocessing start method, None uses the platform's default."""
+    def __init__(self, num_envs, seed=None, auto_reset=True, start_method=None, **env_kwargs):
+        self.num_envs = num_envs
+        self.action_space = spaces.Discrete(game_config.ACTION_SPACE)
+        self.observation_space = spaces.Box(low=0, high=1, shape=(game_config.OBSERVATION_SIZE,), dtype=np.float32)
+
+        context = mp.get_context(start_method)
+        shared_observations = context.RawArray("f", num_envs * game_config.OBSERVATION_SIZE)
+        shared_rewards = context.RawArray("d", num_envs)
+        shared_dones = context.RawArray("b", num_envs)
+        self.observations = np.frombuffer(shared_observations, dtype=np.float32).reshape(num_envs, game_config.OBSERVATION_SIZE)
+        self.rewards = np.frombuffer(shared_rewards, dtype=np.float64)
+        self.dones = np.frombuffer(shared_dones, dtype=np.bool_)
+
+        self.remotes, self.processes = [], []
+        for i in range(num_envs):
+            remote, worker_remote = context.Pipe()
+            process = context.Process(target=vec_env_worker, daemon=True,
+                                      args=(worker_remote, remote, i, env_kwargs, None if seed is None else seed + i,
+                                            auto_reset, shared_observations, shared_rewards, shared_dones))
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.waiting = False
+        self.closed = False
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.observations.copy()
+
+    def step_async(self, actions):
+        if self.waiting:
+            raise Exception("step_async called twice without step_wait")
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", int(action)))
+        self.waiting = True
+
+    def step_wait(self):
+        """The observations, rewards and dones are copies, the shared arrays are rewritten by the next step"""
+        if not self.waiting:
+            raise Exception("step_wait called without step_async")
+        infos = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        return self.observations.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+            self.waiting = False
+        for remote in self.remotes:
+            remote.send(("close", None))
+            remote.close()
+        for process in self.processes:
+            process.join()
+        self.closed = True
@@ -0,0 +1,37 @@
+"""
+Memory footprint and attribute access cost of the entity classes.
+Run from the repository root: python -m benchmarking.entity_footprint
+"""
+import timeit
+import tracemalloc
+from core.food import Pellet, ThrownPellet
+from core.player import Cell
+from core.virus import Virus
+
+N_OBJECTS = 20000
+N_READS = 200000
+
+FACTORIES = {
+    'Pellet': lambda: Pellet(1.0, 2.0, 3),
+    'ThrownPellet': lambda: ThrownPellet(1.0, 2.0, 3.0, 4.0, (1, 2, 3)),
+    'Cell': lambda: Cell(1.0, 2.0, (1, 2, 3), "player", 100),
+    'Virus': lambda: Virus(1.0, 2.0),
+}
+
+
+def measure(factory):
+    """Returns (bytes per object, nanoseconds per read of x, y, radius and mass)"""
+    tracemalloc.start()
+    objects = [factory() for _ in range(N_OBJECTS)]
+    size = tracemalloc.get_traced_memory()[0] / N_OBJECTS
+    tracemalloc.stop()
+
+    obj = objects[0]
+    seconds = min(timeit.repeat(lambda: obj.x + obj.y + obj.radius + obj.mass, number=N_READS, repeat=5))
+    return size, seconds / N_READS * 1e9
+
+
+if __name__ == "__main__":
+    for name, factory in FACTORIES.items():
+        size, read_ns = measure(factory)
+        print(f"{name:13s} {size:7.1f} B/object  {read_ns:6.1f} ns per 4 attribute reads")
@@ -0,0 +1,50 @@
+"""
+Frame times of the object engine with each SPATIAL_GRID_BACKEND, in a late game where
+one player has a single cell close to MAX_PLAYER_MASS.
+Run from the repository root: python -m benchmarking.grid_backends
+"""
+import random
+import time
+import numpy as np
+import core.game
+from core.game import Game
+from bots.basic_bots import DummyBot, BotController
+
+N_BOTS = 30
+FRAMES = 600
+BIG_MASS = 18000
+
+
+def run(backend, seed=0):
+    core.game.game_config.SPATIAL_GRID_BACKEND = backend
+    random.seed(seed)
+    names = [f"bot_{i}" for i in range(N_BOTS)]
+    game = Game(names, 0)
+    big_cell = game.players[0].cells[0]
+    big_cell.mass = BIG_MASS
+    big_cell.update_radius_speed_merge()
+    game.players[0].cells_changed()
+    bots = BotController([DummyBot(name, 3) for name in names])
+
+    frame_times = []
+    for _ in range(FRAMES):
+        actions = bots.get_actions(game)
+        start = time.perf_counter()
+        game.update(actions)
+        frame_times.append(time.perf_counter() - start)
+
+    # The broad phase query of the biggest cell on its own
+    big_cell = game.players[0].biggest_cell
+    range_cells = core.game.game_config.CELL_RANGE_FROM_RADIUS(big_cell.radius)
+    start = time.perf_counter()
+    for _ in range(1000):
+        game.spatial_grid.get_nearby_objects(big_cell, range_cells)
+    query_us = (time.perf_counter() - start) * 1000
+    return np.array(frame_times) * 1000, query_us, range_cells
+
+
+if __name__ == "__main__":
+    for backend in ("flat", "hierarchical"):
+        frame_ms, query_us, range_cells = run(backend)
+        print(f"{backend:12s} frame median {np.median(frame_ms):.2f} ms  p99 {np.percentile(frame_ms, 99):.2f} ms  "
+              f"max {frame_ms.max():.2f} ms | biggest cell query (range_cells {range_cells}) {query_us:.0f} us")
@@ -0,0 +1,59 @@
+"""
+Request times of the batched InferenceServer with uneven client processes, and a check that the
+server stops once its clients are done, with each multiprocessing start method (a server or a
+client holding another process' pipe end never sees it closed).
+Run from the repository root: python -m benchmarking.inference_server
+"""
+import time
+import numpy as np
+import torch.multiprocessing as mp
+import config
+from training.ddqn import DQN
+from training.actors import SharedWeights
+from training.inference import InferenceServer
+
+N_CLIENTS = 8
+REQUESTS = 300
+STOP_TIMEOUT = 10  # seconds
+
+game_config = config.GameConfig()
+
+
+def client_loop(client, seed):
+    client.open_client()
+    rng = np.random.default_rng(seed)
+    for _ in range(REQUESTS):
+        time.sleep(rng.random() * 0.001 * (seed + 1))  # an env step, some clients finish much earlier
+        action = client.greedy_action(rng.random(game_config.OBSERVATION_SIZE, dtype=np.float32))
+        if not 0 <= action < game_config.ACTION_SPACE:
+            raise Exception(f"invalid action {action}")
+    client.close()
+
+
+def run(start_method):
+    context = mp.get_context(start_method)
+    model = DQN(game_config.OBSERVATION_SIZE, game_config.ACTION_SPACE)
+    weights = SharedWeights(model, context)
+    weights.publish(model, 0)
+    server = InferenceServer(weights, N_CLIENTS, game_config.OBSERVATION_SIZE, game_config.ACTION_SPACE, context)
+    processes = [context.Process(target=client_loop, args=(client, i)) for i, client in enumerate(server.clients)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    server.started()
+    for process in processes:
+        process.join()
+    clients_s = time.perf_counter() - start
+
+    server.process.join(STOP_TIMEOUT)
+    if server.process.is_alive():
+        server.process.kill()
+        raise Exception(f"the inference server didn't stop after its clients with the {start_method} start method")
+    server.close()
+    return clients_s
+
+
+if __name__ == "__main__":
+    for start_method in mp.get_all_start_methods():
+        clients_s = run(start_method)
+        print(f"{start_method:12s} all clients done in {clients_s:.2f} s, server stopped")
@@ -1,9 +1,14 @@
 import random
 import math
+import numpy as np
 import config
+from core.array_game import alive_mask, X, Y, MASS, RADIUS
 
 game_config = config.GameConfig()
 
+THREAT_DISTANCE_SQ = 500000  # bots of level 2 and 3 react to cells closer than this
+WANDER_FRAMES = 420  # a wandering bot changes goal every 7 seconds
+
 """
 At level 1:
 This dummy bot goes in roughly straight lines, regardless of what's ahead. 
@@ -36,24 +41,35 @@ class DummyBot:
                         continue
                     for other_cell in player.cells:
                         distance_sq = (cell.x - other_cell.x)**2 + (cell.y - other_cell.y)**2
-                        if distance_sq < 500000:
-                            if self.lvl >= 3:
-                                # Check if smaller cell first. (lvl3 should be aggressive)
-                                critical_mass_other = game_config.MASS_FACTOR_EAT_ANOTHER*other_cell.mass
-                                if cell.mass > critical_mass_other:
-                                    # Chase
-                                    self.target = (other_cell.x, other_cell.y)
-                                    potential_kill = 6*critical_mass_other > cell.mass > 2*critical_mass_other and distance_sq < 360000
-                                    return (*self.target, potential_kill, False)
-                            
-                            critical_mass = game_config.MASS_FACTOR_EAT_ANOTHER*cell.mass
-                            if other_cell.mass > critical_mass:
-                                # Run away
-                                self.target = (2*cell.x - other_cell.x, 2*cell.y - other_cell.y)
-                                potential_death = 6*critical_mass > other_cell.mass > 2*critical_mass and distance_sq < 360000
-                                return (*self.target, potential_death, False)
-
-        max_cell = max(bot_player.cells, key=lambda c: c.radius)
+                        if distance_sq < THREAT_DISTANCE_SQ:
+                            action = self.react(cell, other_cell, distance_sq)
+                            if action:
+                                return action
+
+        return self.wander(bot_player)
+
+    def react(self, cell, other_cell, distance_sq):
+        """Chases (level 3) or runs away from other_cell if one can eat the other, None otherwise"""
+        if self.lvl >= 3:
+            # Check if smaller cell first. (lvl3 should be aggressive)
+            critical_mass_other = game_config.MASS_FACTOR_EAT_ANOTHER*other_cell.mass
+            if cell.mass > critical_mass_other:
+                # Chase
+                self.target = (other_cell.x, other_cell.y)
+                potential_kill = 6*critical_mass_other > cell.mass > 2*critical_mass_other and distance_sq < 360000
+                return (*self.target, potential_kill, False)
+
+        critical_mass = game_config.MASS_FACTOR_EAT_ANOTHER*cell.mass
+        if other_cell.mass > critical_mass:
+            # Run away
+            self.target = (2*cell.x - other_cell.x, 2*cell.y - other_cell.y)
+            potential_death = 6*critical_mass > other_cell.mass > 2*critical_mass and distance_sq < 360000
+            return (*self.target, potential_death, False)
+        return None
+
+    def wander(self, bot_player):
+        """Action when nothing nearby is a threat or a prey"""
+        max_cell = bot_player.biggest_cell
         bot_x, bot_y = max_cell.x, max_cell.y
 
         if self.lvl == 0:
@@ -62,7 +78,7 @@ class DummyBot:
         if self.counter <= 0:
             # Choose new point target
             self.target = (random.randint(0, game_config.GAME_WIDTH), random.randint(0, game_config.GAME_HEIGHT))
-            self.counter = 420  # changes goal every 7 seconds
+            self.counter = WANDER_FRAMES
         self.counter -= 1
 
         # Generate a random target point within a certain radius
@@ -77,4 +93,182 @@ class DummyBot:
         split = False # random.random() < 0.0005
         feed = False # random.random() < 0.001
 
-        return (target_x, target_y, split, feed)
\ No newline at end of file
+        return (target_x, target_y, split, feed)
+
+
+class BotController:
+    """
+    Actions of all the DummyBots of one game in one pass, the same as calling get_action of every bot
+    in order (targets, counters and random draws included).
+
+    Players are found with one name lookup and the level 2 and 3 threat / prey search is a sweep over
+    the cells sorted by x: only the cell pairs within reach along x are tested, all at once with NumPy.
+    The pairs closer than THREAT_DISTANCE_SQ are then handed to DummyBot.react in the order get_action
+    scans them (own cells by decreasing mass, then the other players and their cells).
+    """
+    def __init__(self, bots):
+        self.bots = bots
+
+    def get_actions(self, game):
+        players = game.players
+        player_index = {}
+        for i, player in enumerate(players):
+            player_index.setdefault(player.name, i)
+        bot_players = []
+        for bot in self.bots:
+            if bot.name not in player_index:
+                raise Exception("bot name not found in game")
+            bot_players.append(player_index[bot.name])
+
+        cells, eater, other, distance_sq, bounds = self.nearby_pairs(
+            players, [p for bot, p in zip(self.bots, bot_players) if bot.lvl >= 2])
+
+        actions = []
+        for bot, p in zip(self.bots, bot_players):
+            action = None
+            if bot.lvl >= 2:
+                for k in range(bounds[p], bounds[p + 1]):
+                    action = bot.react(cells[eater[k]], cells[other[k]], distance_sq[k])
+                    if action:
+                        break
+            actions.append(action or bot.wander(players[p]))
+        return actions
+
+    @staticmethod
+    def nearby_pairs(players, reacting_players):
+        """The (cell, other player's cell) pairs closer than THREAT_DISTANCE_SQ with the first cell in
+        reacting_players, sorted in scan order. Returns the cell list, the pair indices into it, their
+        squared distances and bounds, the pairs of player p being bounds[p]:bounds[p + 1]."""
+        cells = [cell for player in players for cell in player.cells]
+        owner = np.repeat(np.arange(len(players)), [len(player.cells) for player in players])
+        x = np.array([cell.x for cell in cells], dtype=float)
+        y = np.array([cell.y for cell in cells], dtype=float)
+        mass = np.array([cell.mass for cell in cells], dtype=float)
+        reacting = np.zeros(len(players), dtype=bool)
+        reacting[reacting_players] = True
+
+        eater, other, distance_sq = scan_pairs(owner, x, y, mass, reacting)
+        bounds = np.searchsorted(owner[eater], np.arange(len(players) + 1)).tolist()
+        return cells, eater.tolist(), other.tolist(), distance_sq.tolist(), bounds
+
+
+def scan_pairs(owner, x, y, mass, reacting, sweep_x=None):
+    """The (cell, other player's cell) pairs closer than THREAT_DISTANCE_SQ whose first cell belongs to a
+    player with reacting[owner], sorted in DummyBot.get_action scan order: by owner of the first cell, its cells
+    by decreasing mass, then the other players and their cells in order. owner is the player of each cell,
+    non-decreasing. Returns the indices of both cells and their squared distances.
+    The sweep runs along sweep_x (x by default), where cells of different owners may be set apart."""
+    if sweep_x is None:
+        sweep_x = x
+    local = np.arange(len(owner)) - np.searchsorted(owner, owner)  # index of a cell among its player's cells
+
+    # rank of a cell among its player's cells by decreasing mass, ties in list order
+    rank = np.empty(len(owner), dtype=np.int64)
+    rank[np.lexsort((local, -mass, owner))] = local
+
+    # sweep along x: each reacting cell against the cells within reach of its x
+    eaters = np.flatnonzero(reacting[owner])
+    by_x = np.argsort(sweep_x, kind='stable')
+    sorted_x = sweep_x[by_x]
+    reach = math.sqrt(THREAT_DISTANCE_SQ) + 1
+    lo = np.searchsorted(sorted_x, sweep_x[eaters] - reach, side='left')
+    hi = np.searchsorted(sorted_x, sweep_x[eaters] + reach, side='right')
+    pair_counts = hi - lo
+    eater = np.repeat(eaters, pair_counts)
+    other = by_x[np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+                 + np.repeat(lo, pair_counts)]
+    distance_sq = (x[eater] - x[other])**2 + (y[eater] - y[other])**2
+    keep = (owner[eater] != owner[other]) & (distance_sq < THREAT_DISTANCE_SQ)
+    eater, other, distance_sq = eater[keep], other[keep], distance_sq[keep]
+
+    scan = np.lexsort((local[other], owner[other], rank[eater], owner[eater]))
+    return eater[scan], other[scan], distance_sq[scan]
+
+
+class BatchedBotController:
+    """
+    Actions of the DummyBots of level lvl at bot_players in every world of a BatchedGame, in one pass over
+    its cell arrays. A bot decides like DummyBot.get_action: same threat / prey scan order, targets and counters,
+    but its wander draws come from np.random, in arrays, instead of random.
+
+    The threat / prey pairs of all worlds come from one scan_pairs, each world shifted along the sweep by
+    twice the game width so that no pair spans two worlds. The first pair of a bot that react would act on
+    decides its action, the other bots wander.
+    """
+    def __init__(self, num_worlds, bot_players, lvl=3):
+        self.bot_players = np.asarray(bot_players, dtype=np.int64)
+        self.lvl = lvl
+        self.counters = np.zeros((num_worlds, len(self.bot_players)), dtype=np.int64)
+        self.targets = np.zeros((num_worlds, len(self.bot_players), 2))
+
+    def reset_world(self, b):
+        """New bots for world b"""
+        self.counters[b] = 0
+        self.targets[b] = 0
+
+    def get_actions(self, game):
+        """px, py and do_split, (num_worlds, bots) arrays. DummyBots never feed."""
+        cells = game.cells[:, self.bot_players]
+        alive = alive_mask(game.n_cells[:, self.bot_players])
+        biggest = np.where(alive, cells[..., RADIUS], -1).argmax(axis=2)
+        biggest_cell = np.take_along_axis(cells, biggest[..., None, None], axis=2)[:, :, 0]
+        px, py = biggest_cell[..., X].copy(), biggest_cell[..., Y].copy()
+        do_split = np.zeros(px.shape, dtype=bool)
+        if self.lvl == 0:
+            return px, py, do_split
+
+        wandering = np.ones(px.shape, dtype=bool)
+        if self.lvl >= 2:
+            wandering = ~self.react(game, px, py, do_split)
+        self.wander(wandering, px, py)
+        return px, py, do_split
+
+    def react(self, game, px, py, do_split):
+        """DummyBot.react on the first pair of each bot it acts on, writes the bots' targets into px, py and
+        self.targets and their splits into do_split. Returns the mask of the bots that reacted."""
+        num_players = game.n_cells.shape[1]
+        world, player, slot = np.nonzero(alive_mask(game.n_cells))
+        cells = game.cells[world, player, slot]
+        x, y, mass = cells[:, X], cells[:, Y], cells[:, MASS]
+        bot_column = np.full(num_players, -1)
+        bot_column[self.bot_players] = np.arange(len(self.bot_players))
+
+        eater, other, distance_sq = scan_pairs(world * num_players + player, x, y, mass,
+                                               np.tile(bot_column >= 0, len(game.n_cells)),
+                                               sweep_x=x + world * 2 * game_config.GAME_WIDTH)
+        chase = (self.lvl >= 3) & (mass[eater] > game_config.MASS_FACTOR_EAT_ANOTHER * mass[other])
+        run_away = ~chase & (mass[other] > game_config.MASS_FACTOR_EAT_ANOTHER * mass[eater])
+        acting = chase | run_away
+        eater, other, distance_sq, chase = eater[acting], other[acting], distance_sq[acting], chase[acting]
+        first = np.ones(len(eater), dtype=bool)  # the pairs are grouped by bot
+        first[1:] = (world[eater[1:]] != world[eater[:-1]]) | (player[eater[1:]] != player[eater[:-1]])
+        eater, other, distance_sq, chase = eater[first], other[first], distance_sq[first], chase[first]
+
+        # chase the prey, or run to the opposite of the threat
+        target_x = np.where(chase, x[other], 2 * x[eater] - x[other])
+        target_y = np.where(chase, y[other], 2 * y[eater] - y[other])
+        smaller, bigger = np.where(chase, mass[other], mass[eater]), np.where(chase, mass[eater], mass[other])
+        critical_mass = game_config.MASS_FACTOR_EAT_ANOTHER * smaller
+        split = (6 * critical_mass > bigger) & (bigger > 2 * critical_mass) & (distance_sq < 360000)
+
+        bots = world[eater], bot_column[player[eater]]
+        px[bots], py[bots], do_split[bots] = target_x, target_y, split
+        self.targets[bots] = np.column_stack((target_x, target_y))
+        reacted = np.zeros(px.shape, dtype=bool)
+        reacted[bots] = True
+        return reacted
+
+    def wander(self, wandering, px, py):
+        """DummyBot.wander for the wandering bots, from their biggest cell at px, py"""
+        new_target = wandering & (self.counters <= 0)
+        self.targets[new_target] = np.random.randint(0, (game_config.GAME_WIDTH + 1, game_config.GAME_HEIGHT + 1),
+                                                     (new_target.sum(), 2))
+        self.counters[new_target] = WANDER_FRAMES
+        self.counters[wandering] -= 1
+
+        bot_x, bot_y = px[wandering], py[wandering]
+        target = self.targets[wandering]
+        angle = (np.arctan2(target[:, 1] - bot_y, target[:, 0] - bot_x)
+                 + np.random.uniform(-math.pi, math.pi, len(bot_x)) / 18)
+        px[wandering] = bot_x + 1000 * np.cos(angle)
+        py[wandering] = bot_y + 1000 * np.sin(angle)
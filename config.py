@@ -62,6 +62,14 @@ class GameConfig:
         self.SPATIAL_GRID_CELL = 70
         self.CELL_RANGE_FROM_RADIUS = lambda r: int(r // self.SPATIAL_GRID_CELL) + 1
         self.VIRUS_CELL_RANGE = self.CELL_RANGE_FROM_RADIUS(self.RADIUS_FROM_MASS(self.VIRUS_MAX_MASS))
+        self.SPATIAL_GRID_BACKEND = "flat"  # "flat" (SpatialGrid) or "hierarchical" (HierarchicalGrid, for very big cells)
+        self.SPATIAL_GRID_LEVELS = (2 * self.CELL_RANGE_FROM_RADIUS(self.RADIUS_FROM_MASS(self.MAX_PLAYER_MASS)) + 1).bit_length()
+        self.VECTORIZED_EAT_MIN_PELLETS = 24  # Player.eat_pellets uses NumPy from this many candidate pellets on
+        self.VECTORIZED_SELF_COLLISION_MIN_PAIRS = 800  # self collisions of all players use NumPy from this many cell pairs on
+        self.OBSERVATION_PELLETS_PER_GRID_CELL = 150  # get_RL_state reads pellets from the grid above this many pellets per grid cell in view
+        self.VECTORIZED_OBSERVATIONS_MIN_AGENTS = 8  # Game.get_RL_states builds the observations together from this many players on
+        self.RECORDING_KEYFRAME_INTERVAL = 60  # core.recording writes the full food every this many frames, seeking replays at most this many deltas
+        self.ENGINE = "objects"  # "objects" (core/game.py) or "arrays" (core/array_game.py, NumPy struct-of-arrays)
 
         # RL training
         self.TOTAL_DIRECTIONS = 16
@@ -69,6 +77,7 @@ class GameConfig:
 
         self.ACTION_SPACE = 2 * self.TOTAL_DIRECTIONS + 1
         self.OBSERVATION_SIZE = (16 + 30 + 100 + 10) * 3
+        self.PIXEL_OBSERVATION_SIZE = (40, 64)  # (height, width) of visualization.rasterizer images, the view's aspect ratio
 
         self.MAX_STEPS = 10000  # Maximum steps per episode
         self.REWARD_FOOD = 1
@@ -0,0 +1,845 @@
+# core/array_game.py
+from collections import namedtuple
+import math
+import random
+import numpy as np
+import config
+from core.food import PELLET_RADIUS, EJECTED_RADIUS, PELLET_PALETTE
+from core.game import generate_points, read_only, StateArrays, PlayerArrays, EntityArrays
+from core.player import resolve_self_collisions
+
+game_config = config.GameConfig()
+
+"""
+Struct-of-arrays version of core.game.Game.
+
+Instead of lists of Cell/Pellet/ThrownPellet/Virus objects, the world lives in a
+handful of contiguous NumPy arrays:
+    cells    (players, MAX_AMOUNT_CELLS, CELL_FIELDS), the first n_cells[p] rows of a player are alive
+    food     (n, 2) pellet positions, kept sorted by x so a cell only looks at the slice under it
+    ejected  (n, EJECTED_FIELDS)
+    viruses  (n, VIRUS_FIELDS)
+
+Movement, velocity decay, passive mass loss, border clamping and pellet eating run on all
+cells at once. The rules are the same as the object engine, except that pellets are resolved
+for every cell in one pass before the other collisions, against the cell sizes at that point.
+"""
+
+# cell fields
+X, Y, VX, VY, MASS, RADIUS, SPEED, MERGE = range(8)
+CELL_FIELDS = 8
+
+# ejected food fields (X, Y, VX, VY shared with cells)
+EJECTED_FIELDS = 4
+
+# virus fields (X, Y, VX, VY shared with cells)
+V_MASS, V_RADIUS, V_FED_X, V_FED_Y, V_HAS_FED = range(4, 9)
+VIRUS_FIELDS = 9
+
+VELOCITY_DECAY = 0.93
+VIRUS_COLOR = (30, 225, 30)
+
+CellView = namedtuple("CellView", ["x", "y", "mass", "radius"])
+ArrayGameSnapshot = namedtuple("ArrayGameSnapshot", ["frame_counter", "buffers", "food", "food_colors", "ejected",
+                                                     "ejected_colors", "viruses", "random_state", "np_random_state"])
+
+
+def radius_from_mass(mass):
+    return 10 * np.sqrt(mass)
+
+
+def speed_from_radius(radius):
+    return 30 * radius ** -0.439
+
+
+def player_buffers(n_players, batch_shape=()):
+    """Per player arrays of an ArrayGame. With a batch_shape, world b uses the views buffers[...][b],
+    so BatchedGame can move the cells of every world with one move_cells call."""
+    shape = tuple(batch_shape) + (n_players,)
+    return {
+        "cells": np.zeros(shape + (game_config.MAX_AMOUNT_CELLS, CELL_FIELDS)),
+        "n_cells": np.ones(shape, dtype=np.int64),
+        "split_cooldown": np.zeros(shape),
+        "mass_eaten": np.zeros(shape),
+        "mass_lost": np.zeros(shape),
+        "mass_ejected": np.zeros(shape),
+    }
+
+
+BUFFER_KEYS = tuple(player_buffers(0))
+
+
+def alive_mask(n_cells):
+    return np.arange(game_config.MAX_AMOUNT_CELLS) < n_cells[..., None]
+
+
+def move_cells(cells, n_cells, px, py):
+    """Vectorized Cell.move for every cell of every player (of every world, with leading batch dimensions).
+    cells is (..., players, MAX_AMOUNT_CELLS, CELL_FIELDS), n_cells, px and py are (..., players)."""
+    alive = alive_mask(n_cells)
+    x, y = cells[..., X], cells[..., Y]
+
+    dx = px[..., None] - x
+    dy = py[..., None] - y
+    magnitude = np.sqrt(dx**2 + dy**2)
+    moving = alive & (magnitude > 0)
+    magnitude[magnitude == 0] = 1
+
+    # Apply external velocity
+    new_x = x + cells[..., VX] + (dx/magnitude) * cells[..., SPEED]
+    new_y = y + cells[..., VY] + (dy/magnitude) * cells[..., SPEED]
+    cells[..., VX] *= VELOCITY_DECAY
+    cells[..., VY] *= VELOCITY_DECAY
+
+    half_radius = cells[..., RADIUS] / 2
+    new_x = np.clip(new_x, half_radius, game_config.GAME_WIDTH - half_radius)
+    new_y = np.clip(new_y, half_radius, game_config.GAME_HEIGHT - half_radius)
+    cells[..., X] = np.where(moving, new_x, x)
+    cells[..., Y] = np.where(moving, new_y, y)
+
+    # Passive mass loss
+    mass = np.maximum(game_config.MIN_PLAYER_MASS, cells[..., MASS] * (1 - game_config.MASS_LOSS_RATE / game_config.FPS))
+    cells[..., MASS] = np.where(alive, mass, cells[..., MASS])
+    cells[..., RADIUS] = radius_from_mass(cells[..., MASS])
+    cells[..., SPEED] = speed_from_radius(np.where(alive, cells[..., RADIUS], 1))
+
+    # Reduce cooldowns
+    cells[..., MERGE] = np.maximum(0, cells[..., MERGE] - 1/game_config.FPS)
+
+
+def handle_self_collisions(cells, n_cells):
+    """Player.handle_self_collisions for every player (of every world) at once, absorbed cells
+    are removed keeping the order of the others."""
+    several = np.nonzero(n_cells > 1)
+    if not len(several[0]):
+        return
+    # only the players with several cells, and only up to the most cells any of them has
+    width = n_cells[several].max()
+    rows = cells[several][:, :width]
+    alive = alive_mask(n_cells[several])[:, :width]
+    shift_x, shift_y, absorbed, gained = resolve_self_collisions(
+        rows[:, :, X], rows[:, :, Y], rows[:, :, MASS], rows[:, :, RADIUS], rows[:, :, MERGE], alive)
+    rows[:, :, X] += shift_x
+    rows[:, :, Y] += shift_y
+
+    merged = gained > 0
+    if merged.any():
+        rows[:, :, MASS] += gained
+        rows[:, :, RADIUS] = np.where(merged, radius_from_mass(rows[:, :, MASS]), rows[:, :, RADIUS])
+        rows[:, :, SPEED] = np.where(merged, speed_from_radius(np.where(merged, rows[:, :, RADIUS], 1)), rows[:, :, SPEED])
+    cells[several + (slice(0, width),)] = rows
+
+    for row in np.flatnonzero(absorbed.any(axis=-1)):
+        index = tuple(axis[row] for axis in several)
+        kept = cells[index][:width][alive[row] & ~absorbed[row]]
+        n_cells[index] = len(kept)
+        cells[index][:len(kept)] = kept
+
+
+def regulate_masses(cells, n_cells):
+    """Vectorized Player.regulate_cell_masses for every player (of every world)."""
+    alive = alive_mask(n_cells)
+    masses = np.where(alive, cells[..., MASS], 0)
+    total_mass = masses.sum(axis=-1)
+    over = total_mass > game_config.MAX_PLAYER_MASS
+    if not over.any():
+        return
+    mass_to_regulate = total_mass - game_config.MIN_PLAYER_MASS * n_cells
+    mass_goal = game_config.MAX_PLAYER_MASS - game_config.MIN_PLAYER_MASS * n_cells
+    if (mass_goal[over] <= 0).any():
+        raise Exception("It seems that MAX_PLAYER_MASS <= MIN_PLAYER_MASS * MAX_AMOUNT_CELLS, which is nonsensical. Please correct this.")
+    scale = np.where(over, mass_goal / np.where(over, mass_to_regulate, 1), 1)
+    regulated = alive & over[..., None]
+    cells[..., MASS] = np.where(regulated, game_config.MIN_PLAYER_MASS + (masses - game_config.MIN_PLAYER_MASS) * scale[..., None],
+                                cells[..., MASS])
+    cells[..., RADIUS] = radius_from_mass(cells[..., MASS])
+    cells[..., SPEED] = speed_from_radius(np.where(alive, cells[..., RADIUS], 1))
+
+
+def eat_food(cells, n_cells, foods):
+    """Pellet eating for all cells of one or several worlds in a single pass.
+    cells (worlds, players, MAX_AMOUNT_CELLS, CELL_FIELDS) and n_cells (worlds, players), foods is the
+    x-sorted (n, 2) pellet array of each world. Every pellet goes to the first covering cell in player
+    and cell order, cells grow in place and masses are regulated.
+    Returns the eaten mask of each world's pellets and the mass eaten by each player (worlds, players)."""
+    n_worlds, n_players, max_cells = cells.shape[:3]
+    alive = alive_mask(n_cells).ravel()
+    flat_cells = cells.reshape(-1, CELL_FIELDS)
+    cell_world = np.repeat(np.arange(n_worlds), n_players * max_cells)
+
+    # Sort keys (world, x): every world gets its own stretch of 3 * GAME_WIDTH, cells reach less than that
+    stride = 3 * game_config.GAME_WIDTH
+    food = np.concatenate(foods)
+    food_world = np.repeat(np.arange(n_worlds), [len(f) for f in foods])
+    food_key = food_world * stride + food[:, 0]
+
+    reach = flat_cells[:, RADIUS] - PELLET_RADIUS * game_config.CLOSENESS_FACTOR
+    can_eat = (alive & (flat_cells[:, RADIUS] >= PELLET_RADIUS) &
+               (flat_cells[:, MASS] > game_config.PELLET_MASS * game_config.MASS_FACTOR_EAT_ANOTHER))
+    cell_key = cell_world * stride + flat_cells[:, X]
+    lo = np.searchsorted(food_key, cell_key - reach, 'left')
+    hi = np.searchsorted(food_key, cell_key + reach, 'right')
+    counts = np.where(can_eat, hi - lo, 0)
+
+    # Every (cell, pellet in its x slice) pair, in cell order
+    pair_cell = np.repeat(np.arange(len(flat_cells)), counts)
+    pair_food = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+    hit = ((food[pair_food, 0] - flat_cells[pair_cell, X])**2 + (food[pair_food, 1] - flat_cells[pair_cell, Y])**2
+           < reach[pair_cell]**2)
+    eaten, first = np.unique(pair_food[hit], return_index=True)
+    eaten_by = pair_cell[hit][first]
+
+    gained = np.bincount(eaten_by, minlength=len(flat_cells)).reshape(n_worlds, n_players, max_cells) * game_config.PELLET_MASS
+    if len(eaten):
+        cells[..., MASS] += gained
+        cells[..., RADIUS] = radius_from_mass(cells[..., MASS])
+        cells[..., SPEED] = speed_from_radius(np.where(alive_mask(n_cells), cells[..., RADIUS], 1))
+        regulate_masses(cells, n_cells)
+
+    eaten_mask = np.zeros(len(food), dtype=bool)
+    eaten_mask[eaten] = True
+    return np.split(eaten_mask, np.cumsum([len(f) for f in foods])[:-1]), gained.sum(axis=-1)
+
+
+class ArrayPlayer:
+    """Read-only stand-in for core.player.Player, so that bots, AgarEnv and the benchmarks
+    can keep using game.players[i].name / .cells / .reward_after_update()."""
+    def __init__(self, game, idx):
+        self.game = game
+        self.idx = idx
+        self.name = game.names[idx]
+        self.color = game.colors[idx]
+
+    @property
+    def cells(self):
+        return self.game.cell_views()[self.idx]
+
+    def aggregates(self):
+        """Same as Player.aggregates, from the per frame ArrayGame.player_aggregates"""
+        return self.total_mass, self.total_size, self.centroid, self.biggest_cell
+
+    @property
+    def total_mass(self):
+        return float(self.game.player_aggregates()[0][self.idx])
+
+    @property
+    def total_size(self):
+        return float(self.game.player_aggregates()[1][self.idx])
+
+    @property
+    def centroid(self):
+        _, _, x, y, _ = self.game.player_aggregates()
+        return float(x[self.idx]), float(y[self.idx])
+
+    @property
+    def biggest_cell(self):
+        return self.cells[self.game.player_aggregates()[4][self.idx]]
+
+    @property
+    def split_cooldown(self):
+        return self.game.split_cooldown[self.idx]
+
+    @property
+    def mass_eaten_this_frame(self):
+        return self.game.mass_eaten[self.idx]
+
+    @property
+    def mass_lost_this_frame(self):
+        return self.game.mass_lost[self.idx]
+
+    @property
+    def mass_ejected_this_frame(self):
+        return self.game.mass_ejected[self.idx]
+
+    def reward_after_update(self):
+        return self.mass_eaten_this_frame - self.mass_lost_this_frame - self.mass_ejected_this_frame
+
+
+class ArrayGame:
+    def __init__(self, player_names, non_dummy_players, buffers=None):
+        """buffers: optional arrays from player_buffers() to build the world in, they are overwritten"""
+        self.frame_counter = 0
+
+        assert 0 <= non_dummy_players <= len(player_names)
+
+        n_players = len(player_names)
+        points = generate_points(game_config.GAME_WIDTH, game_config.GAME_HEIGHT,
+                                 game_config.INITIAL_SEPARATION_MIN, n_players)
+
+        self.names = list(player_names)
+        self.colors = [(100 + random.randint(0, 155), 100 + random.randint(0, 155), 100 + random.randint(0, 155))
+                       for _ in range(n_players)]
+
+        # Per player state is only ever modified in place, it may be a view into a BatchedGame
+        if buffers is None:
+            buffers = player_buffers(n_players)
+        for key, array in buffers.items():
+            array[...] = 1 if key == "n_cells" else 0
+            setattr(self, key, array)
+
+        for i, point in enumerate(points):
+            # non dummy players start with the default mass, dummy bots with a random one
+            mass = game_config.INITIAL_PLAYER_MASS if i < non_dummy_players else random.randint(50, 120)
+            self.set_cell(i, 0, point[0], point[1], mass)
+
+        self.food = np.zeros((0, 2))
+        self.food_colors = np.zeros(0, dtype=np.uint8)  # PELLET_PALETTE indices
+        self.add_food(game_config.INITIAL_FOOD_COUNT)
+
+        self.ejected = np.zeros((0, EJECTED_FIELDS))
+        self.ejected_colors = np.zeros((0, 3), dtype=np.int64)
+
+        self.viruses = np.zeros((0, VIRUS_FIELDS))
+        self.add_viruses(game_config.INITIAL_VIRUS_COUNT)
+
+        self.players = [ArrayPlayer(self, i) for i in range(n_players)]
+        self._cell_views = None
+        self._player_aggregates = None
+        self.observation = np.zeros(game_config.OBSERVATION_SIZE, dtype=np.float32)  # reused by get_RL_state_array
+
+        self.state_version = 0  # dirty-frame counter, see Game.get_state_arrays
+        self._state_arrays = None
+        self.player_colors = read_only(np.array(self.colors, dtype=np.uint8))
+
+    def snapshot(self):
+        """The complete world as an ArrayGameSnapshot of array copies and the RNG states"""
+        return ArrayGameSnapshot(
+            frame_counter=self.frame_counter,
+            buffers={key: getattr(self, key).copy() for key in BUFFER_KEYS},
+            food=self.food.copy(), food_colors=self.food_colors.copy(),
+            ejected=self.ejected.copy(), ejected_colors=self.ejected_colors.copy(),
+            viruses=self.viruses.copy(),
+            random_state=random.getstate(), np_random_state=np.random.get_state())
+
+    def restore(self, snapshot):
+        """Puts the world back exactly as it was at snapshot(). The per player arrays are
+        written in place, they may be views into a BatchedGame."""
+        self.frame_counter = snapshot.frame_counter
+        for key, array in snapshot.buffers.items():
+            getattr(self, key)[...] = array
+        self.food, self.food_colors = snapshot.food.copy(), snapshot.food_colors.copy()
+        self.ejected, self.ejected_colors = snapshot.ejected.copy(), snapshot.ejected_colors.copy()
+        self.viruses = snapshot.viruses.copy()
+        random.setstate(snapshot.random_state)
+        np.random.set_state(snapshot.np_random_state)
+        self._cell_views = None
+        self._player_aggregates = None
+        self.state_version += 1
+
+    def set_cell(self, p, k, x, y, mass, vx=0, vy=0):
+        cell = self.cells[p, k]
+        cell[X], cell[Y], cell[VX], cell[VY] = x, y, vx, vy
+        cell[MASS] = mass
+        cell[RADIUS] = game_config.RADIUS_FROM_MASS(mass)
+        cell[SPEED] = game_config.SPEED_FROM_RADIUS(cell[RADIUS])
+        cell[MERGE] = game_config.MERGE_TIME_FROM_MASS(mass)
+
+    def set_cell_mass(self, p, k, mass):
+        cell = self.cells[p, k]
+        cell[MASS] = mass
+        cell[RADIUS] = game_config.RADIUS_FROM_MASS(mass)
+        cell[SPEED] = game_config.SPEED_FROM_RADIUS(cell[RADIUS])
+
+    def remove_cell(self, p, k):
+        n = self.n_cells[p]
+        self.cells[p, k:n - 1] = self.cells[p, k + 1:n]
+        self.n_cells[p] = n - 1
+
+    def cell_views(self):
+        """Per player list of CellView, built once per frame."""
+        if self._cell_views is None:
+            self._cell_views = [[CellView(*c) for c in self.cells[p, :n][:, [X, Y, MASS, RADIUS]].tolist()]
+                                for p, n in enumerate(self.n_cells.tolist())]
+        return self._cell_views
+
+    def player_aggregates(self):
+        """(total_mass, total_size, x, y, biggest) arrays over the players: x, y is the mass centroid and
+        biggest the index of the (first) biggest cell. Built once per frame, like cell_views."""
+        if self._player_aggregates is None:
+            alive = self.alive_cells()
+            masses = np.where(alive, self.cells[..., MASS], 0)
+            total_mass = masses.sum(axis=1)
+            self._player_aggregates = (total_mass, np.where(alive, self.cells[..., RADIUS], 0).sum(axis=1),
+                                       (self.cells[..., X] * masses).sum(axis=1) / total_mass,
+                                       (self.cells[..., Y] * masses).sum(axis=1) / total_mass,
+                                       np.where(alive, self.cells[..., RADIUS], -1).argmax(axis=1))
+        return self._player_aggregates
+
+    def alive_cells(self):
+        return alive_mask(self.n_cells)
+
+    def add_food(self, amount):
+        new_food = np.column_stack((np.random.randint(0, game_config.GAME_WIDTH + 1, amount),
+                                    np.random.randint(0, game_config.GAME_HEIGHT + 1, amount))).astype(float)
+        new_colors = np.random.randint(0, len(PELLET_PALETTE), amount).astype(np.uint8)
+        food = np.concatenate((self.food, new_food))
+        colors = np.concatenate((self.food_colors, new_colors))
+        order = np.argsort(food[:, 0], kind='stable')
+        self.food = food[order]
+        self.food_colors = colors[order]
+
+    def add_viruses(self, amount):
+        new_viruses = np.zeros((amount, VIRUS_FIELDS))
+        new_viruses[:, X] = np.random.randint(0, game_config.GAME_WIDTH + 1, amount)
+        new_viruses[:, Y] = np.random.randint(0, game_config.GAME_HEIGHT + 1, amount)
+        new_viruses[:, V_MASS] = game_config.VIRUS_INITIAL_MASS
+        new_viruses[:, V_RADIUS] = game_config.RADIUS_FROM_MASS(game_config.VIRUS_INITIAL_MASS)
+        self.viruses = np.concatenate((self.viruses, new_viruses))
+
+    def spawn_food(self):
+        if len(self.food) < game_config.MAX_FOOD_COUNT:
+            self.add_food(min(game_config.FOOD_SPAWN_RATE, game_config.MAX_FOOD_COUNT - len(self.food)))
+
+    def spawn_viruses(self):
+        if len(self.viruses) < game_config.MAX_VIRUS_COUNT_GENERATED:
+            self.add_viruses(min(game_config.VIRUS_SPAWN_RATE, game_config.MAX_VIRUS_COUNT_GENERATED - len(self.viruses)))
+
+    def update(self, actions):
+        px, py = self.begin_frame(actions)
+        self.split_cooldown[...] = np.maximum(0, self.split_cooldown - 1/game_config.FPS)
+        move_cells(self.cells, self.n_cells, px, py)
+        self.handle_all_self_collisions()
+        return self.end_frame()
+
+    def begin_frame(self, actions):
+        """First part of update: splits and ejections. Returns the target points as arrays."""
+        px = np.array([action[0] for action in actions], dtype=float)
+        py = np.array([action[1] for action in actions], dtype=float)
+        self.begin_frame_arrays(px, py, [action[2] for action in actions], [action[3] for action in actions])
+        return px, py
+
+    def begin_frame_arrays(self, px, py, do_split, do_feed):
+        """begin_frame with the actions as (players,) arrays"""
+        self.frame_counter = (self.frame_counter + 1) % game_config.FPS
+        self._cell_views = None
+        self._player_aggregates = None
+        self.state_version += 1
+
+        self.mass_eaten[:] = 0
+        self.mass_lost[:] = 0
+        self.mass_ejected[:] = 0
+
+        new_ejected = []
+        for p in np.flatnonzero(np.logical_or(do_split, do_feed)):
+            if do_split[p]:
+                self.try_split(p, px[p], py[p])
+            if do_feed[p]:
+                new_ejected.extend(self.eject_food(p, px[p], py[p]))
+        if new_ejected:
+            self.ejected = np.concatenate((self.ejected, np.array([e[0] for e in new_ejected])))
+            self.ejected_colors = np.concatenate((self.ejected_colors, np.array([e[1] for e in new_ejected])))
+
+    def handle_all_self_collisions(self):
+        handle_self_collisions(self.cells, self.n_cells)
+
+    def end_frame(self, eat_food=True):
+        """Last part of update, after the cells moved and self collisions: ejected food and viruses,
+        collisions and spawning. Returns the names of the players that got reset.
+        eat_food=False when a BatchedGame already resolved the pellets of all its worlds."""
+        self.ejected_food_update()
+        self.virus_update()
+        reset_player_names = self.handle_collisions(eat_food)
+        if self.frame_counter == 0:
+            self.spawn_food()
+            self.spawn_viruses()
+
+        self._cell_views = None
+        self._player_aggregates = None
+        return reset_player_names
+
+    def try_split(self, p, px, py):
+        if self.split_cooldown[p] > 0:
+            return
+
+        n = self.n_cells[p]
+        new_cells = 0
+        for k in np.argsort(-self.cells[p, :n, MASS], kind='stable'):
+            if n + new_cells >= game_config.MAX_AMOUNT_CELLS:
+                break
+            cell = self.cells[p, k]
+            if cell[MASS] >= game_config.SPLIT_MASS_THRESHOLD:
+                new_mass = cell[MASS] / 2
+                self.set_cell_mass(p, k, new_mass)
+                cell[MERGE] = game_config.MERGE_TIME_FROM_MASS(new_mass)
+
+                dx, dy = px - cell[X], py - cell[Y]
+                magnitude = math.sqrt(dx**2 + dy**2)
+                if magnitude == 0:
+                    # default to splitting to the right
+                    dx, dy, magnitude = 1, 0, 1
+                vx = (dx / magnitude) * game_config.SPLIT_SPEED
+                vy = (dy / magnitude) * game_config.SPLIT_SPEED
+                self.set_cell(p, n + new_cells, cell[X], cell[Y], new_mass, vx, vy)
+                new_cells += 1
+
+        self.n_cells[p] = n + new_cells
+        if new_cells:
+            self.split_cooldown[p] = game_config.SPLIT_COOLDOWN
+
+    def eject_food(self, p, px, py):
+        ejected = []
+        color = self.colors[p]
+        for k in range(self.n_cells[p]):
+            cell = self.cells[p, k]
+            dx, dy = px - cell[X], py - cell[Y]
+            magnitude = math.sqrt(dx**2 + dy**2)
+            if magnitude == 0:
+                # default to ejecting to the right
+                dx, dy, magnitude = 1, 0, 1
+
+            if cell[MASS] >= game_config.MIN_PLAYER_MASS + game_config.EJECTED_MASS:
+                angle = math.atan2(dy, dx) + random.uniform(-math.pi, math.pi)/12
+                self.set_cell_mass(p, k, cell[MASS] - game_config.EJECTED_MASS)
+                self.mass_ejected[p] += game_config.EJECTED_MASS
+                ejected.append(((cell[X] + (dx/magnitude)*cell[RADIUS], cell[Y] + (dy/magnitude)*cell[RADIUS],
+                                 math.cos(angle) * game_config.EJECTION_SPEED, math.sin(angle) * game_config.EJECTION_SPEED),
+                                color))
+        return ejected
+
+    def regulate_cell_masses(self, p):
+        """Same as Player.regulate_cell_masses"""
+        n = self.n_cells[p]
+        masses = self.cells[p, :n, MASS]
+        total_mass = masses.sum()
+        if total_mass > game_config.MAX_PLAYER_MASS:
+            mass_to_regulate = total_mass - game_config.MIN_PLAYER_MASS * n
+            mass_goal = game_config.MAX_PLAYER_MASS - game_config.MIN_PLAYER_MASS * n
+            if mass_goal <= 0:
+                raise Exception("It seems that MAX_PLAYER_MASS <= MIN_PLAYER_MASS * MAX_AMOUNT_CELLS, which is nonsensical. Please correct this.")
+            cells = self.cells[p, :n]
+            cells[:, MASS] = game_config.MIN_PLAYER_MASS + (masses - game_config.MIN_PLAYER_MASS) * mass_goal/mass_to_regulate
+            cells[:, RADIUS] = radius_from_mass(cells[:, MASS])
+            cells[:, SPEED] = speed_from_radius(cells[:, RADIUS])
+            return True
+        return False
+
+    def grow_cell(self, p, k, amount):
+        self.set_cell_mass(p, k, self.cells[p, k, MASS] + amount)
+        self.regulate_cell_masses(p)
+        self.mass_eaten[p] += amount
+
+    def explode_cell(self, p, k):
+        max_new_cells = game_config.MAX_AMOUNT_CELLS - self.n_cells[p]
+        if max_new_cells <= 0:
+            return
+
+        cell = self.cells[p, k]
+        num_new_cells = min(max_new_cells, int(cell[MASS] / game_config.MIN_PLAYER_MASS) - 1)
+        new_cell_mass = cell[MASS] / (num_new_cells + 1)
+        self.set_cell_mass(p, k, new_cell_mass)
+        cell[MERGE] = game_config.MERGE_TIME_FROM_MASS(new_cell_mass)
+
+        n = self.n_cells[p]
+        for i in range(num_new_cells):
+            angle = random.uniform(0, 2 * math.pi)
+            vx = math.cos(angle) * game_config.EXPLODE_SPEED
+            vy = math.sin(angle) * game_config.EXPLODE_SPEED
+            self.set_cell(p, n + i, cell[X], cell[Y], new_cell_mass, vx, vy)
+        self.n_cells[p] = n + num_new_cells
+        if num_new_cells > 0:
+            self.split_cooldown[p] = game_config.SPLIT_COOLDOWN
+
+    def ejected_food_update(self):
+        ejected = self.ejected
+        ejected[:, X] += ejected[:, VX]
+        ejected[:, Y] += ejected[:, VY]
+        np.clip(ejected[:, X], EJECTED_RADIUS/2, game_config.GAME_WIDTH - EJECTED_RADIUS/2, out=ejected[:, X])
+        np.clip(ejected[:, Y], EJECTED_RADIUS/2, game_config.GAME_HEIGHT - EJECTED_RADIUS/2, out=ejected[:, Y])
+        ejected[:, VX] *= VELOCITY_DECAY
+        ejected[:, VY] *= VELOCITY_DECAY
+
+    def virus_update(self):
+        """Checks for separation, separates, and then moves every virus"""
+        new_viruses = []
+        for v in np.argsort(-self.viruses[:, V_MASS], kind='stable'):
+            if len(self.viruses) + len(new_viruses) >= game_config.MAX_VIRUS_COUNT_SEPARATION:
+                break
+            virus = self.viruses[v]
+            if virus[V_MASS] < game_config.VIRUS_SEPARATION_MASS:
+                continue
+            if not virus[V_HAS_FED]:
+                raise Exception("Virus is bigger than the separation theshold without having been fed")
+            virus[V_MASS] = game_config.VIRUS_INITIAL_MASS
+            virus[V_RADIUS] = game_config.RADIUS_FROM_MASS(virus[V_MASS])
+
+            dx, dy = virus[V_FED_X], virus[V_FED_Y]
+            magnitude = math.sqrt(dx**2 + dy**2)
+            if magnitude == 0:
+                raise Exception("virus is separating but somehow has last_fed_direction as (0, 0)")
+            new_virus = np.zeros(VIRUS_FIELDS)
+            new_virus[X], new_virus[Y] = virus[X], virus[Y]
+            new_virus[VX] = (dx / magnitude) * game_config.VIRUS_SPLIT_SPEED
+            new_virus[VY] = (dy / magnitude) * game_config.VIRUS_SPLIT_SPEED
+            new_virus[V_MASS] = game_config.VIRUS_INITIAL_MASS
+            new_virus[V_RADIUS] = virus[V_RADIUS]
+            new_viruses.append(new_virus)
+
+        if new_viruses:
+            self.viruses = np.concatenate((self.viruses, np.array(new_viruses)))
+
+        # move the viruses
+        viruses = self.viruses
+        viruses[:, X] += viruses[:, VX]
+        viruses[:, Y] += viruses[:, VY]
+        viruses[:, VX] *= VELOCITY_DECAY
+        viruses[:, VY] *= VELOCITY_DECAY
+
+    def eat_food(self):
+        eaten, mass_eaten = eat_food(self.cells[None], self.n_cells[None], [self.food])
+        self.apply_eaten_food(eaten[0], mass_eaten[0])
+
+    def apply_eaten_food(self, eaten, mass_eaten):
+        self.food = self.food[~eaten]
+        self.food_colors = self.food_colors[~eaten]
+        self.mass_eaten += mass_eaten
+
+    def handle_collisions(self, eat_food=True):
+        # Pellets first, for every cell in one pass
+        if eat_food:
+            self.eat_food()
+
+        reset_players = set()
+        ejected_alive = np.ones(len(self.ejected), dtype=bool)
+        virus_alive = np.ones(len(self.viruses), dtype=bool)
+        ejected, viruses = self.ejected, self.viruses
+        touches_cells, touches_ejected, touches_viruses = self.broad_phase()
+
+        # Viruses eat ejected food
+        if len(ejected):
+            for v in range(len(viruses)):
+                virus = viruses[v]
+                if virus[V_MASS] <= game_config.EJECTED_MASS * game_config.MASS_FACTOR_EAT_ANOTHER or virus[V_RADIUS] < EJECTED_RADIUS:
+                    continue
+                reach = virus[V_RADIUS] - EJECTED_RADIUS * game_config.CLOSENESS_FACTOR
+                # a virus only grows while eating, so everything in reach now stays in reach
+                hits = ejected_alive & ((ejected[:, X] - virus[X])**2 + (ejected[:, Y] - virus[Y])**2 < reach**2)
+                for e in np.flatnonzero(hits):
+                    virus[V_MASS] = min(virus[V_MASS] + game_config.EJECTED_MASS, game_config.VIRUS_MAX_MASS)
+                    virus[V_RADIUS] = game_config.RADIUS_FROM_MASS(virus[V_MASS])
+                    virus[V_FED_X], virus[V_FED_Y] = ejected[e, VX], ejected[e, VY]
+                    if virus[V_FED_X] == 0 and virus[V_FED_Y] == 0:
+                        virus[V_FED_X], virus[V_FED_Y] = virus[X] - ejected[e, X], virus[Y] - ejected[e, Y]
+                    virus[V_HAS_FED] = 1
+                    ejected_alive[e] = False
+
+        for i in range(len(self.players)):
+            if self.names[i] in reset_players or not (touches_cells[i] or touches_ejected[i] or touches_viruses[i]):
+                continue
+
+            k = 0
+            while k < self.n_cells[i]:  # explosions can append cells while we iterate
+                cell = self.cells[i, k]
+
+                # Ejected food can be eaten by players
+                if touches_ejected[i] and cell[MASS] > game_config.EJECTED_MASS * game_config.MASS_FACTOR_EAT_ANOTHER and cell[RADIUS] >= EJECTED_RADIUS:
+                    reach = cell[RADIUS] - EJECTED_RADIUS * game_config.CLOSENESS_FACTOR
+                    hits = ejected_alive & ((ejected[:, X] - cell[X])**2 + (ejected[:, Y] - cell[Y])**2 < reach**2)
+                    n_eaten = np.count_nonzero(hits)
+                    if n_eaten:
+                        ejected_alive &= ~hits
+                        self.grow_cell(i, k, n_eaten * game_config.EJECTED_MASS)
+
+                # Check for virus collisions
+                hits = touches_viruses[i] and (virus_alive & (cell[MASS] > viruses[:, V_MASS] * game_config.MASS_FACTOR_EAT_ANOTHER) &
+                        (cell[RADIUS] >= viruses[:, V_RADIUS]) &
+                        ((viruses[:, X] - cell[X])**2 + (viruses[:, Y] - cell[Y])**2
+                         < (cell[RADIUS] - viruses[:, V_RADIUS] * game_config.CLOSENESS_FACTOR)**2))
+                for v in np.flatnonzero(hits) if touches_viruses[i] else ():
+                    virus = viruses[v]
+                    distance = math.sqrt((cell[X] - virus[X])**2 + (cell[Y] - virus[Y])**2)
+                    # the cell shrinks after each explosion, check again
+                    if (cell[MASS] > virus[V_MASS] * game_config.MASS_FACTOR_EAT_ANOTHER and
+                            cell[RADIUS] >= virus[V_RADIUS] and
+                            distance < cell[RADIUS] - virus[V_RADIUS] * game_config.CLOSENESS_FACTOR):
+                        virus_alive[v] = False
+                        self.grow_cell(i, k, virus[V_MASS])
+                        self.explode_cell(i, k)
+
+                # Check for player collisions
+                if not touches_cells[i]:
+                    k += 1
+                    continue
+                others = self.cells
+                edible = (self.alive_cells() &
+                          (cell[MASS] > others[..., MASS] * game_config.MASS_FACTOR_EAT_ANOTHER) &
+                          (cell[RADIUS] >= others[..., RADIUS]) &
+                          ((others[..., X] - cell[X])**2 + (others[..., Y] - cell[Y])**2
+                           < (cell[RADIUS] - others[..., RADIUS] * game_config.CLOSENESS_FACTOR)**2))
+                edible[i] = False
+                for j in np.flatnonzero(edible.any(axis=1)):
+                    if self.names[j] in reset_players:
+                        continue
+                    # Remove from the back so the indices of the remaining cells stay valid
+                    for other_k in np.flatnonzero(edible[j])[::-1]:
+                        other_mass = self.cells[j, other_k, MASS]
+                        self.grow_cell(i, k, other_mass)
+                        self.mass_lost[j] += other_mass
+                        self.remove_cell(j, other_k)
+                    if self.n_cells[j] == 0:
+                        # Don't check that player anymore and schedule for resetting
+                        reset_players.add(self.names[j])
+                k += 1
+
+        # Drop everything that was eaten this frame in one go
+        self.ejected = self.ejected[ejected_alive]
+        self.ejected_colors = self.ejected_colors[ejected_alive]
+        self.viruses = self.viruses[virus_alive]
+
+        for p in np.flatnonzero(self.n_cells == 0):
+            self.reset_player(p)
+        self._cell_views = None
+        self._player_aggregates = None
+        self.state_version += 1
+        return reset_players
+
+    def broad_phase(self):
+        """Per player flags: does any of its cells overlap another player's cell, an ejected pellet
+        or a virus at the start of the collision stage. Players with no overlap skip that test."""
+        alive = self.alive_cells()
+        cells = self.cells[alive]
+        owners = np.nonzero(alive)[0]
+
+        def touching(xs, ys, radii):
+            d2 = (cells[:, None, X] - xs[None, :])**2 + (cells[:, None, Y] - ys[None, :])**2
+            return d2 < (cells[:, None, RADIUS] + radii[None, :])**2
+
+        def per_player(flags):
+            return np.bincount(owners, weights=flags.any(axis=1), minlength=len(self.names)) > 0
+
+        other_cells = touching(cells[:, X], cells[:, Y], cells[:, RADIUS]) & (owners[:, None] != owners[None, :])
+        ejected = touching(self.ejected[:, X], self.ejected[:, Y], np.full(len(self.ejected), EJECTED_RADIUS))
+        viruses = touching(self.viruses[:, X], self.viruses[:, Y], self.viruses[:, V_RADIUS])
+        return per_player(other_cells), per_player(ejected), per_player(viruses)
+
+    def reset_player(self, p):
+        """Use this function to respawn the player"""
+        self.n_cells[p] = 1
+        self.set_cell(p, 0, random.randint(0, game_config.GAME_WIDTH), random.randint(0, game_config.GAME_HEIGHT),
+                      game_config.INITIAL_PLAYER_MASS)
+
+    def get_player_state(self, p):
+        n = self.n_cells[p]
+        cells = self.cells[p, :n]
+        masses = cells[:, MASS]
+        total_mass = masses.sum()
+        return {
+            "name": self.names[p],
+            "total_size": float(cells[:, RADIUS].sum()),
+            "total_mass": float(total_mass),
+            "x": float((cells[:, X] * masses).sum() / total_mass),
+            "y": float((cells[:, Y] * masses).sum() / total_mass),
+            "cells": [{'x': x, 'y': y, 'color': self.colors[p], 'name': self.names[p], 'mass': mass, 'radius': radius}
+                      for x, y, mass, radius in cells[:, [X, Y, MASS, RADIUS]].tolist()]
+        }
+
+    def get_state(self):
+        return {
+            'players': [self.get_player_state(p) for p in range(len(self.players))],
+            'food': [{'x': x, 'y': y, 'color': PELLET_PALETTE[color], 'mass': game_config.PELLET_MASS, 'radius': PELLET_RADIUS}
+                     for (x, y), color in zip(self.food.tolist(), self.food_colors.tolist())],
+            'viruses': [{'x': v[X], 'y': v[Y], 'mass': v[V_MASS], 'radius': v[V_RADIUS], 'color': VIRUS_COLOR,
+                         'spikes': int(v[V_RADIUS]/2)} for v in self.viruses.tolist()],
+            'ejected_food': [{'x': e[X], 'y': e[Y], 'vx': e[VX], 'vy': e[VY], 'color': tuple(color),
+                              'mass': game_config.EJECTED_MASS, 'radius': EJECTED_RADIUS}
+                             for e, color in zip(self.ejected.tolist(), self.ejected_colors.tolist())]
+        }
+
+    def get_state_arrays(self):
+        """Same as Game.get_state_arrays. Food, viruses and ejected food are views of the world arrays,
+        the alive cells are gathered into one array."""
+        if self._state_arrays is not None and self._state_arrays.version == self.state_version:
+            return self._state_arrays
+
+        alive = self.alive_cells()
+        total_mass, total_size, x, y, _ = self.player_aggregates()
+        player_arrays = PlayerArrays(tuple(self.names), self.player_colors, *read_only(x, y, total_size, total_mass))
+
+        owners, _ = np.nonzero(alive)
+        cells = self.cells[alive]
+        cells = EntityArrays(*read_only(cells[:, X], cells[:, Y], cells[:, RADIUS], cells[:, MASS], owners),
+                             self.player_colors)
+
+        n = len(self.food)
+        food = EntityArrays(read_only(self.food[:, 0]), read_only(self.food[:, 1]), np.broadcast_to(PELLET_RADIUS, n),
+                            np.broadcast_to(float(game_config.PELLET_MASS), n), read_only(self.food_colors[:]),
+                            read_only(np.array(PELLET_PALETTE, dtype=np.uint8)))
+
+        v = self.viruses
+        viruses = EntityArrays(*read_only(v[:, X], v[:, Y], v[:, V_RADIUS], v[:, V_MASS], np.zeros(len(v), dtype=np.intp)),
+                               read_only(np.array([VIRUS_COLOR], dtype=np.uint8)))
+
+        n = len(self.ejected)
+        ejected_food = EntityArrays(read_only(self.ejected[:, X]), read_only(self.ejected[:, Y]),
+                                    np.broadcast_to(EJECTED_RADIUS, n), np.broadcast_to(float(game_config.EJECTED_MASS), n),
+                                    read_only(np.arange(n)), read_only(self.ejected_colors.astype(np.uint8)))
+
+        self._state_arrays = StateArrays(self.state_version, player_arrays, cells, food, viruses, ejected_food)
+        return self._state_arrays
+
+    def get_RL_state(self, player_index):
+        return self.get_RL_state_array(player_index, out=np.zeros(game_config.OBSERVATION_SIZE)).tolist()
+
+    def get_RL_states(self, player_indices, out=None):
+        """get_RL_state_array of several players, as the rows of out (len(player_indices), OBSERVATION_SIZE)"""
+        if out is None:
+            out = np.zeros((len(player_indices), game_config.OBSERVATION_SIZE), dtype=np.float32)
+        for row, player_index in zip(out, player_indices):
+            self.get_RL_state_array(player_index, out=row)
+        return out
+
+    def get_RL_state_array(self, player_index, out=None):
+        """Same layout as Game.get_RL_state: 16 own cells, 30 other cells, 100 food, 10 viruses,
+        each as (x, y, mass) normalized to the view. Padding repeats the last written position.
+        Written into out (OBSERVATION_SIZE,) if given, e.g. a row of a batched float32 block,
+        otherwise into self.observation, a float32 buffer overwritten by the next call."""
+        n = self.n_cells[player_index]
+        own = self.cells[player_index, :n]
+        total_size = own[:, RADIUS].sum()
+
+        # Calculate visible area
+        view_width = game_config.WIDTH / math.pow(min(64 / total_size, 1), 0.4)
+        view_height = game_config.HEIGHT / math.pow(min(64 / total_size, 1), 0.4)
+        view_left = own[0, X] - view_width / 2
+        view_top = own[0, Y] - view_height / 2
+
+        def visible(xs, ys):
+            return (view_left <= xs) & (xs <= view_left + view_width) & (view_top <= ys) & (ys <= view_top + view_height)
+
+        alive = self.alive_cells()
+        alive[player_index] = False
+        others = self.cells[alive]
+        others = others[visible(others[:, X], others[:, Y])]
+        others = others[np.argsort(-others[:, MASS], kind='stable')]
+
+        # food is sorted by x, only the slice under the view is tested
+        first = np.searchsorted(self.food[:, 0], view_left, side='left')
+        last = np.searchsorted(self.food[:, 0], view_left + view_width, side='right')
+        pellets = self.food[first:last]
+        pellets = pellets[(view_top <= pellets[:, 1]) & (pellets[:, 1] <= view_top + view_height)][:100]
+        ejected = self.ejected[visible(self.ejected[:, X], self.ejected[:, Y])][:100 - len(pellets), [X, Y]]
+        food = np.concatenate((pellets, ejected))
+        food_mass = np.concatenate((np.full(len(pellets), game_config.PELLET_MASS),
+                                    np.full(len(ejected), game_config.EJECTED_MASS)))
+        viruses = self.viruses[visible(self.viruses[:, X], self.viruses[:, Y])]
+
+        if out is None:
+            out = self.observation
+        obs = out.reshape(16 + 30 + 100 + 10, 3)
+        obs[:, 2] = 0
+        last = (0, 0)
+        start = 0
+        for xs, ys, masses, size in ((own[:, X], own[:, Y], own[:, MASS] / game_config.MAX_PLAYER_MASS, 16),
+                                     (others[:, X], others[:, Y], others[:, MASS] / game_config.MAX_PLAYER_MASS, 30),
+                                     (food[:, 0], food[:, 1], food_mass, 100),
+                                     (viruses[:, X], viruses[:, Y], viruses[:, V_MASS], 10)):
+            count = min(len(xs), size)
+            block = obs[start:start + size]
+            if count:
+                block[:count, 0] = (xs[:count] - view_left) / view_width
+                block[:count, 1] = (ys[:count] - view_top) / view_height
+                block[:count, 2] = masses[:count]
+                last = block[count - 1, :2].copy()
+            block[count:, :2] = last  # Padding
+            start += size
+
+        return out
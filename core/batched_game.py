@@ -0,0 +1,81 @@
+# core/batched_game.py
+import numpy as np
+import config
+from core.array_game import ArrayGame, player_buffers, move_cells, handle_self_collisions, eat_food, X, Y, RADIUS
+
+game_config = config.GameConfig()
+
+"""
+B independent worlds of the array engine stepped together.
+
+The per player arrays of all worlds live in one block with a leading batch dimension
+(cells is (B, players, MAX_AMOUNT_CELLS, CELL_FIELDS)), each ArrayGame works on its view
+of it. Movement, velocity decay, mass loss, clamping, cooldowns, self collisions and pellet eating
+run once for all worlds, the actions are (B, players) arrays, the discrete actions of player 0 are converted for all
+worlds at once and the observations are written straight into a (B, OBSERVATION_SIZE) float32 block.
+"""
+
+
+class BatchedGame:
+    def __init__(self, num_worlds, player_names, non_dummy_players):
+        self.num_worlds = num_worlds
+        self.player_names = list(player_names)
+        self.non_dummy_players = non_dummy_players
+
+        self.buffers = player_buffers(len(player_names), (num_worlds,))
+        for key, array in self.buffers.items():
+            setattr(self, key, array)
+        self.worlds = [None] * num_worlds
+        for b in range(num_worlds):
+            self.reset_world(b)
+
+        self.observations = np.zeros((num_worlds, game_config.OBSERVATION_SIZE), dtype=np.float32)
+
+    def reset_world(self, b):
+        """Builds a fresh world in slot b"""
+        self.worlds[b] = ArrayGame(self.player_names, self.non_dummy_players,
+                                   buffers={key: array[b] for key, array in self.buffers.items()})
+
+    def update(self, px, py, do_split, do_feed):
+        """The actions of every player of every world, as (B, players) arrays.
+        Returns the set of reset player names of each world."""
+        px = np.asarray(px, dtype=float)
+        py = np.asarray(py, dtype=float)
+        for b, world in enumerate(self.worlds):
+            world.begin_frame_arrays(px[b], py[b], do_split[b], do_feed[b])
+
+        self.split_cooldown[...] = np.maximum(0, self.split_cooldown - 1/game_config.FPS)
+        move_cells(self.cells, self.n_cells, px, py)
+        handle_self_collisions(self.cells, self.n_cells)
+
+        # Pellets of every world in one pass
+        eaten, mass_eaten = eat_food(self.cells, self.n_cells, [world.food for world in self.worlds])
+        for world, world_eaten, world_mass_eaten in zip(self.worlds, eaten, mass_eaten):
+            world.apply_eaten_food(world_eaten, world_mass_eaten)
+        return [world.end_frame(eat_food=False) for world in self.worlds]
+
+    def discrete_to_targets(self, actions, player_idx=0):
+        """Vectorized AgarEnv._action_to_game_format for one player of every world.
+        actions is (B,) in [0, ACTION_SPACE). Returns px, py and do_split as (B,) arrays."""
+        actions = np.asarray(actions)
+        cells = self.cells[:, player_idx]
+        alive = np.arange(game_config.MAX_AMOUNT_CELLS) < self.n_cells[:, player_idx, None]
+        biggest = np.where(alive, cells[..., RADIUS], -1).argmax(axis=1)
+        biggest_cell = cells[np.arange(self.num_worlds), biggest]
+
+        angle = 2 * np.pi * (actions % game_config.TOTAL_DIRECTIONS) / game_config.TOTAL_DIRECTIONS
+        offset = np.where(actions == 2 * game_config.TOTAL_DIRECTIONS, 0,  # "Center" action
+                          game_config.DISCRETE_FACTOR_DISTANCE * biggest_cell[:, RADIUS])
+        px = biggest_cell[:, X] + offset * np.cos(angle)
+        py = biggest_cell[:, Y] + offset * np.sin(angle)
+        do_split = (actions >= game_config.TOTAL_DIRECTIONS) & (actions < 2 * game_config.TOTAL_DIRECTIONS)
+        return px, py, do_split
+
+    def rewards(self, player_idx=0):
+        return self.mass_eaten[:, player_idx] - self.mass_lost[:, player_idx] - self.mass_ejected[:, player_idx]
+
+    def get_RL_states(self, player_idx=0):
+        """(B, OBSERVATION_SIZE) float32 block, reused between calls"""
+        for world, row in zip(self.worlds, self.observations):
+            world.get_RL_state_array(player_idx, out=row)
+        return self.observations
@@ -1,13 +1,32 @@
 import config
+import colorsys
+import itertools
+import numpy as np
+from operator import is_not
 game_config = config.GameConfig()
 
+uids = itertools.count()  # creation order, Game keeps ejected_food sorted by it
+
+# Every pellet has the same mass and radius, and its color is an index into a shared palette
+PELLET_RADIUS = game_config.RADIUS_FROM_MASS(game_config.PELLET_MASS)
+EJECTED_RADIUS = game_config.RADIUS_FROM_MASS(game_config.EJECTED_MASS)
+PELLET_PALETTE = [tuple(int(255 * c) for c in colorsys.hsv_to_rgb(i / 64, 0.75, 0.95)) for i in range(64)]
+
 class Pellet:
-    def __init__(self, x, y, color, mass):
+    __slots__ = ('uid', 'index', 'x', 'y', 'color_index')
+    mass = game_config.PELLET_MASS
+    radius = PELLET_RADIUS
+
+    def __init__(self, x, y, color_index):
+        self.uid = next(uids)
+        self.index = None  # position in its PelletPool
         self.x = x
         self.y = y
-        self.color = color
-        self.mass = mass
-        self.radius = game_config.RADIUS_FROM_MASS(mass)
+        self.color_index = color_index
+
+    @property
+    def color(self):
+        return PELLET_PALETTE[self.color_index]
 
     def get_state(self):
         """Return the current state of the cell."""
@@ -19,17 +38,103 @@ class Pellet:
             'radius': self.radius
         }
 
+class PelletPool:
+    """Fixed capacity storage for the static pellets, nothing is allocated after construction.
+    The alive pellets are packed in the first `count` slots and the slots after them are the free list:
+    removing a pellet swaps it with the last alive one, spawning revives the first free one.
+    x, y and colors (PELLET_PALETTE indices) are array views of the alive pellets,
+    iterating gives the alive Pellet objects."""
+    mass = Pellet.mass
+    radius = Pellet.radius
+    palette = np.array(PELLET_PALETTE, dtype=np.uint8)  # palette[colors] gives the RGB rows
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+
+        self.pellets = [Pellet(0, 0, 0) for _ in range(capacity)]
+        for index, pellet in enumerate(self.pellets):
+            pellet.index = index
+        self._x = np.zeros(capacity)
+        self._y = np.zeros(capacity)
+        self._colors = np.zeros(capacity, dtype=np.uint8)
+        self._uids = np.zeros(capacity, dtype=np.int64)
+
+    @property
+    def x(self):
+        return self._x[:self.count]
+
+    @property
+    def y(self):
+        return self._y[:self.count]
+
+    @property
+    def colors(self):
+        return self._colors[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return itertools.islice(self.pellets, self.count)
+
+    def spawn(self, x, y, color_index):
+        if self.count == self.capacity:
+            raise Exception("Pellet pool is full, spawn less than MAX_FOOD_COUNT pellets")
+        pellet = self.pellets[self.count]
+        pellet.uid = next(uids)
+        pellet.x, pellet.y, pellet.color_index = x, y, color_index
+        self._x[self.count], self._y[self.count], self._colors[self.count] = x, y, color_index
+        self._uids[self.count] = pellet.uid
+        self.count += 1
+        return pellet
+
+    def remove(self, pellet):
+        index, last = pellet.index, self.count - 1
+        last_pellet = self.pellets[last]
+        self.pellets[index], self.pellets[last] = last_pellet, pellet
+        last_pellet.index, pellet.index = index, last
+        self._x[index], self._y[index], self._colors[index] = self._x[last], self._y[last], self._colors[last]
+        self._uids[index] = self._uids[last]
+        self.count = last
+
+    def snapshot(self):
+        n = self.count
+        return (n, self.pellets[:], self._x[:n].copy(), self._y[:n].copy(), self._colors[:n].copy(), self._uids[:n].copy())
+
+    def restore(self, snapshot):
+        """Back to an earlier snapshot(). Only the Pellet objects that were recycled
+        or moved to another slot since then are written to."""
+        n, pellets, x, y, colors, uids = snapshot
+        # A slot is untouched if it holds the same object as then, alive then and now with the same uid
+        changed = np.fromiter(map(is_not, self.pellets, pellets), dtype=bool, count=self.capacity)
+        alive = min(n, self.count)
+        changed[:alive] |= self._uids[:alive] != uids[:alive]
+        changed[alive:n] = True
+
+        self.count = n
+        self.pellets[:] = pellets
+        self._x[:n], self._y[:n], self._colors[:n], self._uids[:n] = x, y, colors, uids
+        for index in np.flatnonzero(changed).tolist():
+            pellet = pellets[index]
+            pellet.index = index
+            if index < n and pellet.uid != uids[index]:  # respawned since
+                pellet.uid, pellet.x, pellet.y, pellet.color_index = int(uids[index]), float(x[index]), float(y[index]), int(colors[index])
+
 class ThrownPellet:
-    def __init__(self, x, y, vx, vy, color, mass):
+    __slots__ = ('uid', 'x', 'y', 'vx', 'vy', 'color', 'mass', 'radius')
+
+    def __init__(self, x, y, vx, vy, color, mass=game_config.EJECTED_MASS):
+        self.uid = next(uids)
         self.x = x
         self.y = y
 
         self.vx = vx
         self.vy = vy
         
-        self.color = color
+        self.color = color  # the shared color tuple of the player that ejected it
         self.mass = mass
-        self.radius = game_config.RADIUS_FROM_MASS(mass)
+        self.radius = EJECTED_RADIUS if mass == game_config.EJECTED_MASS else game_config.RADIUS_FROM_MASS(mass)
 
     def update(self):
         self.x += self.vx
@@ -1,12 +1,79 @@
 # core/game.py
-from core.player import Player
-from core.food import Pellet
+from core.player import Player, handle_players_self_collisions
+from core.food import Pellet, PelletPool, ThrownPellet, PELLET_PALETTE
 from core.virus import Virus
+from operator import attrgetter
+from collections import namedtuple
+import heapq
+import itertools
 import math
 import random
+import numpy as np
 import config
 game_config = config.GameConfig()
 
+by_uid = attrgetter('uid')  # entity lists are always in creation order
+by_x = attrgetter('x')
+by_mass = attrgetter('mass')
+
+# Everything about an entity that can change after it's created, in the order Game.restore assigns them
+cell_fields = attrgetter('x', 'y', 'mass', 'radius', 'speed', 'merge_time', 'external_vx', 'external_vy')
+player_fields = attrgetter('split_cooldown', 'mass_eaten_this_frame', 'mass_lost_this_frame', 'mass_ejected_this_frame')
+virus_fields = attrgetter('x', 'y', 'mass', 'radius', 'spikes', 'vx', 'vy', 'last_fed_direction')
+ejected_fields = attrgetter('x', 'y', 'vx', 'vy')
+state_fields = attrgetter('x', 'y', 'radius', 'mass')
+
+GameSnapshot = namedtuple("GameSnapshot", ["frame_counter", "players", "viruses", "ejected_food", "food",
+                                           "grid", "grid_moving_objects", "random_state"])
+
+# Game.get_state_arrays(): one EntityArrays per entity type, color holds indices into palette (k, 3) uint8.
+# For cells the color index is the owner, palette is then players.colors.
+StateArrays = namedtuple("StateArrays", ["version", "players", "cells", "food", "viruses", "ejected_food"])
+PlayerArrays = namedtuple("PlayerArrays", ["names", "colors", "x", "y", "total_size", "total_mass"])
+EntityArrays = namedtuple("EntityArrays", ["x", "y", "radius", "mass", "color", "palette"])
+
+def read_only(*arrays):
+    """Flags the arrays (usually views) as read-only, returns the first one or all of them"""
+    for array in arrays:
+        array.flags.writeable = False
+    return arrays[0] if len(arrays) == 1 else arrays
+
+def entity_arrays(objects, color, palette):
+    """EntityArrays of a list of objects with x, y, radius and mass, all columns built in one call"""
+    x, y, radius, mass = read_only(*np.array(list(zip(*map(state_fields, objects))), dtype=float).reshape(4, -1))
+    return EntityArrays(x, y, radius, mass, read_only(color), palette)
+
+def fill_observation(out, blocks, view_left, view_top, view_width, view_height):
+    """Writes the observation blocks into out (OBSERVATION_SIZE,). blocks are (rows, size) pairs with rows
+    a list or array of (x, y, mass), positions get normalized to the view in float64 before being stored.
+    Padding rows repeat the last written position with mass 0, the first block must not be empty."""
+    rows = np.empty((len(out) // 3, 3))
+    source = np.arange(len(rows))
+    start = last = 0
+    for block_rows, size in blocks:
+        count = min(len(block_rows), size)
+        if count:
+            rows[start:start + count] = block_rows[:count]
+            last = start + count - 1
+        source[start + count:start + size] = last  # Padding
+        start += size
+
+    padding = source != np.arange(len(rows))
+    rows = rows[source]
+    rows[padding, 2] = 0
+    obs = out.reshape(-1, 3)
+    obs[:, 0] = (rows[:, 0] - view_left) / view_width
+    obs[:, 1] = (rows[:, 1] - view_top) / view_height
+    obs[:, 2] = rows[:, 2]
+    return out
+
+def first_true(mask, k):
+    """(row, column, rank in its row) of the first k True entries of each row of a 2D mask"""
+    rows, columns = np.nonzero(mask)
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, np.arange(len(mask)))[rows]
+    keep = ranks < k
+    return rows[keep], columns[keep], ranks[keep]
+
 def generate_points(rect_width, rect_height, min_distance, num_points):
     points = []
     attempts = 0
@@ -30,18 +97,53 @@ def generate_points(rect_width, rect_height, min_distance, num_points):
     return points
 
 class SpatialGrid:
-    # For optimization.
+    # For optimization. Kept alive across frames, objects are only re-bucketed when they cross a grid cell.
     def __init__(self, cell_size):
         self.cell_size = cell_size
-        self.grid = {}
+        self.grid = {}  # key -> bucket, buckets are dicts used as ordered sets
+        self.keys = {}  # object -> key of the bucket it is in
+
+    def key_of(self, obj):
+        return (int(obj.x // self.cell_size), int(obj.y // self.cell_size))
 
     def add_object(self, obj):
-        cell_x = int(obj.x // self.cell_size)
-        cell_y = int(obj.y // self.cell_size)
-        key = (cell_x, cell_y)
+        key = self.key_of(obj)
         if key not in self.grid:
-            self.grid[key] = []
-        self.grid[key].append(obj)
+            self.grid[key] = {}
+        self.grid[key][obj] = None
+        self.keys[obj] = key
+
+    def remove_object(self, obj):
+        key = self.keys.pop(obj)
+        bucket = self.grid[key]
+        del bucket[obj]
+        if not bucket:
+            del self.grid[key]
+
+    def move_object(self, obj):
+        """Inserts obj, or re-buckets it if it crossed into another grid cell since the last call"""
+        old_key = self.keys.get(obj)
+        if old_key is None:
+            self.add_object(obj)
+            return
+        key = self.key_of(obj)
+        if key != old_key:
+            self.remove_object(obj)
+            if key not in self.grid:
+                self.grid[key] = {}
+            self.grid[key][obj] = None
+            self.keys[obj] = key
+
+    def snapshot(self):
+        return dict(self.keys)
+
+    def restore(self, keys):
+        """Back to the objects of an earlier snapshot(), which must already be back at the positions
+        they had then. Only the objects that were added, removed or re-bucketed since are touched."""
+        for obj in [obj for obj, key in self.keys.items() if keys.get(obj) != key]:
+            self.remove_object(obj)
+        for obj in [obj for obj, key in keys.items() if obj not in self.keys]:
+            self.add_object(obj)
 
     def get_nearby_objects(self, obj, range_cells=1):
         cell_x = int(obj.x // self.cell_size)
@@ -53,6 +155,208 @@ class SpatialGrid:
                 if key in self.grid:
                     nearby.extend(self.grid[key])
         return nearby
+
+    def get_objects_in_range(self, low_x, high_x, low_y, high_y):
+        """Objects of the grid cells low_x..high_x times low_y..high_y (inclusive), in the same
+        order as get_nearby_objects. The lookups run in C, it is meant for wide areas."""
+        keys = itertools.product(range(low_x, high_x + 1), range(low_y, high_y + 1))
+        return list(itertools.chain.from_iterable(filter(None, map(self.grid.get, keys))))
+
+class HierarchicalGrid:
+    """
+    Multi-resolution version of SpatialGrid with the same interface and the same query results.
+
+    Level l has buckets of cell_size * 2**l and every object is in one bucket of each level.
+    A query covers the same square of level 0 cells as SpatialGrid.get_nearby_objects, but reads
+    its inside from coarse buckets and only uses the fine levels along its border, so a huge cell
+    costs a few hundred lookups instead of (2*range_cells + 1)**2.
+    """
+    DIRECT_RANGE = 6  # up to this range_cells scanning the level 0 square directly is as fast
+    DIRECT_CELLS = 441  # same for get_objects_in_range, whose level 0 scan runs in C
+
+    def __init__(self, cell_size, levels):
+        self.cell_size = cell_size
+        self.top_level = levels - 1
+        self.levels = [{} for _ in range(levels)]  # key -> bucket, buckets are dicts used as ordered sets
+        self.keys = {}  # object -> level 0 key of its buckets
+
+    def key_of(self, obj):
+        return (int(obj.x // self.cell_size), int(obj.y // self.cell_size))
+
+    def insert(self, obj, key):
+        key_x, key_y = key
+        for level in range(self.top_level + 1):
+            grid = self.levels[level]
+            level_key = (key_x >> level, key_y >> level)
+            if level_key not in grid:
+                grid[level_key] = {}
+            grid[level_key][obj] = None
+
+    def delete(self, obj, key):
+        key_x, key_y = key
+        for level in range(self.top_level + 1):
+            grid = self.levels[level]
+            level_key = (key_x >> level, key_y >> level)
+            bucket = grid[level_key]
+            del bucket[obj]
+            if not bucket:
+                del grid[level_key]
+
+    def add_object(self, obj):
+        key = self.key_of(obj)
+        self.insert(obj, key)
+        self.keys[obj] = key
+
+    def remove_object(self, obj):
+        self.delete(obj, self.keys.pop(obj))
+
+    def move_object(self, obj):
+        """Inserts obj, or re-buckets it in the levels whose bucket it left since the last call"""
+        old_key = self.keys.get(obj)
+        if old_key is None:
+            self.add_object(obj)
+            return
+        key = self.key_of(obj)
+        if key != old_key:
+            # the first level where both keys share a bucket, and all coarser ones, stay as they are
+            changed = ((key[0] ^ old_key[0]) | (key[1] ^ old_key[1])).bit_length()
+            for level in range(min(changed, self.top_level + 1)):
+                grid = self.levels[level]
+                old_level_key = (old_key[0] >> level, old_key[1] >> level)
+                bucket = grid[old_level_key]
+                del bucket[obj]
+                if not bucket:
+                    del grid[old_level_key]
+                level_key = (key[0] >> level, key[1] >> level)
+                if level_key not in grid:
+                    grid[level_key] = {}
+                grid[level_key][obj] = None
+            self.keys[obj] = key
+
+    snapshot = SpatialGrid.snapshot
+    restore = SpatialGrid.restore
+
+    def get_nearby_objects(self, obj, range_cells=1):
+        cell_x = int(obj.x // self.cell_size)
+        cell_y = int(obj.y // self.cell_size)
+        nearby = []
+        if range_cells <= self.DIRECT_RANGE:
+            grid = self.levels[0]
+            for dx in range(-range_cells, range_cells + 1):
+                for dy in range(-range_cells, range_cells + 1):
+                    key = (cell_x + dx, cell_y + dy)
+                    if key in grid:
+                        nearby.extend(grid[key])
+            return nearby
+        return self.get_objects_in_range(cell_x - range_cells, cell_x + range_cells,
+                                         cell_y - range_cells, cell_y + range_cells)
+
+    def get_objects_in_range(self, low_x, high_x, low_y, high_y):
+        """Objects of the level 0 cells low_x..high_x times low_y..high_y (inclusive)"""
+        if (high_x - low_x + 1) * (high_y - low_y + 1) <= self.DIRECT_CELLS:
+            keys = itertools.product(range(low_x, high_x + 1), range(low_y, high_y + 1))
+            return list(itertools.chain.from_iterable(filter(None, map(self.levels[0].get, keys))))
+
+        found = []
+        levels = self.levels
+        for level_x, block_x in self.aligned_blocks(low_x, high_x):
+            for level_y, block_y in self.aligned_blocks(low_y, high_y):
+                # the strip pair is covered by square buckets of the finer of the two levels
+                level = min(level_x, level_y)
+                grid = levels[level]
+                first_x, first_y = block_x << (level_x - level), block_y << (level_y - level)
+                for key_x in range(first_x, first_x + (1 << (level_x - level))):
+                    for key_y in range(first_y, first_y + (1 << (level_y - level))):
+                        key = (key_x, key_y)
+                        if key in grid:
+                            found.extend(grid[key])
+        return found
+
+    def aligned_blocks(self, low, high):
+        """Splits the cells low..high of one axis into the fewest aligned blocks, as (level, index) pairs"""
+        blocks = []
+        while low <= high:
+            level = 0
+            while (level < self.top_level and low % (2 << level) == 0 and
+                   low + (2 << level) - 1 <= high):
+                level += 1
+            blocks.append((level, low >> level))
+            low += 1 << level
+        return blocks
+
+class SweepAndPrune:
+    """Broad phase for cell vs cell. All player cells are kept sorted along x between frames
+    (the order barely changes from one frame to the next, so re-sorting is close to linear)
+    and a cell is only paired with the cells whose centre is inside its x interval and then its y interval.
+    The intervals are the square SpatialGrid.get_nearby_objects(cell, range_cells) covers, which
+    leaves room for a cell growing while it eats."""
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = []
+        self.pairs = {}  # cell -> cells of other players in its square, in x order
+
+    def update(self, players):
+        """Re-sorts the cells and finds every pair of the frame in one vectorized sweep"""
+        owners = {}
+        for i, player in enumerate(players):
+            for cell in player.cells:
+                owners[cell] = i
+        cells = [cell for cell in self.cells if cell in owners]
+        known = set(cells)
+        cells.extend(cell for cell in owners if cell not in known)
+        cells.sort(key=by_x)
+        self.cells = cells
+
+        size = self.cell_size
+        xs = np.array([cell.x for cell in cells])
+        ys = np.array([cell.y for cell in cells])
+        radius = np.array([cell.radius for cell in cells])
+        owner = np.array([owners[cell] for cell in cells])
+        range_cells = np.maximum(1, radius // size + 1)
+        key_x, key_y = xs // size, ys // size
+
+        lo = np.searchsorted(xs, (key_x - range_cells) * size, side='left')
+        hi = np.searchsorted(xs, (key_x + range_cells + 1) * size, side='left')
+        counts = hi - lo
+        eater = np.repeat(np.arange(len(cells)), counts)
+        other = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        keep = ((owner[other] != owner[eater]) &
+                ((key_y[eater] - range_cells[eater]) * size <= ys[other]) &
+                (ys[other] < (key_y[eater] + range_cells[eater] + 1) * size))
+
+        pairs = {}
+        for e, o in zip(eater[keep].tolist(), other[keep].tolist()):
+            if cells[e] in pairs:
+                pairs[cells[e]].append(cells[o])
+            else:
+                pairs[cells[e]] = [cells[o]]
+        self.pairs = pairs
+
+    def candidates(self, cell, range_cells, eaten, player_index):
+        """Cells of other players in the square of cell for range_cells, in player order
+        and then creation order like a scan of the players' cell lists"""
+        paired = self.pairs.get(cell)
+        if not paired:
+            return ()
+        # range_cells can only have shrunk since update, if the cell lost mass to a virus or to regulation
+        size = self.cell_size
+        cell_x, cell_y = cell.x // size, cell.y // size
+        left, right = (cell_x - range_cells) * size, (cell_x + range_cells + 1) * size
+        top, bottom = (cell_y - range_cells) * size, (cell_y + range_cells + 1) * size
+        found = [other for other in paired
+                 if left <= other.x < right and top <= other.y < bottom and other not in eaten]
+        if len(found) > 1:
+            found.sort(key=lambda c: (player_index[c.name], c.uid))
+        return found
+
+def make_spatial_grid(backend=None):
+    """Broad phase for Game, defaulting to game_config.SPATIAL_GRID_BACKEND"""
+    backend = backend or game_config.SPATIAL_GRID_BACKEND
+    if backend == "flat":
+        return SpatialGrid(game_config.SPATIAL_GRID_CELL)
+    if backend == "hierarchical":
+        return HierarchicalGrid(game_config.SPATIAL_GRID_CELL, game_config.SPATIAL_GRID_LEVELS)
+    raise Exception(f"Spatial grid backend {backend} not supported")
     
 class Game:
     def __init__(self, player_names, non_dummy_players):
@@ -74,21 +378,77 @@ class Game:
             name, mass=random.randint(50, 120)) for name, point in zip(player_names[non_dummy_players:], points[non_dummy_players:])]
 
         
-        self.food = self.generate_food(game_config.INITIAL_FOOD_COUNT)
+        # Pellets never move: they are inserted in the grid once when spawned, and removed when eaten.
+        self.spatial_grid = make_spatial_grid()
+        self.food = PelletPool(game_config.MAX_FOOD_COUNT)
+        self.generate_food(game_config.INITIAL_FOOD_COUNT)
         self.viruses = self.generate_viruses(game_config.INITIAL_VIRUS_COUNT)
         self.ejected_food = []
 
+        self.grid_moving_objects = set()  # viruses and ejected food currently in the grid
+        self.sweep_and_prune = SweepAndPrune(game_config.SPATIAL_GRID_CELL)  # player cells are not in the grid
+        self.observation = np.zeros(game_config.OBSERVATION_SIZE, dtype=np.float32)  # reused by get_RL_state_array
+
+        self.state_version = 0  # dirty-frame counter, bumped by every update, handle_collisions and restore
+        self._state_arrays = None
+        self.player_colors = read_only(np.array([player.color for player in self.players], dtype=np.uint8))
+        self.color_owners = {player.color: i for i, player in reversed(list(enumerate(self.players)))}
+
+    def snapshot(self):
+        """The complete world as a GameSnapshot: the entity objects alive now with their fields,
+        the pellet pool arrays, the grid contents and the RNG state. No object is copied, so it is
+        cheap enough to take every frame. Any number of restore() calls can start from it."""
+        return GameSnapshot(
+            frame_counter=self.frame_counter,
+            players=[(player.cells[:], list(map(cell_fields, player.cells)), player_fields(player))
+                     for player in self.players],
+            viruses=(self.viruses[:], list(map(virus_fields, self.viruses))),
+            ejected_food=(self.ejected_food[:], list(map(ejected_fields, self.ejected_food))),
+            food=self.food.snapshot(),
+            grid=self.spatial_grid.snapshot(),
+            grid_moving_objects=self.grid_moving_objects.copy(),
+            random_state=random.getstate())
+
+    def restore(self, snapshot):
+        """Puts the world back exactly as it was at snapshot(), the game then goes on
+        the same way it did after the snapshot for the same actions."""
+        self.state_version += 1
+        self.frame_counter = snapshot.frame_counter
+        for player, (cells, values, player_values) in zip(self.players, snapshot.players):
+            player.cells = cells[:]
+            player.cells_changed()
+            (player.split_cooldown, player.mass_eaten_this_frame, player.mass_lost_this_frame,
+             player.mass_ejected_this_frame) = player_values
+            for cell, cell_values in zip(cells, values):
+                (cell.x, cell.y, cell.mass, cell.radius, cell.speed, cell.merge_time,
+                 cell.external_vx, cell.external_vy) = cell_values
+
+        viruses, values = snapshot.viruses
+        self.viruses = viruses[:]
+        for virus, virus_values in zip(viruses, values):
+            (virus.x, virus.y, virus.mass, virus.radius, virus.spikes, virus.vx, virus.vy,
+             virus.last_fed_direction) = virus_values
+        ejected_food, values = snapshot.ejected_food
+        self.ejected_food = ejected_food[:]
+        for ejected, ejected_values in zip(ejected_food, values):
+            ejected.x, ejected.y, ejected.vx, ejected.vy = ejected_values
+
+        self.food.restore(snapshot.food)
+        self.spatial_grid.restore(snapshot.grid)
+        self.grid_moving_objects = snapshot.grid_moving_objects.copy()
+        random.setstate(snapshot.random_state)
+
     def update_spatial_grid(self):
-        self.spatial_grid = SpatialGrid(game_config.SPATIAL_GRID_CELL)
-        for player in self.players:
-            for cell in player.cells:
-                self.spatial_grid.add_object(cell)
-        for food in self.food:
-            self.spatial_grid.add_object(food)
-        for virus in self.viruses:
-            self.spatial_grid.add_object(virus)
-        for ejected in self.ejected_food:
-            self.spatial_grid.add_object(ejected)
+        """Syncs the moving objects with the grid: new ones are inserted, the ones that crossed
+        a grid cell are re-bucketed and the ones gone since last frame are removed."""
+        moving_objects = set(self.viruses)
+        moving_objects.update(self.ejected_food)
+
+        for obj in self.grid_moving_objects - moving_objects:
+            self.spatial_grid.remove_object(obj)
+        for obj in moving_objects:
+            self.spatial_grid.move_object(obj)
+        self.grid_moving_objects = moving_objects
 
     def ejected_food_update(self):
         for ejected in self.ejected_food:
@@ -113,10 +473,12 @@ class Game:
             virus.update()
 
     def update(self, actions):
+        self.state_version += 1
         self.frame_counter = (self.frame_counter + 1) % game_config.FPS
         for player, action in zip(self.players, actions):
-            ejected_food_player = player.update(action)  # Handles self collisions
+            ejected_food_player = player.update(action, self_collisions=False)
             self.ejected_food.extend(ejected_food_player)
+        handle_players_self_collisions(self.players)  # all players at once, vectorized when there are many cells
         
         self.ejected_food_update()
         self.virus_update()
@@ -128,67 +490,137 @@ class Game:
         return reset_player_names
 
     def get_RL_state(self, player_index):
-        obs = []
+        return self.get_RL_state_array(player_index, out=np.zeros(game_config.OBSERVATION_SIZE)).tolist()
+
+    def get_RL_state_array(self, player_index, out=None):
+        """Observation of a player: 16 own cells, 30 other cells (the biggest), 100 food, 10 viruses,
+        each as (x, y, mass) normalized to the view. Written into out (OBSERVATION_SIZE,), by default
+        self.observation, a float32 buffer overwritten by the next call.
+        When the pellets are dense enough (OBSERVATION_PELLETS_PER_GRID_CELL) they are read from the grid
+        buckets under the view instead of testing all of them, so the cost follows what is visible
+        and not the amount of food on the map."""
         player = self.players[player_index]
-        total_size = sum([cell.radius for cell in player.cells])
-        
+        total_size = player.total_size
+
         # Calculate visible area
         view_width = game_config.WIDTH / math.pow(min(64 / total_size, 1), 0.4)
         view_height = game_config.HEIGHT / math.pow(min(64 / total_size, 1), 0.4)
         view_left = player.cells[0].x - view_width / 2
         view_top = player.cells[0].y - view_height / 2
-        
+        view_right = view_left + view_width
+        view_bottom = view_top + view_height
+
         # Player's own cells (max 16)
-        for i in range(16):
-            if i < len(player.cells):
-                cell = player.cells[i]
-                norm_x = (cell.x - view_left) / view_width
-                norm_y = (cell.y - view_top) / view_height
-                obs.extend([norm_x, norm_y,
-                            cell.mass / game_config.MAX_PLAYER_MASS])
-            else:
-                obs.extend([norm_x, norm_y, 0])  # Padding
-        
-        # Other visible cells (max 30)
-        visible_cells = []
-        for i, p in enumerate(self.players):
-            if i != player_index:
-                for cell in p.cells:
-                    if (view_left <= cell.x <= view_left + view_width and
-                        view_top <= cell.y <= view_top + view_height):
-                        visible_cells.append((cell.x, cell.y, cell.mass))
-        
-        visible_cells.sort(key=lambda c: c[2], reverse=True)  # Sort by mass
-        for i in range(30):
-            if i < len(visible_cells):
-                x, y, mass = visible_cells[i]
-                norm_x, norm_y = (x - view_left) / view_width, (y - view_top) / view_height
-                obs.extend([norm_x, norm_y, mass / game_config.MAX_PLAYER_MASS])
-            else:
-                obs.extend([norm_x, norm_y, 0])  # Padding
-        
-        # Food (max 100)
-        visible_food = [f for f in self.food + self.ejected_food if (view_left <= f.x <= view_left + view_width and
-                                                view_top <= f.y <= view_top + view_height)]
-        for i in range(100):
-            if i < len(visible_food):
-                norm_x, norm_y = (visible_food[i].x - view_left) / view_width, (visible_food[i].y - view_top) / view_height
-                obs.extend([norm_x, norm_y, visible_food[i].mass])
-            else:
-                obs.extend([norm_x, norm_y, 0])  # Padding
-        
-        # Viruses (max 10)
-        visible_viruses = [v for v in self.viruses if (view_left <= v.x <= view_left + view_width and
-                                                    view_top <= v.y <= view_top + view_height)]
-        for i in range(10):
-            if i < len(visible_viruses):
-                norm_x, norm_y = (visible_viruses[i].x - view_left) / view_width, (visible_viruses[i].y - view_top) / view_height
-                obs.extend([norm_x, norm_y, visible_viruses[i].mass])
-            else:
-                obs.extend([norm_x, norm_y, 0])  # Padding
-        
-        return obs
+        own = [(cell.x, cell.y, cell.mass / game_config.MAX_PLAYER_MASS) for cell in player.cells]
+
+        # Other visible cells (max 30), the biggest ones in player order for equal masses
+        visible_cells = heapq.nlargest(30, [
+            cell for i, p in enumerate(self.players) if i != player_index
+            for cell in p.cells if view_left <= cell.x <= view_right and view_top <= cell.y <= view_bottom],
+            key=by_mass)
+        visible_cells = [(cell.x, cell.y, cell.mass / game_config.MAX_PLAYER_MASS) for cell in visible_cells]
+
+        # Food (max 100), the first visible pellets in pool order and then ejected food
+        cell_size = self.spatial_grid.cell_size
+        first_x, last_x = max(0, int(view_left // cell_size)), min(int(view_right // cell_size), game_config.GAME_WIDTH // cell_size)
+        first_y, last_y = max(0, int(view_top // cell_size)), min(int(view_bottom // cell_size), game_config.GAME_HEIGHT // cell_size)
+        view_cells = (last_x - first_x + 1) * (last_y - first_y + 1)
+        if view_cells * game_config.OBSERVATION_PELLETS_PER_GRID_CELL < len(self.food):
+            nearby_objects = self.spatial_grid.get_objects_in_range(first_x, last_x, first_y, last_y)
+            pellets = np.fromiter([obj.index for obj in nearby_objects if isinstance(obj, Pellet)], dtype=np.int64)
+            pellet_x, pellet_y = self.food.x[pellets], self.food.y[pellets]
+        else:  # one vectorized test of every pellet is cheaper than the bucket lookups
+            pellets = None
+            pellet_x, pellet_y = self.food.x, self.food.y
+        visible = np.flatnonzero((view_left <= pellet_x) & (pellet_x <= view_right) &
+                                 (view_top <= pellet_y) & (pellet_y <= view_bottom))
+        pellets = visible if pellets is None else pellets[visible]
+        if len(pellets) > 100:
+            pellets = np.partition(pellets, 99)[:100]
+        pellets.sort()
+        visible_food = np.empty((len(pellets), 3))
+        visible_food[:, 0], visible_food[:, 1], visible_food[:, 2] = self.food.x[pellets], self.food.y[pellets], self.food.mass
+        if len(visible_food) < 100:
+            visible_ejected = [(f.x, f.y, f.mass) for f in self.ejected_food
+                               if view_left <= f.x <= view_right and view_top <= f.y <= view_bottom]
+            if visible_ejected:
+                visible_food = np.concatenate((visible_food, visible_ejected))
 
+        # Viruses (max 10)
+        visible_viruses = [(v.x, v.y, v.mass) for v in self.viruses
+                           if view_left <= v.x <= view_right and view_top <= v.y <= view_bottom]
+
+        if out is None:
+            out = self.observation
+        return fill_observation(out, ((own, 16), (visible_cells, 30), (visible_food, 100), (visible_viruses, 10)),
+                                view_left, view_top, view_width, view_height)
+
+    def get_RL_states(self, player_indices, out=None):
+        """get_RL_state_array of several players, as the rows of out (len(player_indices), OBSERVATION_SIZE),
+        by default a new float32 array. From VECTORIZED_OBSERVATIONS_MIN_AGENTS players on, all the entities
+        are gathered into one array and tested against all the views at once, and the observations are
+        built together without a loop per player."""
+        if out is None:
+            out = np.zeros((len(player_indices), game_config.OBSERVATION_SIZE), dtype=np.float32)
+        if len(player_indices) < game_config.VECTORIZED_OBSERVATIONS_MIN_AGENTS:
+            for row, player_index in zip(out, player_indices):
+                self.get_RL_state_array(player_index, out=row)
+            return out
+
+        # Calculate visible areas, shape (agents, 1) to broadcast against the entities
+        views = []
+        for player_index in player_indices:
+            player = self.players[player_index]
+            total_size = player.total_size
+            view_width = game_config.WIDTH / math.pow(min(64 / total_size, 1), 0.4)
+            view_height = game_config.HEIGHT / math.pow(min(64 / total_size, 1), 0.4)
+            views.append((player.cells[0].x - view_width / 2, player.cells[0].y - view_height / 2, view_width, view_height))
+        view_left, view_top, view_width, view_height = np.array(views).T[:, :, None]
+        view_right, view_bottom = view_left + view_width, view_top + view_height
+
+        # Every entity as an (x, y, mass) row of one table, the blocks pick rows of it
+        cells = [cell for player in self.players for cell in player.cells]
+        owners = np.repeat(np.arange(len(self.players)), [len(player.cells) for player in self.players])
+        table = np.concatenate((
+            np.array([(cell.x, cell.y, cell.mass / game_config.MAX_PLAYER_MASS) for cell in cells]),
+            np.column_stack((self.food.x, self.food.y, np.full(len(self.food), self.food.mass))),
+            np.array([(f.x, f.y, f.mass) for f in self.ejected_food]).reshape(-1, 3),
+            np.array([(v.x, v.y, v.mass) for v in self.viruses]).reshape(-1, 3)))
+        pellets_start = len(cells)
+        ejected_start = pellets_start + len(self.food)
+        viruses_start = ejected_start + len(self.ejected_food)
+        visible = (view_left <= table[:, 0]) & (table[:, 0] <= view_right) & (view_top <= table[:, 1]) & (table[:, 1] <= view_bottom)
+        agents = np.array(player_indices)[:, None]
+
+        # source[k, r] is the table row of row r of observation k, -1 for padding
+        source = np.full((len(player_indices), 16 + 30 + 100 + 10), -1)
+        rows, columns, ranks = first_true(owners == agents, 16)
+        source[rows, ranks] = columns
+        by_size = np.argsort(-table[:pellets_start, 2], kind='stable')  # ties stay in player order
+        rows, columns, ranks = first_true(visible[:, by_size] & (owners[by_size] != agents), 30)
+        source[rows, 16 + ranks] = by_size[columns]
+        rows, columns, ranks = first_true(visible[:, pellets_start:ejected_start], 100)
+        source[rows, 46 + ranks] = pellets_start + columns
+        pellet_counts = np.bincount(rows, minlength=len(player_indices))
+        rows, columns, ranks = first_true(visible[:, ejected_start:viruses_start], 100)
+        ranks += pellet_counts[rows]  # ejected food goes after the pellets
+        keep = ranks < 100
+        source[rows[keep], 46 + ranks[keep]] = ejected_start + columns[keep]
+        rows, columns, ranks = first_true(visible[:, viruses_start:], 10)
+        source[rows, 146 + ranks] = viruses_start + columns
+
+        # Padding rows repeat the last written row, with mass 0
+        written = source >= 0
+        last_written = np.where(written, np.arange(source.shape[1]), 0)
+        np.maximum.accumulate(last_written, axis=1, out=last_written)
+        rows = table[np.take_along_axis(source, last_written, axis=1)]
+        rows[~written, 2] = 0
+
+        obs = out.reshape(len(player_indices), -1, 3)
+        obs[..., 0] = (rows[..., 0] - view_left) / view_width
+        obs[..., 1] = (rows[..., 1] - view_top) / view_height
+        obs[..., 2] = rows[..., 2]
+        return out
 
     def get_state(self):
         return {
@@ -197,17 +629,51 @@ class Game:
             'viruses': [v.get_state() for v in self.viruses],
             'ejected_food': [e.get_state() for e in self.ejected_food]
         }
+
+    def get_state_arrays(self):
+        """The same content as get_state() as a StateArrays of read-only NumPy arrays, without a dict per entity.
+        Pellets are views of the pellet pool, the other types take one array per column.
+        The export is cached until state_version changes: a consumer can compare the version with the one
+        it last drew or saved to skip unchanged frames. The views are only valid until the next update,
+        copy them to keep a frame."""
+        if self._state_arrays is not None and self._state_arrays.version == self.state_version:
+            return self._state_arrays
+
+        players = self.players
+        aggregates = np.array([(*player.centroid, player.total_size, player.total_mass) for player in players],
+                              dtype=float).reshape(-1, 4)
+        x, y, total_size, total_mass = read_only(*aggregates.T.copy())
+        player_arrays = PlayerArrays(tuple(player.name for player in players), self.player_colors,
+                                     x, y, total_size, total_mass)
+
+        owners = np.repeat(np.arange(len(players)), [len(player.cells) for player in players])
+        cells = entity_arrays([cell for player in players for cell in player.cells], owners, self.player_colors)
+
+        n = len(self.food)
+        food = EntityArrays(read_only(self.food.x), read_only(self.food.y),
+                            np.broadcast_to(self.food.radius, n), np.broadcast_to(float(self.food.mass), n),
+                            read_only(self.food.colors), read_only(PelletPool.palette.view()))
+
+        viruses = entity_arrays(self.viruses, np.zeros(len(self.viruses), dtype=np.intp),
+                                read_only(np.array([Virus.color], dtype=np.uint8)))
+        ejected_food = entity_arrays(self.ejected_food, np.array([self.color_owners[e.color] for e in self.ejected_food],
+                                                                 dtype=np.intp), self.player_colors)
+
+        self._state_arrays = StateArrays(self.state_version, player_arrays, cells, food, viruses, ejected_food)
+        return self._state_arrays
     
     def generate_food(self, amount):
-        return [Pellet(random.randint(0, game_config.GAME_WIDTH),
-                    random.randint(0, game_config.GAME_HEIGHT),
-                    (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)), game_config.PELLET_MASS)
-            for _ in range(amount)]
+        """Revives amount pellets from the pool and puts them in the grid"""
+        for _ in range(amount):
+            pellet = self.food.spawn(random.randint(0, game_config.GAME_WIDTH),
+                                     random.randint(0, game_config.GAME_HEIGHT),
+                                     random.randrange(len(PELLET_PALETTE)))
+            self.spatial_grid.add_object(pellet)
     
     def spawn_food(self):
         if len(self.food) < game_config.MAX_FOOD_COUNT:
             new_food_count = min(game_config.FOOD_SPAWN_RATE, game_config.MAX_FOOD_COUNT - len(self.food))
-            self.food.extend(self.generate_food(new_food_count))
+            self.generate_food(new_food_count)
 
     def generate_viruses(self, amount):
         return [Virus(random.randint(0, game_config.GAME_WIDTH),
@@ -218,13 +684,40 @@ class Game:
             new_viruses_count = min(game_config.VIRUS_SPAWN_RATE, game_config.MAX_VIRUS_COUNT_GENERATED - len(self.viruses))
             self.viruses.extend(self.generate_viruses(new_viruses_count))
 
+    def collision_candidates(self, nearby_objects, eaten):
+        """Splits the grid candidates of a cell by type, dropping what was already eaten this frame.
+        Each group is sorted the way the entity lists are ordered (creation order), so objects
+        are eaten in the same order as when scanning the full lists.
+        Pellets are eaten as one batch, their order doesn't matter."""
+        food, ejected, viruses = [], [], []
+        for obj in nearby_objects:
+            if obj in eaten:
+                continue
+            if isinstance(obj, Pellet):
+                food.append(obj)
+            elif isinstance(obj, ThrownPellet):
+                ejected.append(obj)
+            else:
+                viruses.append(obj)
+        ejected.sort(key=by_uid)
+        viruses.sort(key=by_uid)
+        return food, ejected, viruses
+
     def handle_collisions(self):
+        self.state_version += 1
         self.update_spatial_grid()
+        self.sweep_and_prune.update(self.players)
         reset_players = set()
+        player_index = {player.name: i for i, player in enumerate(self.players)}
+
+        # Everything eaten this frame. The entity lists are only compacted once, at the end.
+        eaten = set()
 
         for virus in self.viruses:
             nearby_objects = self.spatial_grid.get_nearby_objects(virus, range_cells=game_config.VIRUS_CELL_RANGE)
-            self.ejected_food = [e for e in self.ejected_food if not (e in nearby_objects and virus.eat(e))]
+            for e in sorted((o for o in nearby_objects if isinstance(o, ThrownPellet) and o not in eaten), key=by_uid):
+                if virus.eat(e):
+                    eaten.add(e)
         
         for i, player in enumerate(self.players):
             if player.name in reset_players:
@@ -233,31 +726,58 @@ class Game:
             for cell in player.cells:
                 range_cells = max(1, int(cell.radius // game_config.SPATIAL_GRID_CELL) + 1)
                 nearby_objects = self.spatial_grid.get_nearby_objects(cell, range_cells=range_cells)
+                food, ejected, viruses = self.collision_candidates(nearby_objects, eaten)
 
-
-                # Check for food collisions
-                self.food = [f for f in self.food if not (f in nearby_objects and player.eat(f, cell=cell))]
+                # Check for food collisions, all candidates in one pass
+                if food:
+                    eaten_food, _ = player.eat_pellets([f.x for f in food], [f.y for f in food], cells=[cell])
+                    eaten.update(food[k] for k in eaten_food)
 
                 # Ejected food can be eaten by players
-                self.ejected_food = [e for e in self.ejected_food if not (e in nearby_objects and player.eat(e, cell=cell))]
+                for e in ejected:
+                    if player.eat(e, cell=cell):
+                        eaten.add(e)
             
                 # Check for virus collisions
-                self.viruses = [v for v in self.viruses if not (v in nearby_objects and player.eat(v, virus=True, cell=cell))]
+                for v in viruses:
+                    if player.eat(v, virus=True, cell=cell):
+                        eaten.add(v)
 
                 # Check for player collisions
-                for j, other_player in enumerate(self.players):
-                    if i != j and other_player.name not in reset_players:
-                        for other_cell in other_player.cells[:]:  # Iterate over a copy to avoid issues with modification
-                            if other_cell in nearby_objects and player.eat(other_cell, cell=cell):
-
-                                other_player.mass_lost_this_frame += other_cell.mass
-                                other_player.cells.remove(other_cell)
-                                if len(other_player.cells) == 0:
-                                    # Don't check that player anymore and schedule for resetting
-                                    reset_players.add(other_player.name)
+                for other_cell in self.sweep_and_prune.candidates(cell, range_cells, eaten, player_index):
+                    j = player_index[other_cell.name]
+                    other_player = self.players[j]
+                    if i != j and other_player.name not in reset_players and other_cell not in eaten:
+                        if player.eat(other_cell, cell=cell):
+                            eaten.add(other_cell)
+                            other_player.mass_lost_this_frame += other_cell.mass
+                            other_player.cells.remove(other_cell)
+                            other_player.cells_changed()
+                            if len(other_player.cells) == 0:
+                                # Don't check that player anymore and schedule for resetting
+                                reset_players.add(other_player.name)
+
+        if eaten:
+            # in creation order, so the pool's slot order doesn't depend on the order of the grid buckets
+            for obj in sorted((obj for obj in eaten if isinstance(obj, Pellet)), key=by_uid):
+                self.spatial_grid.remove_object(obj)
+                self.food.remove(obj)  # back to the pool's free slots
+            self.ejected_food = [e for e in self.ejected_food if e not in eaten]
+            self.viruses = [v for v in self.viruses if v not in eaten]
 
         for player in self.players:
             if len(player.cells) == 0:
                 player.reset()
         return reset_players
-    
\ No newline at end of file
+    
+
+def create_game(player_names, non_dummy_players, engine=None):
+    """Builds a world with the requested engine, defaulting to game_config.ENGINE.
+    Both engines expose update(actions), get_state(), get_state_arrays(), get_RL_state(i), handle_collisions() and players."""
+    engine = engine or game_config.ENGINE
+    if engine == "objects":
+        return Game(player_names, non_dummy_players)
+    if engine == "arrays":
+        from core.array_game import ArrayGame  # imports this module
+        return ArrayGame(player_names, non_dummy_players)
+    raise Exception(f"Engine {engine} not supported")
@@ -1,12 +1,158 @@
 import math
 import config
 import random
+import itertools
+import numpy as np
+from operator import attrgetter
 from core.food import ThrownPellet
 
 game_config = config.GameConfig()
 
+uids = itertools.count()  # creation order, a player's cell list is always sorted by it
+by_radius = attrgetter('radius')
+
+
+def covered_mask(cells_x, cells_y, cells_radius, cells_mass, xs, ys, radius, mass):
+    """Vectorized Cell.can_eat and Cell.intersects_with of k cells against m objects sharing
+    one radius and mass (pellets, ejected food). Returns a (k, m) bool matrix."""
+    cells_radius = np.asarray(cells_radius, dtype=float)[:, None]
+    reach = cells_radius - radius * game_config.CLOSENESS_FACTOR
+    distance_sq = ((np.asarray(xs)[None, :] - np.asarray(cells_x, dtype=float)[:, None])**2 +
+                   (np.asarray(ys)[None, :] - np.asarray(cells_y, dtype=float)[:, None])**2)
+    return ((np.asarray(cells_mass, dtype=float)[:, None] > mass * game_config.MASS_FACTOR_EAT_ANOTHER) &
+            (cells_radius >= radius) & (distance_sq < reach**2))
+
+def resolve_self_collisions(x, y, mass, radius, merge_time, alive):
+    """Vectorized Player.handle_self_collisions for the cells of one or many players.
+    All arguments are (..., n) arrays, one row of n cell slots per player, alive marks the used slots.
+
+    Every pair is tested on the positions at the start of the call. Touching pairs that can both merge
+    merge if one covers the other, pairs in order of (first cell, second cell) with the first cell
+    absorbing the second, and a cell that was absorbed doesn't absorb anything after. The other
+    touching pairs are pushed apart by half their overlap each, all pushes on a cell add up.
+    Returns the x and y displacements, the absorbed mask and the mass gained by each cell."""
+    x = np.where(alive, x, np.nan)  # nothing touches an unused slot
+    dx = x[..., None, :] - x[..., :, None]  # [i, j] is from cell i to cell j
+    dy = y[..., None, :] - y[..., :, None]
+    distance = np.hypot(dx, dy)
+    radius_i, radius_j = radius[..., :, None], radius[..., None, :]
+    smaller = np.minimum(radius_i, radius_j)
+    touching_distance = radius_i + radius_j - smaller*0.05
+    touching = distance < touching_distance
+
+    absorbed = np.zeros(x.shape, dtype=bool)
+    gained = np.zeros(x.shape)
+    can_merge = alive & (merge_time == 0)
+    if (can_merge.sum(axis=-1) > 1).any():
+        both_can_merge = can_merge[..., :, None] & can_merge[..., None, :]
+        touching &= ~both_can_merge  # pairs that can merge are never pushed
+        n = x.shape[-1]
+        covered = distance < np.maximum(radius_i, radius_j) - smaller * game_config.CLOSENESS_FACTOR
+        for index in np.argwhere(both_can_merge & covered & np.triu(np.ones((n, n), dtype=bool), 1)).tolist():
+            *row, i, j = index
+            row = tuple(row)
+            if not absorbed[row + (i,)] and not absorbed[row + (j,)]:
+                absorbed[row + (j,)] = True
+                gained[row + (i,)] += mass[row + (j,)]
+        if absorbed.any():
+            touching &= ~absorbed[..., :, None] & ~absorbed[..., None, :]
+
+    # Push cells apart, the pair masks are symmetric so each cell moves away from every cell it touches
+    pushed = touching & (distance > 0)
+    scale = np.divide(touching_distance - distance, 2 * distance, out=np.zeros_like(distance), where=pushed)
+    shift_x = -np.multiply(dx, scale, out=np.zeros_like(dx), where=pushed).sum(axis=-1)
+    shift_y = -np.multiply(dy, scale, out=np.zeros_like(dy), where=pushed).sum(axis=-1)
+    return shift_x, shift_y, absorbed, gained
+
+def self_collisions_loop(cells):
+    """Plain Python resolve_self_collisions for one player's Cell list, faster for a handful of cells.
+    Returns the same four results as lists, or None when no two cells touch."""
+    n = len(cells)
+    absorbed = [False] * n
+    gained = [0.0] * n
+    touching_pairs = []
+    for i in range(n):
+        cell1 = cells[i]
+        x1, y1, radius1 = cell1.x, cell1.y, cell1.radius
+        for j in range(i + 1, n):
+            cell2 = cells[j]
+            dx = cell2.x - x1
+            dy = cell2.y - y1
+            reach = radius1 + cell2.radius
+            if dx*dx + dy*dy >= reach*reach:
+                continue  # too far apart to touch
+            distance = math.sqrt(dx*dx + dy*dy)
+            smaller = min(radius1, cell2.radius)
+            touching_distance = reach - smaller*0.05
+            if distance < touching_distance:
+                if cell1.merge_time == 0 and cell2.merge_time == 0:
+                    covered = distance < max(radius1, cell2.radius) - smaller * game_config.CLOSENESS_FACTOR
+                    if covered and not absorbed[i] and not absorbed[j]:
+                        absorbed[j] = True
+                        gained[i] += cell2.mass
+                elif distance > 0:
+                    touching_pairs.append((i, j, dx, dy, (touching_distance - distance) / (2 * distance)))
+    if not touching_pairs and not any(absorbed):
+        return None
+
+    # Push cells apart
+    shift_x, shift_y = [0.0] * n, [0.0] * n
+    for i, j, dx, dy, scale in touching_pairs:
+        if not absorbed[i] and not absorbed[j]:
+            shift_x[i] -= dx * scale
+            shift_y[i] -= dy * scale
+            shift_x[j] += dx * scale
+            shift_y[j] += dy * scale
+    return shift_x, shift_y, absorbed, gained
+
+def handle_players_self_collisions(players):
+    """Player.handle_self_collisions of many players. From VECTORIZED_SELF_COLLISION_MIN_PAIRS
+    cell pairs on they share a single resolve_self_collisions call, one row per player,
+    below that each one uses self_collisions_loop."""
+    batched = [player for player in players if len(player.cells) > 1]
+    pairs = sum(len(player.cells) * (len(player.cells) - 1) // 2 for player in batched)
+    if pairs < game_config.VECTORIZED_SELF_COLLISION_MIN_PAIRS:
+        for player in batched:
+            result = self_collisions_loop(player.cells)
+            if result is not None:
+                apply_self_collisions(player.cells, *result)
+                player.cells_changed()
+        return
+
+    counts = np.array([len(player.cells) for player in batched])
+    rows = np.repeat(np.arange(len(batched)), counts)
+    slots = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    fields = np.zeros((len(batched), counts.max(), 5))
+    fields[rows, slots] = [(cell.x, cell.y, cell.mass, cell.radius, cell.merge_time)
+                           for player in batched for cell in player.cells]
+    alive = np.zeros(fields.shape[:2], dtype=bool)
+    alive[rows, slots] = True
+
+    shift_x, shift_y, absorbed, gained = resolve_self_collisions(
+        fields[..., 0], fields[..., 1], fields[..., 2], fields[..., 3], fields[..., 4], alive)
+    shift_x, shift_y, absorbed, gained = shift_x.tolist(), shift_y.tolist(), absorbed.tolist(), gained.tolist()
+    for row, player in enumerate(batched):
+        apply_self_collisions(player.cells, shift_x[row], shift_y[row], absorbed[row], gained[row])
+        player.cells_changed()
+
+def apply_self_collisions(cells, shift_x, shift_y, absorbed, gained):
+    """Moves, grows and removes the cells of one player, the lists can be longer than cells"""
+    for cell, cell_shift_x, cell_shift_y, cell_gained in zip(cells, shift_x, shift_y, gained):
+        cell.x += cell_shift_x
+        cell.y += cell_shift_y
+        if cell_gained:
+            # Merge cells
+            cell.mass += cell_gained
+            cell.radius = game_config.RADIUS_FROM_MASS(cell.mass)
+            cell.speed = game_config.SPEED_FROM_RADIUS(cell.radius)
+    if any(absorbed):
+        cells[:] = [cell for cell, cell_absorbed in zip(cells, absorbed) if not cell_absorbed]
+
 class Cell:
+    __slots__ = ('uid', 'x', 'y', 'color', 'name', 'mass', 'radius', 'speed', 'merge_time', 'external_vx', 'external_vy')
+
     def __init__(self, x, y, color, name, mass, vx=0, vy=0):
+        self.uid = next(uids)
         self.x = x
         self.y = y
         self.color = color
@@ -166,6 +312,8 @@ class Player:
         self.color = color
         self.cells = [Cell(x, y, color, name, mass)]
         self.split_cooldown = 0
+        self._total_mass = None  # cached aggregates, see aggregates()
+        self._aggregates = None
 
         # These parameters don't take in account the pssive mass loss.
         self.mass_eaten_this_frame = 0
@@ -175,12 +323,58 @@ class Player:
     def reset(self):
         """Use this function to respawn the player"""
         self.cells = [Cell(random.randint(0, game_config.GAME_WIDTH), random.randint(0, game_config.GAME_HEIGHT), self.color, self.name, game_config.INITIAL_PLAYER_MASS)]
+        self.cells_changed()
+
+    def cells_changed(self):
+        """Drops the cached aggregates. The Player methods call it themselves, code that changes
+        the cells list or the position or mass of a cell from outside has to call it too."""
+        self._total_mass = None
+        self._aggregates = None
+
+    def aggregates(self):
+        """(total_mass, total_size, centroid, biggest_cell), computed in one pass over the cells
+        the first time they are asked for after the cells changed, so every reader of a frame shares it.
+        The sums are the same as the ones of get_state, so the values are identical."""
+        if self._aggregates is None:
+            cells = self.cells
+            total_mass = self.total_mass
+            center_x = 0
+            center_y = 0
+            for cell in cells:
+                center_x += cell.x * cell.mass
+                center_y += cell.y * cell.mass
+            self._aggregates = (total_mass, sum([cell.radius for cell in cells]),
+                                (center_x/total_mass, center_y/total_mass), max(cells, key=by_radius))
+        return self._aggregates
+
+    @property
+    def total_mass(self):
+        """Cached on its own, regulate_cell_masses needs it after every meal"""
+        if self._total_mass is None:
+            self._total_mass = sum([cell.mass for cell in self.cells])
+        return self._total_mass
+
+    @property
+    def total_size(self):
+        """Sum of the radii of the cells, sets the size of the view"""
+        return self.aggregates()[1]
+
+    @property
+    def centroid(self):
+        """Mass weighted average position of the cells, as (x, y)"""
+        return self.aggregates()[2]
+
+    @property
+    def biggest_cell(self):
+        """The cell with the largest radius, the first one on ties"""
+        return self.aggregates()[3]
 
     def move(self, px, py):
         """Move the player's cells towards the point px, py,
         """
         for cell in self.cells:
             cell.move(px, py)
+        self.cells_changed()
 
     def eat(self, other, virus=False, cell=None):
         """Attempt to eat another object (food or player cell). If virus, explode if eaten."""
@@ -188,6 +382,7 @@ class Player:
         if cell is not None:
             if cell.can_eat(other) and cell.intersects_with(other):
                 cell.grow(other.mass)
+                self.cells_changed()
                 self.regulate_cell_masses()
                 if virus:
                     self.explode_cell(cell)
@@ -199,6 +394,7 @@ class Player:
         for cell in self.cells:
             if cell.can_eat(other) and cell.intersects_with(other):
                 cell.grow(other.mass)
+                self.cells_changed()
                 self.regulate_cell_masses()
                 if virus:
                     self.explode_cell(cell)
@@ -207,9 +403,45 @@ class Player:
                 return True
         return False
     
+    def eat_pellets(self, xs, ys, mass=game_config.PELLET_MASS, cells=None):
+        """Batched eat for pellets of one mass, given their coordinates as arrays.
+        Every pellet goes to the first of the cells (default: all of them) covering it,
+        each cell grows once and the masses are regulated once.
+        Returns the list of indices of the eaten pellets and the total mass gained."""
+        cells = self.cells if cells is None else cells
+        radius = game_config.RADIUS_FROM_MASS(mass)
+        if len(xs) >= game_config.VECTORIZED_EAT_MIN_PELLETS:
+            covered = covered_mask([cell.x for cell in cells], [cell.y for cell in cells],
+                                   [cell.radius for cell in cells], [cell.mass for cell in cells],
+                                   xs, ys, radius, mass)
+            eaten = np.flatnonzero(covered.any(axis=0)).tolist()
+            eaten_by = covered[:, eaten].argmax(axis=0).tolist()  # first covering cell
+        else:
+            # Same test in plain Python, NumPy call overhead dominates for a handful of pellets
+            eaten, eaten_by = [], []
+            for i, (x, y) in enumerate(zip(xs, ys)):
+                for k, cell in enumerate(cells):
+                    if (cell.mass > mass * game_config.MASS_FACTOR_EAT_ANOTHER and cell.radius >= radius and
+                            (cell.x - x)**2 + (cell.y - y)**2 < (cell.radius - radius * game_config.CLOSENESS_FACTOR)**2):
+                        eaten.append(i)
+                        eaten_by.append(k)
+                        break
+        if not eaten:
+            return eaten, 0
+
+        for k in set(eaten_by):
+            cells[k].grow(eaten_by.count(k) * mass)
+        self.cells_changed()
+        self.regulate_cell_masses()
+
+        mass_gained = len(eaten) * mass
+        self.mass_eaten_this_frame += mass_gained
+        return eaten, mass_gained
+
     def explode_cell(self, cell):
         new_cells = cell.explode(max_new_cells=game_config.MAX_AMOUNT_CELLS - len(self.cells))
         self.cells.extend(new_cells)
+        self.cells_changed()
         if new_cells:
             self.split_cooldown = game_config.SPLIT_COOLDOWN
     
@@ -217,7 +449,7 @@ class Player:
         """Regulates masses so that the total mass doesn't exceed the maximum.
         Modifies cells masses, so it is crucial that we call cell.update_radius_and_speed().
         """
-        total_mass = sum([cell.mass for cell in self.cells])
+        total_mass = self.total_mass
         if total_mass > game_config.MAX_PLAYER_MASS:
             mass_to_regulate = total_mass - game_config.MIN_PLAYER_MASS * len(self.cells)
             mass_goal = game_config.MAX_PLAYER_MASS - game_config.MIN_PLAYER_MASS * len(self.cells)
@@ -226,30 +458,21 @@ class Player:
             for cell in self.cells:
                 cell.mass = game_config.MIN_PLAYER_MASS + (cell.mass - game_config.MIN_PLAYER_MASS) * mass_goal/mass_to_regulate
                 cell.update_radius_speed_merge(reset_merge=False)
+            self.cells_changed()
             return True
         return False
 
 
     def get_state(self):
         """Return the current state of the player."""
-        cell_states = [cell.get_state() for cell in self.cells]
-        # weighted average
-        center_x = 0
-        center_y = 0
-        for cell in cell_states:
-            center_x += cell["x"] * cell["mass"]
-            center_y += cell["y"] * cell["mass"]
-
-        total_mass = sum([cell['mass'] for cell in cell_states])
-        # print("Player.py line 202: MASS:", total_mass)
-        center_x, center_y = center_x/total_mass, center_y/total_mass
+        total_mass, total_size, (center_x, center_y), _ = self.aggregates()
         return {
             "name": self.name,
-            "total_size": sum([cell['radius'] for cell in cell_states]),
-            "total_mass": sum([cell['mass'] for cell in cell_states]),
+            "total_size": total_size,
+            "total_mass": total_mass,
             "x": center_x,
             "y": center_y,
-            "cells": cell_states
+            "cells": [cell.get_state() for cell in self.cells]
         }
     
     def try_split(self, px, py):
@@ -267,6 +490,7 @@ class Player:
         self.cells.extend(new_cells)
         if new_cells:
             self.split_cooldown = game_config.SPLIT_COOLDOWN
+            self.cells_changed()
 
     def eject_food(self, px, py):
         ejected_cells = []
@@ -274,34 +498,15 @@ class Player:
             thrown_pellet = cell.eject_food(px, py)
             if thrown_pellet is not None:
                 ejected_cells.append(thrown_pellet)
+        self.cells_changed()
         return ejected_cells
 
     def handle_self_collisions(self):
-        for i, cell1 in enumerate(self.cells):
-            for cell2 in self.cells[i+1:]:
-                dx = cell2.x - cell1.x
-                dy = cell2.y - cell1.y
-                distance = math.sqrt(dx**2 + dy**2)
-                touching_distance = cell1.radius + cell2.radius - min(cell1.radius, cell2.radius)*0.05
-                if distance < touching_distance:
-                    if cell1.merge_time == 0 and cell2.merge_time == 0: 
-                        if (cell1.intersects_with(cell2) or cell2.intersects_with(cell1)):
-                            # Merge cells
-                            cell1.mass += cell2.mass
-                            cell1.radius = game_config.RADIUS_FROM_MASS(cell1.mass)
-                            cell1.speed = game_config.SPEED_FROM_RADIUS(cell1.radius)
-                            self.cells.remove(cell2)
-                    else:
-                        # Push cells apart
-                        if distance > 0:
-                            overlap = touching_distance - distance
-                            angle = math.atan2(dy, dx)
-                            cell1.x -= math.cos(angle) * overlap / 2
-                            cell1.y -= math.sin(angle) * overlap / 2
-                            cell2.x += math.cos(angle) * overlap / 2
-                            cell2.y += math.sin(angle) * overlap / 2
-
-    def update(self, action):
+        """Merges and pushes apart the player's own cells, see resolve_self_collisions"""
+        handle_players_self_collisions([self])
+
+    def update(self, action, self_collisions=True):
+        """self_collisions=False when the caller resolves them for all players at once"""
         self.mass_eaten_this_frame = 0
         self.mass_lost_this_frame = 0
         self.mass_ejected_this_frame = 0
@@ -321,7 +526,8 @@ class Player:
 
         self.split_cooldown = max(0, self.split_cooldown - 1/game_config.FPS)
         self.move(px, py)
-        self.handle_self_collisions()
+        if self_collisions:
+            self.handle_self_collisions()
         return ejected_food
     
     def reward_after_update(self):
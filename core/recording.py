@@ -0,0 +1,315 @@
+import json
+import os
+from collections import namedtuple
+import numpy as np
+import config
+from core.food import PELLET_RADIUS, EJECTED_RADIUS, PELLET_PALETTE
+from core.game import StateArrays, PlayerArrays, EntityArrays, read_only
+
+game_config = config.GameConfig()
+
+"""
+Trajectory recordings: the frames of a game as entity arrays, in memory-mapped files.
+
+A recording is a directory with
+    meta.json   player names and colors, keyframe interval, number of frames (written from the first keyframe on)
+    data.bin    one record per frame, only ever appended to
+    index.bin   (frames, 3) int64: byte offset and size of each record, frame of its keyframe
+
+A record is a RECORD_HEADER followed by the actions, the players, the cells, the viruses,
+the ejected food and the food, each as a packed structured array. Every field but the food is
+written every frame. The food is written in full every keyframe_interval frames (a keyframe),
+the other frames only hold the pellets removed and added since the previous frame.
+Food is kept in a canonical order (sorted by x, y, color), the order of the engines' pools is not recorded.
+In memory it is a pair of arrays: a uint64 key holding the float32 bits of x and y, and the colors.
+
+Reading a frame is an index lookup plus at most keyframe_interval - 1 food deltas, so seeking
+costs the same anywhere in the file. The blocks are read-only views of the memory map:
+scanning a 50000 frame recording only pages in the bytes that are looked at.
+The recorder writes meta.json at every keyframe and a frame's index row after its record, so a
+recording that was never closed (crash, Ctrl-C) still opens with every frame written.
+"""
+
+RECORD_HEADER = np.dtype([('frame', '<i8'), ('keyframe', 'u1'), ('cells', '<i4'), ('viruses', '<i4'),
+                          ('ejected_food', '<i4'), ('food', '<i4'), ('food_added', '<i4')])
+ACTION = np.dtype([('x', '<f4'), ('y', '<f4'), ('split', 'u1'), ('feed', 'u1')])
+PLAYER = np.dtype([('x', '<f4'), ('y', '<f4'), ('total_size', '<f4'), ('total_mass', '<f4')])
+CELL = np.dtype([('x', '<f4'), ('y', '<f4'), ('radius', '<f4'), ('mass', '<f4'), ('owner', '<u2')])
+VIRUS = np.dtype([('x', '<f4'), ('y', '<f4'), ('radius', '<f4'), ('mass', '<f4')])
+EJECTED = np.dtype([('x', '<f4'), ('y', '<f4'), ('color', 'u1', (3,))])
+FOOD = np.dtype([('x', '<f4'), ('y', '<f4'), ('color', 'u1')])
+
+PLAYER_SERIES_CHUNK = 1024  # frames read at once by Recording.player_series
+
+RecordedFrame = namedtuple("RecordedFrame", ["frame", "actions", "players", "cells", "viruses", "ejected_food", "food"])
+
+
+def food_keys(x, y):
+    """uint64 sort key of pellet positions, from the float32 bits of x and y"""
+    x = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    return (x << np.uint64(32)) | np.ascontiguousarray(y, dtype=np.float32).view(np.uint32)
+
+def food_rows(keys, colors):
+    """FOOD rows of (keys, colors)"""
+    rows = np.zeros(len(keys), dtype=FOOD)
+    rows['x'] = (keys >> np.uint64(32)).astype(np.uint32).view(np.float32)
+    rows['y'] = (keys & np.uint64(0xffffffff)).astype(np.uint32).view(np.float32)
+    rows['color'] = colors
+    return rows
+
+def rows_food(rows):
+    """(keys, colors) of FOOD rows"""
+    return food_keys(rows['x'], rows['y']), np.ascontiguousarray(rows['color'])
+
+def canonical_order(keys, colors):
+    """Same as np.lexsort((colors, keys)), but much faster on inputs made of a few sorted runs"""
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    same_spot = sorted_keys[1:] == sorted_keys[:-1]
+    if same_spot.any():
+        # then by color within each spot: the spot's rank dominates the composite key
+        spot = np.concatenate(([0], np.cumsum(~same_spot)))
+        order = order[np.argsort(spot * 256 + colors[order], kind='stable')]
+    return order
+
+def food_counts(blocks, signs):
+    """Multiset sum of (keys, colors) blocks, each counted with its sign.
+    Returns the distinct pellets in canonical order and their counts."""
+    keys = np.concatenate([block[0] for block in blocks])
+    colors = np.concatenate([block[1] for block in blocks])
+    weights = np.repeat(np.asarray(signs, dtype=np.int64), [len(block[0]) for block in blocks])
+    order = canonical_order(keys, colors)
+    keys, colors, weights = keys[order], colors[order], weights[order]
+    if not len(keys):
+        return keys, colors, weights
+    starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (colors[1:] != colors[:-1]))))
+    return keys[starts], colors[starts], np.add.reduceat(weights, starts)
+
+def food_delta(previous, food):
+    """(removed, added) pellets between two canonical (keys, colors) food arrays"""
+    keys, colors, counts = food_counts([previous, food], [-1, 1])
+    removed, added = np.maximum(-counts, 0), np.maximum(counts, 0)
+    return (np.repeat(keys, removed), np.repeat(colors, removed)), (np.repeat(keys, added), np.repeat(colors, added))
+
+def apply_food_delta(food, removed, added):
+    keys, colors, counts = food_counts([food, removed, added], [1, -1, 1])
+    return np.repeat(keys, counts), np.repeat(colors, counts)
+
+
+class AppendOnlyFile:
+    """A file written through a memory map that grows by doubling, bytes are never rewritten.
+    close() trims the file to what was written."""
+    def __init__(self, path, capacity=1 << 20):
+        self.path = path
+        self.used = 0
+        self.capacity = capacity
+        with open(path, 'wb') as f:
+            f.truncate(capacity)
+        self.map = np.memmap(path, dtype=np.uint8, mode='r+', shape=(capacity,))
+
+    def append(self, data):
+        data = np.frombuffer(data, dtype=np.uint8)
+        if self.used + len(data) > self.capacity:
+            self.map.flush()
+            del self.map
+            while self.used + len(data) > self.capacity:
+                self.capacity *= 2
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.capacity)
+            self.map = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=(self.capacity,))
+        self.map[self.used:self.used + len(data)] = data
+        self.used += len(data)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        del self.map
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.used)
+
+
+class Recorder:
+    """Streams the frames of one game to a recording directory.
+    Call record(game.get_state_arrays(), actions) after every update, close() at the end."""
+    def __init__(self, path, keyframe_interval=game_config.RECORDING_KEYFRAME_INTERVAL):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        if os.path.exists(os.path.join(path, "meta.json")):  # of an older recording, not of this data
+            os.remove(os.path.join(path, "meta.json"))
+        self.data = AppendOnlyFile(os.path.join(path, "data.bin"))
+        self.index = AppendOnlyFile(os.path.join(path, "index.bin"), capacity=24 << 12)  # whole (offset, size, keyframe) rows
+        self.frames = 0
+        self.meta = None
+        self.food = None  # canonical food of the last frame
+        self.keyframe = 0
+        self.last_version = None
+
+    def record(self, state, actions=None):
+        """Appends a frame. state is a StateArrays from get_state_arrays(), actions the list of
+        (px, py, do_split, do_feed) given to the update that produced it. A state whose version
+        was already recorded (nothing changed since) is skipped."""
+        if state.version == self.last_version:
+            return
+        self.last_version = state.version
+        players = state.players
+        if self.meta is None:
+            self.meta = {"names": list(players.names), "colors": players.colors.tolist(),
+                         "keyframe_interval": self.keyframe_interval}
+
+        n_players = len(players.names)
+        action_rows = np.zeros(n_players, dtype=ACTION)
+        if actions is not None:
+            actions = np.array([tuple(action) for action in actions], dtype=float).reshape(-1, 4)
+            action_rows['x'], action_rows['y'], action_rows['split'], action_rows['feed'] = actions.T
+        player_rows = np.zeros(n_players, dtype=PLAYER)
+        player_rows['x'], player_rows['y'] = players.x, players.y
+        player_rows['total_size'], player_rows['total_mass'] = players.total_size, players.total_mass
+
+        cells = state.cells
+        cell_rows = np.zeros(len(cells.x), dtype=CELL)
+        cell_rows['x'], cell_rows['y'], cell_rows['radius'], cell_rows['mass'] = cells.x, cells.y, cells.radius, cells.mass
+        cell_rows['owner'] = cells.color
+        viruses = state.viruses
+        virus_rows = np.zeros(len(viruses.x), dtype=VIRUS)
+        virus_rows['x'], virus_rows['y'], virus_rows['radius'], virus_rows['mass'] = viruses.x, viruses.y, viruses.radius, viruses.mass
+        ejected = state.ejected_food
+        ejected_rows = np.zeros(len(ejected.x), dtype=EJECTED)
+        ejected_rows['x'], ejected_rows['y'], ejected_rows['color'] = ejected.x, ejected.y, ejected.palette[ejected.color]
+
+        keys, colors = food_keys(state.food.x, state.food.y), state.food.color
+        order = canonical_order(keys, colors)
+        food = keys[order], colors[order]
+        keyframe = self.frames % self.keyframe_interval == 0
+        if keyframe:
+            self.keyframe = self.frames
+            food_blocks = [food_rows(*food)]
+        else:
+            food_blocks = [food_rows(*block) for block in food_delta(self.food, food)]
+        self.food = food
+
+        header = np.zeros(1, dtype=RECORD_HEADER)
+        header[0] = (self.frames, keyframe, len(cell_rows), len(virus_rows), len(ejected_rows),
+                     len(food_blocks[0]), 0 if keyframe else len(food_blocks[1]))
+        blocks = [header, action_rows, player_rows, cell_rows, virus_rows, ejected_rows, *food_blocks]
+        record = b"".join(block.tobytes() for block in blocks)
+        offset = self.data.used
+        self.data.append(record)
+        # the index row last: a frame is in the index only once its record is complete
+        self.index.append(np.array([offset, len(record), self.keyframe], dtype='<i8').tobytes())
+        self.frames += 1
+        if keyframe:
+            self.flush()  # a crashed or interrupted recording stays readable
+
+    def flush(self):
+        """Makes everything recorded so far readable by Recording (nothing to read before the first frame)"""
+        self.data.flush()
+        self.index.flush()
+        if self.meta is None:
+            return
+        with open(os.path.join(self.path, "meta.json"), 'w') as f:
+            json.dump(dict(self.meta, frames=self.frames), f)
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+
+class Recording:
+    """Read-only access to a recording directory through memory maps"""
+    def __init__(self, path):
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise Exception(f"{path} is not a recording, or no frame was recorded in it")
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.index = np.memmap(os.path.join(path, "index.bin"), dtype='<i8', mode='r').view(np.ndarray).reshape(-1, 3)
+        # every frame of the index, meta["frames"] is behind when the recorder didn't close
+        self.frames = int(np.count_nonzero(self.index[:, 1]))
+        self.index = self.index[:self.frames]
+        self.names = tuple(self.meta["names"])
+        self.colors = read_only(np.array(self.meta["colors"], dtype=np.uint8).reshape(-1, 3))
+        self.keyframe_interval = self.meta["keyframe_interval"]
+        self.data = np.memmap(os.path.join(path, "data.bin"), dtype=np.uint8, mode='r').view(np.ndarray)  # plain views are cheaper to slice
+        self.food_palette = read_only(np.array(PELLET_PALETTE, dtype=np.uint8))
+        self._food_frame = None  # (frame, food) of the last food reconstruction
+        self._food = None
+
+    def __len__(self):
+        return self.frames
+
+    def blocks(self, i):
+        """Header and the blocks of record i, as views of the memory map (food blocks not applied)"""
+        offset = self.index[i, 0]
+        header = self.data[offset:offset + RECORD_HEADER.itemsize].view(RECORD_HEADER)[0]
+        n_players = len(self.names)
+        sizes = [(ACTION, n_players), (PLAYER, n_players), (CELL, header['cells']), (VIRUS, header['viruses']),
+                 (EJECTED, header['ejected_food']), (FOOD, header['food']), (FOOD, header['food_added'])]
+        offset += RECORD_HEADER.itemsize
+        blocks = []
+        for dtype, count in sizes:
+            blocks.append(self.data[offset:offset + dtype.itemsize * count].view(dtype))
+            offset += dtype.itemsize * count
+        return header, blocks
+
+    def food(self, i):
+        """Canonical FOOD rows of frame i. Starts from its keyframe, or from the last frame read
+        when moving forward within the same keyframe interval."""
+        keyframe = self.index[i, 2]
+        if self._food_frame is not None and keyframe <= self._food_frame <= i:
+            start, food = self._food_frame, self._food
+        else:
+            start, food = keyframe, rows_food(self.blocks(keyframe)[1][5])
+        if start < i:
+            # the deltas add up, all of them are applied with a single sort
+            deltas = [self.blocks(frame)[1][5:] for frame in range(start + 1, i + 1)]
+            removed = rows_food(np.concatenate([delta[0] for delta in deltas]))
+            added = rows_food(np.concatenate([delta[1] for delta in deltas]))
+            food = apply_food_delta(food, removed, added)
+        self._food_frame, self._food = i, food
+        return food_rows(*food)
+
+    def frame(self, i):
+        header, (actions, players, cells, viruses, ejected_food, _, _) = self.blocks(i)
+        return RecordedFrame(int(header['frame']), actions, players, cells, viruses, ejected_food, self.food(i))
+
+    def state_arrays(self, i):
+        """Frame i as the StateArrays of get_state_arrays(), for PygameRenderer.render_arrays and the rasterizer"""
+        frame = self.frame(i)
+        as_float = lambda column: read_only(column.astype(float))
+        players = PlayerArrays(self.names, self.colors, *map(as_float, (frame.players['x'], frame.players['y'],
+                                                                         frame.players['total_size'], frame.players['total_mass'])))
+        cells = frame.cells
+        cells = EntityArrays(*map(as_float, (cells['x'], cells['y'], cells['radius'], cells['mass'])),
+                             read_only(cells['owner'].astype(np.intp)), self.colors)
+        n = len(frame.food)
+        food = EntityArrays(as_float(frame.food['x']), as_float(frame.food['y']), np.broadcast_to(PELLET_RADIUS, n),
+                            np.broadcast_to(float(game_config.PELLET_MASS), n), frame.food['color'], self.food_palette)
+        viruses = frame.viruses
+        viruses = EntityArrays(*map(as_float, (viruses['x'], viruses['y'], viruses['radius'], viruses['mass'])),
+                               read_only(np.zeros(len(viruses), dtype=np.intp)), read_only(np.array([(30, 225, 30)], dtype=np.uint8)))
+        n = len(frame.ejected_food)
+        ejected_food = EntityArrays(as_float(frame.ejected_food['x']), as_float(frame.ejected_food['y']),
+                                    np.broadcast_to(EJECTED_RADIUS, n), np.broadcast_to(float(game_config.EJECTED_MASS), n),
+                                    read_only(np.arange(n)), frame.ejected_food['color'])
+        return StateArrays(i, players, cells, food, viruses, ejected_food)
+
+    def player_series(self, field, chunk=PLAYER_SERIES_CHUNK):
+        """(frames, players) array of a PLAYER field (x, y, total_size, total_mass) of every frame.
+        Only the players block of each record is read, chunk frames at a time."""
+        start = self.index[:, 0] + RECORD_HEADER.itemsize + ACTION.itemsize * len(self.names)
+        block = PLAYER.itemsize * len(self.names)
+        series = np.empty((self.frames, len(self.names)), dtype=PLAYER[field])
+        for first in range(0, self.frames, chunk):
+            rows = self.data[start[first:first + chunk, None] + np.arange(block)]
+            series[first:first + chunk] = rows.view(PLAYER)[field]
+        return series
+
+    def scan(self, block, first=0, last=None):
+        """Yields (frame, rows) for one of "actions", "players", "cells", "viruses", "ejected_food"
+        of the frames first..last, the rows being views of the memory map"""
+        position = RecordedFrame._fields.index(block) - 1
+        for i in range(first, self.frames if last is None else last):
+            yield i, self.blocks(i)[1][position]
@@ -2,18 +2,23 @@
 import math
 import random
 import config
+import itertools
 
 game_config = config.GameConfig()
 
+uids = itertools.count()  # creation order, Game keeps its virus list sorted by it
+
 class Virus:
+    __slots__ = ('uid', 'x', 'y', 'mass', 'radius', 'spikes', 'vx', 'vy', 'last_fed_direction')
+    color = (30, 225, 30)  # Green color for viruses
+
     def __init__(self, x, y, mass=game_config.VIRUS_INITIAL_MASS, vx=0, vy=0):
+        self.uid = next(uids)
         self.x = x
         self.y = y
         self.mass = mass
         self.update_radius_spikes()
         
-        self.color = (30, 225, 30)  # Green color for viruses
-        
         self.vx = vx
         self.vy = vy
 
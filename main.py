@@ -3,34 +3,36 @@ import time
 import matplotlib
 import matplotlib.pyplot as plt
 import pygame
-from core.game import Game
+from core.game import create_game
 from visualization.pygame_renderer import PygameRenderer
-from bots.basic_bots import DummyBot
+from bots.basic_bots import DummyBot, BotController
+from core.recording import Recorder, Recording
 import pickle
 from collections import defaultdict
 import config
 import numpy as np
 from agar_env import AgarEnv
 from training.ddqn import DoubleDQNAgent
+from training.actors import ActorPool
 from feudalnet import FeudalNetwork
 import torch
 from argparse import Namespace
 import multiprocessing as mp
-from functools import partial
 
 game_config = config.GameConfig()
 matplotlib.use('Agg')  # Non-interactive backend
 
-def human_play_with_dummies(n_dummies):
+def human_play_with_dummies(n_dummies, engine=None, record=None):
     if n_dummies > game_config.MAX_PLAYERS:
         raise Exception("might lag. bypass if you want (config.py line 21), but you have been warned")
     renderer = PygameRenderer(game_config)
     dummy_names = [f"dum{i}" for i in range(1, n_dummies+1)]
     
-    game = Game(["Human"] + dummy_names, non_dummy_players=1)
+    game = create_game(["Human"] + dummy_names, non_dummy_players=1, engine=engine)
     game_state = game.get_state() # initial game state
 
-    dummy_bots = [DummyBot(name) for name in dummy_names]
+    bot_controller = BotController([DummyBot(name) for name in dummy_names])
+    recorder = Recorder(record) if record else None
 
     clock = pygame.time.Clock()
 
@@ -38,50 +40,90 @@ def human_play_with_dummies(n_dummies):
     split_key_pressed = False
     feed_key_pressed = False
 
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+    try:
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
 
-            # for splitting
-            elif event.type == pygame.KEYDOWN:  
-                split_key_pressed = event.key == pygame.K_SPACE
-                feed_key_pressed = event.key == pygame.K_w
+                # for splitting
+                elif event.type == pygame.KEYDOWN:  
+                    split_key_pressed = event.key == pygame.K_SPACE
+                    feed_key_pressed = event.key == pygame.K_w
                     
-        mouse_x, mouse_y = pygame.mouse.get_pos()
-        action_x, action_y = renderer.screen_to_world((mouse_x, mouse_y))
-
-        # for splitting
-        if split_key_pressed:
-            do_split = True
-            split_key_pressed = False  # Reset the flag
-        else:
-            do_split = False
+            mouse_x, mouse_y = pygame.mouse.get_pos()
+            action_x, action_y = renderer.screen_to_world((mouse_x, mouse_y))
 
-        # for feeding
-        if feed_key_pressed:
-            do_feed = True
-            feed_key_pressed = False  # Reset the flag
-        else:
-            do_feed = False
+            # for splitting
+            if split_key_pressed:
+                do_split = True
+                split_key_pressed = False  # Reset the flag
+            else:
+                do_split = False
+
+            # for feeding
+            if feed_key_pressed:
+                do_feed = True
+                feed_key_pressed = False  # Reset the flag
+            else:
+                do_feed = False
 
         
-        game.update([(action_x, action_y, do_split, do_feed)] + [dummy_bot.get_action(game) for dummy_bot in dummy_bots])
-        game_state = game.get_state()
-        renderer.render(game_state)
+            actions = [(action_x, action_y, do_split, do_feed)] + bot_controller.get_actions(game)
+            game.update(actions)
+            state = game.get_state_arrays()
+            renderer.render_arrays(state)
+            if recorder:
+                recorder.record(state, actions)
+            clock.tick(game_config.FPS)
+    finally:
+        renderer.close()
+        if recorder:
+            recorder.close()
+
+def replay(record, follow=0):
+    """Replay viewer of a recording made with --record.
+    Space: pause, left / right: one frame back / forward, down / up: one keyframe interval,
+    home / end: first / last frame, tab: follow the next player."""
+    recording = Recording(record)
+    renderer = PygameRenderer(game_config)
+    clock = pygame.time.Clock()
+    jumps = {pygame.K_LEFT: -1, pygame.K_RIGHT: 1,
+             pygame.K_DOWN: -recording.keyframe_interval, pygame.K_UP: recording.keyframe_interval,
+             pygame.K_HOME: -len(recording), pygame.K_END: len(recording)}
+
+    frame = 0
+    paused = False
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_TAB:
+                    follow = (follow + 1) % len(recording.names)
+                elif event.key in jumps:
+                    frame = min(max(frame + jumps[event.key], 0), len(recording) - 1)
+
+        pygame.display.set_caption(f"Replay {record}: frame {frame}/{len(recording) - 1}, following {recording.names[follow]}")
+        renderer.render_arrays(recording.state_arrays(frame), follow=follow)
+        if not paused:
+            frame = min(frame + 1, len(recording) - 1)
         clock.tick(game_config.FPS)
     renderer.close()
 
-def basic_bot_test(n_dummies, visualize, high, low, frames_per_game, num_games, spatialgrid_size):
+def basic_bot_test(n_dummies, visualize, high, low, frames_per_game, num_games, spatialgrid_size, engine=None):
     # For testing the bots and measuring the processing speed.
     dummy_names = [f"dum{i}" for i in range(n_dummies)]
-    dummy_bots = [DummyBot(name) for name in dummy_names]
+    bot_controller = BotController([DummyBot(name) for name in dummy_names])
 
     game_config.SPATIAL_GRID_CELL = spatialgrid_size
 
     time_intervals = []
     for _ in range(num_games):
-        game = Game(dummy_names, non_dummy_players=0)
+        game = create_game(dummy_names, non_dummy_players=0, engine=engine)
         max_steps = frames_per_game
 
         if visualize:
@@ -94,9 +136,8 @@ def basic_bot_test(n_dummies, visualize, high, low, frames_per_game, num_games,
                     if event.type == pygame.QUIT:
                         running = False
 
-                game.update([dummy_bot.get_action(game) for dummy_bot in dummy_bots])
-                game_state = game.get_state()
-                renderer.render(game_state)
+                game.update(bot_controller.get_actions(game))
+                renderer.render_arrays(game.get_state_arrays())
                 clock.tick(game_config.FPS)
                 max_steps -= 1
             renderer.close()
@@ -106,7 +147,7 @@ def basic_bot_test(n_dummies, visualize, high, low, frames_per_game, num_games,
         else:
             st = time.time()
             while max_steps > 0:
-                game.update([dummy_bot.get_action(game) for dummy_bot in dummy_bots])
+                game.update(bot_controller.get_actions(game))
                 max_steps -= 1
             end = time.time()
             print(f"Ran in {end - st} seconds")
@@ -128,36 +169,44 @@ def basic_bot_test(n_dummies, visualize, high, low, frames_per_game, num_games,
     
     plt.savefig(f'timetest_gridsize{game_config.SPATIAL_GRID_CELL}_{low}_{high}.png')
 
-def basic_bot_benchmarking(n_dummies, frames_per_game, num_games):
+def basic_bot_benchmarking(n_dummies, frames_per_game, num_games, engine=None, record=None):
     dummy_names = [f"dum{i}" for i in range(n_dummies)]
-    dummy_bots = [DummyBot(name) for name in dummy_names]
+    bot_controller = BotController([DummyBot(name) for name in dummy_names])
     
     player_size_evolution = defaultdict(list)
     
     
     for game_num in range(1, num_games+1):
-        game = Game(dummy_names, non_dummy_players=0)
+        game = create_game(dummy_names, non_dummy_players=0, engine=engine)
+        recorder = Recorder(f"{record}/game{game_num}") if record else None
         current_sizes = defaultdict(list)
         player_death_flags = {f"dum{i}": False for i in range(n_dummies)}
 
-        for frame in range(1, frames_per_game+1):
-            if frame % 10000 == 0:
-                print(f"Game {game_num}/{num_games}, Frame {frame}/{frames_per_game}")
+        try:
+            for frame in range(1, frames_per_game+1):
+                if frame % 10000 == 0:
+                    print(f"Game {game_num}/{num_games}, Frame {frame}/{frames_per_game}")
             
-            for player in game.players:
-                total_size = sum(cell.mass for cell in player.cells)
-                current_sizes[player.name].append(total_size)
+                for player in game.players:
+                    total_size = player.total_mass
+                    current_sizes[player.name].append(total_size)
             
-            reset_players = game.handle_collisions()
-            # if reset_players:
-            #     print(f"Dead: {reset_players}")
+                reset_players = game.handle_collisions()
+                # if reset_players:
+                #     print(f"Dead: {reset_players}")
             
-            for reset_player in reset_players:
-                player_size_evolution[reset_player].append(current_sizes[reset_player])
-                current_sizes[reset_player] = []
-                player_death_flags[reset_player] = True
-
-            game.update([dummy_bot.get_action(game) for dummy_bot in dummy_bots])
+                for reset_player in reset_players:
+                    player_size_evolution[reset_player].append(current_sizes[reset_player])
+                    current_sizes[reset_player] = []
+                    player_death_flags[reset_player] = True
+
+                actions = bot_controller.get_actions(game)
+                game.update(actions)
+                if recorder:
+                    recorder.record(game.get_state_arrays(), actions)
+        finally:
+            if recorder:
+                recorder.close()
         
         # Append remaining sizes and mark as incomplete if necessary
         for player_name, sizes in current_sizes.items():
@@ -178,27 +227,9 @@ def basic_bot_benchmarking(n_dummies, frames_per_game, num_games):
     print(f"Player size evolution data saved to {filename}")
 
     
-def train_episode(agent, num_dummies, dummy_lvl, max_frames_per_episode, episode):
-    env = AgarEnv(num_dummy_bots=num_dummies, dummy_lvl=dummy_lvl, max_frames_per_episode=max_frames_per_episode)
-    state = env.reset()
-    total_reward = 0
-    done = False
-    frames = 0
-    experiences = []
-    
-    while not done:
-        frames += 1
-        action = agent.act(state)
-        next_state, reward, done, _ = env.step(action)
-        experiences.append((state, action, reward, next_state, done))
-        state = next_state
-        total_reward += reward
-    
-    env.close()
-    return episode, total_reward, frames, experiences
-
 def train_double_dqn(num_dummies, dummy_lvl, num_episodes=1000, batch_size=32, 
-            episodes_to_save=200, update_target_every=100, max_frames_per_episode=3600, checkpoint_path=None):
+            episodes_to_save=200, update_target_every=100, max_frames_per_episode=3600, checkpoint_path=None, prioritized=False,
+            batched_inference=False):
     print("Training with the args:")
     print(f"num_dummies: {num_dummies}")
     print(f"dummy_lvl: {dummy_lvl}")
@@ -206,32 +237,30 @@ def train_double_dqn(num_dummies, dummy_lvl, num_episodes=1000, batch_size=32,
     print(f"max_frames_per_episode: {max_frames_per_episode}")
     print(f"batch_size: {batch_size}")
     print(f"update_target_every: {update_target_every}")
+    print(f"prioritized: {prioritized}")
+    print(f"batched_inference: {batched_inference}")
 
     env = AgarEnv(num_dummy_bots=num_dummies, dummy_lvl=dummy_lvl, max_frames_per_episode=max_frames_per_episode)
     state_size = env.observation_space.shape[0]
     action_size = env.action_space.n
-    agent = DoubleDQNAgent(state_size, action_size)
+    agent = DoubleDQNAgent(state_size, action_size, prioritized=prioritized)
     if checkpoint_path is not None:
         agent.load(checkpoint_path)
 
-    # Create a pool of workers
-    num_processes = mp.cpu_count() // 2
-    pool = mp.Pool(processes=num_processes)
-
-    # Partial function for multiprocessing
-    train_func = partial(train_episode, agent, num_dummies, dummy_lvl, max_frames_per_episode)
+    # Long-lived actor processes, each with its own env and policy copy, stream their transitions back
+    num_processes = max(mp.cpu_count() // 2, 1)
+    actors = ActorPool(agent, num_processes, num_episodes, batched_inference=batched_inference,
+                       num_dummy_bots=num_dummies, dummy_lvl=dummy_lvl, max_frames_per_episode=max_frames_per_episode)
 
     total_rewards = []
-    for i in range(0, num_episodes, num_processes):
-        episodes_to_run = min(num_processes, num_episodes - i)
-        results = pool.map(train_func, range(i, i + episodes_to_run))
+    while len(total_rewards) < num_episodes:
+        finished = actors.finished_episodes()
+        for actor_id, states, actions, rewards, dones in actors.transitions():
+            agent.remember_batch(states, actions, rewards, dones, stream=actor_id)
 
-        for episode, total_reward, frames, experiences in results:
+        for _, episode, total_reward, frames in finished:
             total_rewards.append(total_reward)
 
-            for exp in experiences:
-                agent.remember(*exp)
-
             if len(agent.memory) > batch_size:
                 agent.replay(batch_size)
 
@@ -242,18 +271,21 @@ def train_double_dqn(num_dummies, dummy_lvl, num_episodes=1000, batch_size=32,
 
             print(f"Episode: {episode+1}/{num_episodes}, Frames: {frames}, Total Reward: {total_reward}, Epsilon: {agent.epsilon:.2f}")
 
-        if (i + episodes_to_run) % episodes_to_save == 0:
-            agent.save(f"checkpoints/ddqn_{i+episodes_to_run}eps_lvl{dummy_lvl}.pth")
-            # Save total rewards as pickle file
-            with open(f"rewards/ddqn_rewards_{i+episodes_to_run}eps_lvl{dummy_lvl}.pkl", "wb") as f:
-                pickle.dump(total_rewards, f)
+            if len(total_rewards) % episodes_to_save == 0:
+                agent.save(f"checkpoints/ddqn_{len(total_rewards)}eps_lvl{dummy_lvl}.pth")
+                # Save total rewards as pickle file
+                with open(f"rewards/ddqn_rewards_{len(total_rewards)}eps_lvl{dummy_lvl}.pkl", "wb") as f:
+                    pickle.dump(total_rewards, f)
+
+        if finished:
+            # The actors' next episodes use the new weights and epsilon
+            actors.publish(agent)
 
     # Save final total rewards
     with open(f"rewards/ddqn_rewards_final_{num_episodes}eps_lvl{dummy_lvl}.pkl", "wb") as f:
         pickle.dump(total_rewards, f)
 
-    pool.close()
-    pool.join()
+    actors.close()
     env.close()
 
 def dqn_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
@@ -275,7 +307,7 @@ def dqn_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
 
     # Set up the game
     game = env.game
-    dummy_bots = env.dummy_bots
+    bot_controller = env.bot_controller
 
     running = True
     while running:
@@ -291,7 +323,7 @@ def dqn_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
         dqn_action = env._action_to_game_format(action)
 
         # Get actions for dummy bots
-        dummy_actions = [bot.get_action(game) for bot in dummy_bots]
+        dummy_actions = bot_controller.get_actions(game)
 
         # Combine DQN action with dummy bot actions
         all_actions = [dqn_action] + dummy_actions
@@ -301,8 +333,7 @@ def dqn_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
 
         # Render the game if visualization is enabled
         if visualize:
-            game_state = game.get_state()
-            renderer.render(game_state)
+            renderer.render_arrays(game.get_state_arrays())
             clock.tick(game_config.FPS)
 
         # Check if the episode is done
@@ -373,7 +404,7 @@ def feudal_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
     
     # Set up the game
     game = env.game
-    dummy_bots = env.dummy_bots
+    bot_controller = env.bot_controller
     
     running = True
     while running:
@@ -395,7 +426,7 @@ def feudal_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
         feudal_action = env._action_to_game_format(action)
         
         # Get actions for dummy bots
-        dummy_actions = [bot.get_action(game) for bot in dummy_bots]
+        dummy_actions = bot_controller.get_actions(game)
         
         # Combine Feudal Network action with dummy bot actions
         all_actions = [feudal_action] + dummy_actions
@@ -405,8 +436,7 @@ def feudal_vs_dummies(num_dummies, dummy_lvl, visualize, checkpoint_path):
         
         # Render the game if visualization is enabled
         if visualize:
-            game_state = game.get_state()
-            renderer.render(game_state)
+            renderer.render_arrays(game.get_state_arrays())
             clock.tick(game_config.FPS)
         
         # Check if the episode is done
@@ -428,6 +458,8 @@ if __name__ == "__main__":
     parser.add_argument("--frames_per_game")
     parser.add_argument("--num_games")
     parser.add_argument("--spatialgrid_size")
+    parser.add_argument("--engine", help="objects or arrays, defaults to config.py ENGINE")
+    parser.add_argument("--record", help="recording directory to write (human_with_dummies, basic_bot_benchmarking) or to replay")
 
     # Training
     parser.add_argument("--num_episodes", type=int, default=1000)
@@ -437,18 +469,23 @@ if __name__ == "__main__":
     parser.add_argument("--dummy_lvl", type=int)
     parser.add_argument("--max_frames_per_episode", type=int)
     parser.add_argument("--checkpoint_path")
+    parser.add_argument("--prioritized", action="store_true", help="prioritized experience replay (train_double_dqn)")
+    parser.add_argument("--batched_inference", action="store_true",
+                        help="actors get their actions from one batched inference process (train_double_dqn)")
     
     args = parser.parse_args()
 
     if args.mode == "human_with_dummies":
-        human_play_with_dummies(args.num_dummies)
+        human_play_with_dummies(args.num_dummies, engine=args.engine, record=args.record)
     elif args.mode == "basic_bot_test":
         basic_bot_test(args.num_dummies, visualize=args.visualize,
                        high=int(args.high), low=int(args.low), frames_per_game=int(args.frames_per_game),
-                       num_games=int(args.num_games), spatialgrid_size=int(args.spatialgrid_size))
+                       num_games=int(args.num_games), spatialgrid_size=int(args.spatialgrid_size), engine=args.engine)
     elif args.mode == "basic_bot_benchmarking":
         basic_bot_benchmarking(args.num_dummies, frames_per_game=int(args.frames_per_game),
-                       num_games=int(args.num_games))
+                       num_games=int(args.num_games), engine=args.engine, record=args.record)
+    elif args.mode == "replay":
+        replay(args.record)
 
     elif args.mode == "train_double_dqn":
         train_double_dqn(num_dummies=args.num_dummies, 
@@ -458,7 +495,9 @@ if __name__ == "__main__":
                         batch_size=args.batch_size, 
                         update_target_every=args.update_target_every,
                         max_frames_per_episode=args.max_frames_per_episode,
-                        checkpoint_path=args.checkpoint_path)
+                        checkpoint_path=args.checkpoint_path,
+                        prioritized=args.prioritized,
+                        batched_inference=args.batched_inference)
         
     elif args.mode == "dqn_vs_dummies":
         dqn_vs_dummies(num_dummies=args.num_dummies, dummy_lvl=args.dummy_lvl, 
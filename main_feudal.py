@@ -6,14 +6,11 @@ from feudalnet import FeudalNetwork, feudal_loss
 from storage import Storage
 # from logger import Logger
 import config
-from agar_env import AgarEnv
+from agar_env import AgarVecEnv
 game_config = config.GameConfig()
 import numpy as np
 import pickle
 
-import threading
-from queue import Queue
-
 parser = argparse.ArgumentParser(description='Feudal Nets')
 # GENERIC RL/MODEL PARAMETERS
 parser.add_argument('--lr', type=float, default=0.0005,
@@ -61,10 +58,6 @@ parser.add_argument('--seed', type=int, default=0,
 
 args = parser.parse_args()
 
-def worker(env, action, result_queue):
-    result = env.step(action)
-    result_queue.put(result)
-
 def experiment(args):
 
     save_steps = list(torch.arange(0, int(args.max_steps),
@@ -81,8 +74,9 @@ def experiment(args):
         torch.backends.cudnn.benchmark = False
 
     # envs = make_envs('Agar', args.num_workers)
-    envs = [AgarEnv(num_dummy_bots=30, dummy_lvl=3, max_frames_per_episode=None) 
-            for _ in range(args.num_workers)]
+    # One worker process per env, the games go on after the player dies (it respawns)
+    envs = AgarVecEnv(args.num_workers, seed=args.seed, auto_reset=False,
+                      num_dummy_bots=30, dummy_lvl=3, max_frames_per_episode=None)
     feudalnet = FeudalNetwork(
         num_workers=args.num_workers,
         input_dim=(game_config.OBSERVATION_SIZE,),
@@ -103,7 +97,7 @@ def experiment(args):
                                     alpha=0.99, eps=1e-5)
     goals, states, masks = feudalnet.init_obj()
 
-    x = np.array([env.reset() for env in envs])
+    x = envs.reset()
     step = 0
 
     total_rewards = []
@@ -124,23 +118,8 @@ def experiment(args):
             # Take a step, log the info, get the next state
             action, logp, entropy = take_action(action_dist)
 
-            # Create threads and result queue
-            threads = []
-            result_queue = Queue()
-            for env, action_singular in zip(envs, action):
-                thread = threading.Thread(target=worker, args=(env, action_singular, result_queue))
-                thread.start()
-                threads.append(thread)
-
-            # Wait for all threads to complete
-            for thread in threads:
-                thread.join()
-
-            # Collect results
-            data = [result_queue.get() for _ in range(args.num_workers)]
-            x = np.array([datapoint[0] for datapoint in data])
-            reward = np.array([datapoint[1] for datapoint in data])
-            done = np.array([datapoint[2] for datapoint in data])
+            # All the envs step in parallel in their worker processes
+            x, reward, done, _ = envs.step(action)
 
             episode_reward += reward
 
@@ -198,8 +177,7 @@ def experiment(args):
             with open(f"feudal_rewards/{args.env_name}_{args.run_name}_rewards_step={step}.pkl", "wb") as f:
                 pickle.dump(total_rewards, f)
 
-    for env in envs:
-        env.close()
+    envs.close()
     torch.save({
         'model': feudalnet.state_dict(),
         'args': args,
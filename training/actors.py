@@ -0,0 +1,209 @@
+"""
+Long-lived actor processes for train_double_dqn.
+
+Each actor keeps its own AgarEnv and a CPU copy of the policy for the whole training, and plays
+episodes until num_episodes have been started. The learner publishes new weights (and epsilon)
+into a SharedWeights, the actors only copy them, at the start of an episode, when its version
+changed. Transitions come back through one TransitionRing per actor, preallocated arrays in
+shared memory, so neither the agent nor the transitions are ever pickled. Like in the agent's
+ReplayBuffer, next states aren't sent: they are the states of the following transitions of the actor.
+"""
+import random
+import time
+from queue import Empty
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from agar_env import AgarEnv
+from training.ddqn import DQN
+from training.inference import InferenceServer, greedy_actions
+
+
+class SharedWeights:
+    """Flat copy of a model's parameters in shared memory, with the epsilon to act with.
+    version counts the publications, its lock also guards the weights."""
+    def __init__(self, model, context):
+        self.vector = parameters_to_vector(model.parameters()).detach().cpu().share_memory_()
+        self.epsilon = context.RawValue("d", 0)
+        self.version = context.Value("q", 0)
+
+    def publish(self, model, epsilon):
+        with self.version.get_lock():
+            self.vector.copy_(parameters_to_vector(model.parameters()).detach())
+            self.epsilon.value = epsilon
+            self.version.value += 1
+
+    def pull(self, model, version):
+        """Copies the weights into model (if not None) if they were published after version, returns (version, epsilon)"""
+        with self.version.get_lock():
+            if model is not None and self.version.value != version:
+                # a copy, the model would otherwise be a view of the shared weights
+                vector_to_parameters(self.vector.clone(), model.parameters())
+            return self.version.value, self.epsilon.value
+
+
+class TransitionRing:
+    """Single producer, single consumer ring of (state, action, reward, done) transitions in shared memory.
+    put (actor) waits while the ring is full, get (learner) takes every transition written since the last get."""
+    def __init__(self, capacity, state_size, context):
+        shared = (context.RawArray("f", capacity * state_size), context.RawArray("q", capacity),
+                  context.RawArray("d", capacity), context.RawArray("b", capacity),
+                  context.Value("q", 0), context.Value("q", 0))
+        self._attach(capacity, state_size, shared)
+
+    def _attach(self, capacity, state_size, shared):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.shared = shared
+        states, actions, rewards, dones, self.written, self.read = shared
+        self.arrays = (np.frombuffer(states, dtype=np.float32).reshape(capacity, state_size),
+                       np.frombuffer(actions, dtype=np.int64),
+                       np.frombuffer(rewards, dtype=np.float64),
+                       np.frombuffer(dones, dtype=np.bool_))
+
+    def __getstate__(self):
+        return self.capacity, self.state_size, self.shared
+
+    def __setstate__(self, state):
+        self._attach(*state)
+
+    def put(self, state, action, reward, done):
+        written = self.written.value
+        while written - self.read.value >= self.capacity:
+            time.sleep(0.001)
+        row = written % self.capacity
+        for array, value in zip(self.arrays, (state, action, reward, done)):
+            array[row] = value
+        self.written.value = written + 1  # only once the row is complete
+
+    def get(self):
+        """(states, actions, rewards, dones) arrays, copies"""
+        read, written = self.read.value, self.written.value
+        rows = np.arange(read, written) % self.capacity
+        transitions = tuple(array[rows] for array in self.arrays)
+        self.read.value = written
+        return transitions
+
+
+def act(greedy_action, state, epsilon, action_size):
+    """DoubleDQNAgent.act, greedy_action gives the action of highest value of a state"""
+    if np.random.rand() <= epsilon:
+        return random.randrange(action_size)
+    return greedy_action(state)
+
+
+def actor_loop(actor_id, weights, ring, next_episode, num_episodes, results, state_size, action_size, seed, env_kwargs,
+               inference_client=None):
+    random.seed(seed)
+    np.random.seed(seed if seed is None else seed % 2**32)
+    torch.set_num_threads(1)  # one core per actor
+    env = AgarEnv(**env_kwargs)
+    if inference_client is None:
+        model = DQN(state_size, action_size)
+        greedy_action = lambda state: int(greedy_actions(model, state[None])[0])
+    else:
+        inference_client.open_client()
+        model = None  # the server pulls the weights
+        greedy_action = inference_client.greedy_action
+    version = -1
+    while True:
+        with next_episode.get_lock():
+            episode = next_episode.value
+            next_episode.value += 1
+        if episode >= num_episodes:
+            break
+
+        version, epsilon = weights.pull(model, version)
+        state = env.reset()
+        total_reward = 0
+        frames = 0
+        done = False
+        while not done:
+            frames += 1
+            action = act(greedy_action, state, epsilon, action_size)
+            next_state, reward, done, _ = env.step(action)
+            ring.put(state, action, reward, done)
+            state = next_state
+            total_reward += reward
+        # after the last transition of the episode is in the ring
+        results.put((actor_id, episode, total_reward, frames))
+    env.close()
+    if inference_client is not None:
+        inference_client.close()
+
+
+class ActorPool:
+    """num_actors actor processes playing num_episodes episodes in total with the weights of agent.
+    With batched_inference, the actors' greedy actions come from an InferenceServer batching their observations,
+    with the latest published weights, instead of one forward pass per actor and frame with the weights
+    of the start of the episode.
+    env_kwargs go to AgarEnv. Actor i seeds random and np.random with seed + i (from the OS if seed is None)."""
+    def __init__(self, agent, num_actors, num_episodes, ring_capacity=4096, seed=None, batched_inference=False,
+                 **env_kwargs):
+        context = mp.get_context()
+        self.weights = SharedWeights(agent.model, context)
+        self.publish(agent)
+        self.inference_server = None
+        inference_clients = [None] * num_actors
+        if batched_inference:
+            self.inference_server = InferenceServer(self.weights, num_actors, agent.state_size, agent.action_size, context)
+            inference_clients = self.inference_server.clients
+        self.rings = [TransitionRing(ring_capacity, agent.state_size, context) for _ in range(num_actors)]
+        self.next_episode = context.Value("q", 0)
+        self.num_episodes = num_episodes
+        self.received = 0  # results returned by finished_episodes
+        self.results = context.Queue()
+        self.processes = []
+        for i, (ring, inference_client) in enumerate(zip(self.rings, inference_clients)):
+            process = context.Process(target=actor_loop, daemon=True,
+                                      args=(i, self.weights, ring, self.next_episode, num_episodes, self.results,
+                                            agent.state_size, agent.action_size, None if seed is None else seed + i,
+                                            env_kwargs, inference_client))
+            process.start()
+            self.processes.append(process)
+        if self.inference_server is not None:
+            self.inference_server.started()
+
+    def publish(self, agent):
+        """Makes the actors play their next episodes with the current weights and epsilon of agent"""
+        self.weights.publish(agent.model, agent.epsilon)
+
+    def finished_episodes(self, timeout=0.01):
+        """(actor_id, episode, total_reward, frames) of the episodes finished since the last call,
+        waits up to timeout seconds for the first one.
+        Raises if an actor or the inference server died, or if every actor exited before num_episodes results came."""
+        self.check_processes()
+        # an actor's results are in the queue once it exited, whether they are read before or after
+        exited = all(process.exitcode is not None for process in self.processes)
+        finished = []
+        try:
+            finished.append(self.results.get(timeout=timeout))
+            while True:
+                finished.append(self.results.get_nowait())
+        except Empty:
+            pass
+        self.received += len(finished)
+        if exited and not finished and self.received < self.num_episodes:
+            raise Exception(f"the actors exited after {self.received} of {self.num_episodes} episodes")
+        return finished
+
+    def check_processes(self):
+        """Raises if an actor or the inference server exited with an error"""
+        for actor_id, process in enumerate(self.processes):
+            if process.exitcode not in (None, 0):
+                raise Exception(f"actor {actor_id} exited with code {process.exitcode}")
+        if self.inference_server is not None and self.inference_server.process.exitcode not in (None, 0):
+            raise Exception(f"the inference server exited with code {self.inference_server.process.exitcode}")
+
+    def transitions(self):
+        """(actor_id, states, actions, rewards, dones) of every transition streamed since the last call, in order for each actor,
+        all the transitions of the episodes returned by finished_episodes before this call included"""
+        for actor_id, ring in enumerate(self.rings):
+            yield (actor_id,) + ring.get()
+
+    def close(self):
+        for process in self.processes:
+            process.join()
+        if self.inference_server is not None:
+            self.inference_server.close()
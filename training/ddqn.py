@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import random
-from collections import deque
+from training.replay import ReplayBuffer, PrioritizedReplayBuffer
 
 class DQN(nn.Module):
     def __init__(self, state_size, action_size):
@@ -20,11 +20,15 @@ class DQN(nn.Module):
         return self.fc4(x)
 
 class DoubleDQNAgent:
-    def __init__(self, state_size, action_size):
+    def __init__(self, state_size, action_size, memory_size=100000, memory_path=None, prioritized=False):
+        """memory_path: .npy file to hold the replay observations as a memmap, for big memory_size
+        prioritized: sample the replay by TD error (PrioritizedReplayBuffer) and weight the loss by importance sampling"""
         self.state_size = state_size
         self.action_size = action_size
 
-        self.memory = deque(maxlen=2000)
+        self.prioritized = prioritized
+        memory_class = PrioritizedReplayBuffer if prioritized else ReplayBuffer
+        self.memory = memory_class(memory_size, state_size, path=memory_path)
         self.random = np.random.RandomState()
 
         self.gamma = 0.95
@@ -38,8 +42,14 @@ class DoubleDQNAgent:
         self.target_model = DQN(state_size, action_size).to(self.device)
         self.optimizer = optim.Adam(self.model.parameters(), lr=self.learning_rate)
 
-    def remember(self, state, action, reward, next_state, done):
-        self.memory.append((state, action, reward, next_state, done))
+    def remember(self, state, action, reward, done, stream=0):
+        """No next_state: the next state of a transition is the state of the next transition remembered
+        for the same stream, so the transitions of a stream have to be remembered in the order they were played"""
+        self.memory.add(np.asarray(state)[None], [action], [reward], [done], stream)
+
+    def remember_batch(self, states, actions, rewards, dones, stream=0):
+        """Consecutive transitions of a stream, see ReplayBuffer.add"""
+        self.memory.add(states, actions, rewards, dones, stream)
 
     def act(self, state):
         if np.random.rand() <= self.epsilon:
@@ -52,21 +62,21 @@ class DoubleDQNAgent:
     def replay(self, batch_size):
         if len(self.memory) < batch_size:
             return
-        minibatch = random.sample(self.memory, batch_size)
-        states, actions, rewards, next_states, dones = zip(*minibatch)
-
-        states = torch.FloatTensor(states).to(self.device)
-        actions = torch.LongTensor(actions).to(self.device)
-        rewards = torch.FloatTensor(rewards).to(self.device)
-        next_states = torch.FloatTensor(next_states).to(self.device)
-        dones = torch.FloatTensor(dones).to(self.device)
+        indices = self.memory.sample_indices(batch_size)
+        states, actions, rewards, next_states, dones = (tensor.to(self.device) for tensor in self.memory.batch(indices))
 
         current_q_values = self.model(states).gather(1, actions.unsqueeze(1))
         next_q_values = self.target_model(next_states).detach()
         max_next_q_values = next_q_values.max(1)[0]
         expected_q_values = rewards + (1 - dones) * self.gamma * max_next_q_values
 
-        loss = nn.MSELoss()(current_q_values, expected_q_values.unsqueeze(1))
+        if self.prioritized:
+            td_errors = expected_q_values - current_q_values.squeeze(1)
+            weights = self.memory.weights(indices).to(self.device)
+            loss = (weights * td_errors ** 2).mean()
+            self.memory.update_priorities(indices, td_errors.detach().cpu().numpy())
+        else:
+            loss = nn.MSELoss()(current_q_values, expected_q_values.unsqueeze(1))
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
@@ -0,0 +1,125 @@
+"""
+Batched DQN inference shared by the actor processes of train_double_dqn.
+
+Instead of one batch-size-1 forward pass per actor and frame, the actors write their observation
+into their row of a shared array and ping the server process through their pipe. The server waits
+for the first request, gathers the others that arrive within max_latency seconds (or until every
+actor asked), runs one forward pass over the batch, writes the actions into a shared array and
+answers each waiting actor. The server pulls the weights from the learner's SharedWeights when a
+new version was published.
+An actor is done when its end of the pipe is closed in every process. Forked processes inherit all
+the ends open in their parent, so the server and each client close the ends that aren't theirs
+when they start, whatever the start method.
+"""
+import time
+from multiprocessing.connection import wait
+import numpy as np
+import torch
+from training.ddqn import DQN
+
+
+def greedy_actions(model, observations):
+    """Actions of highest value for a batch of observations, as a NumPy array"""
+    with torch.no_grad():
+        return model(torch.from_numpy(observations)).argmax(1).numpy()
+
+
+def inference_loop(weights, connections, client_connections, observations, actions, state_size, action_size, max_latency):
+    for connection in client_connections:  # so that only the actors hold them
+        connection.close()
+    observations = np.frombuffer(observations, dtype=np.float32).reshape(len(connections), state_size)
+    actions = np.frombuffer(actions, dtype=np.int64)
+    model = DQN(state_size, action_size)
+    version = -1
+    rows = {connection: row for row, connection in enumerate(connections)}
+    open_connections = list(connections)
+    while open_connections:
+        ready = wait(open_connections)
+        deadline = time.perf_counter() + max_latency
+        pending = []
+        while True:
+            for connection in ready:
+                try:
+                    connection.recv_bytes()
+                except EOFError:  # the actor is done
+                    open_connections.remove(connection)
+                    continue
+                pending.append(connection)
+            remaining = deadline - time.perf_counter()
+            if len(pending) == len(open_connections) or remaining <= 0:
+                break
+            ready = wait([c for c in open_connections if c not in pending], remaining)
+            if not ready:
+                break
+
+        if pending:
+            version, _ = weights.pull(model, version)
+            batch = np.sort([rows[connection] for connection in pending])
+            actions[batch] = greedy_actions(model, observations[batch])
+            for connection in pending:
+                connection.send_bytes(b"")
+
+
+class InferenceClient:
+    """An actor's end of the InferenceServer, greedy_action blocks until the server answered.
+    inherited are the other ends of the server's pipes, open_client closes them in the actor's process."""
+    def __init__(self, row, connection, observations, actions, state_size, inherited=()):
+        self._attach(row, connection, observations, actions, state_size, inherited)
+
+    def _attach(self, row, connection, observations, actions, state_size, inherited):
+        self.row = row
+        self.connection = connection
+        self.inherited = inherited
+        self.shared = (observations, actions, state_size)
+        self.observation = np.frombuffer(observations, dtype=np.float32).reshape(-1, state_size)[row]
+        self.actions = np.frombuffer(actions, dtype=np.int64)
+
+    def __getstate__(self):
+        return (self.row, self.connection) + self.shared + (self.inherited,)
+
+    def __setstate__(self, state):
+        self._attach(*state)
+
+    def open_client(self):
+        """To call first in the actor's process"""
+        for connection in self.inherited:
+            connection.close()
+        self.inherited = ()
+
+    def greedy_action(self, state):
+        self.observation[:] = state
+        self.connection.send_bytes(b"")
+        self.connection.recv_bytes()
+        return int(self.actions[self.row])
+
+    def close(self):
+        self.connection.close()
+
+
+class InferenceServer:
+    """Server process answering num_clients InferenceClients (self.clients) with the weights published in weights.
+    It stops once every client is closed."""
+    def __init__(self, weights, num_clients, state_size, action_size, context, max_latency=0.002):
+        observations = context.RawArray("f", num_clients * state_size)
+        actions = context.RawArray("q", num_clients)
+        pipes = [context.Pipe() for _ in range(num_clients)]
+        self.server_ends = [server_end for server_end, _ in pipes]
+        client_ends = [client_end for _, client_end in pipes]
+        self.clients = [InferenceClient(row, client_end, observations, actions, state_size,
+                                        self.server_ends + client_ends[:row] + client_ends[row + 1:])
+                        for row, client_end in enumerate(client_ends)]
+        self.process = context.Process(target=inference_loop, daemon=True,
+                                       args=(weights, self.server_ends, client_ends, observations, actions,
+                                             state_size, action_size, max_latency))
+        self.process.start()
+
+    def started(self):
+        """To call once the clients were given to their processes: closes this process' ends of the pipes,
+        so that the server sees when the actors close theirs"""
+        for connection in self.server_ends:
+            connection.close()
+        for client in self.clients:
+            client.close()
+
+    def close(self):
+        self.process.join()
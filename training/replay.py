@@ -0,0 +1,164 @@
+"""
+Preallocated replay memory for DoubleDQNAgent.
+
+Transitions live in fixed-size NumPy arrays used as a ring, the oldest ones are overwritten first.
+Observations are stored once, as float16 by default: the next state of a transition is the state
+of the following transition of the same stream (an actor or env playing its episodes in order),
+found through next_index, so it is never stored twice. The last transition of a stream has no
+next state until the stream's following transition is added and can't be sampled until then, the
+next state of a done transition is never needed. With path, the observations are a .npy memmap,
+for buffers bigger than RAM.
+Batches are sampled with replacement.
+"""
+import numpy as np
+import torch
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, state_size, observation_dtype=np.float16, path=None, seed=None):
+        self.capacity = capacity
+        if path is None:
+            self.observations = np.zeros((capacity, state_size), dtype=observation_dtype)
+        else:
+            self.observations = np.lib.format.open_memmap(path, mode="w+", dtype=observation_dtype,
+                                                          shape=(capacity, state_size))
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.bool_)
+        self.next_index = np.full(capacity, -1, dtype=np.int64)  # row of the next state, -1 while unknown
+        self.added = 0  # transitions added so far, the next one goes to row added % capacity
+        self.pending = {}  # stream: position (in added order) of its last transition, waiting for its next state
+        self.random = np.random.default_rng(seed)
+
+    def __len__(self):
+        """Number of transitions that can be sampled"""
+        return min(self.added, self.capacity) - len(self.pending)
+
+    def add(self, states, actions, rewards, dones, stream=0):
+        """Adds consecutive transitions of a stream, states (n, state_size) and actions, rewards, dones (n,)"""
+        count = min(len(states), self.capacity)  # only the last capacity ones would be kept
+        if count == 0:
+            return
+        previous = self.pending.pop(stream, None) if count == len(states) else None
+        states, actions, rewards, dones = (np.asarray(a)[len(a) - count:] for a in (states, actions, rewards, dones))
+        positions = self.added + np.arange(count)
+        rows = positions % self.capacity
+        self.added += count
+        # the transitions about to be overwritten no longer wait for a next state
+        self.pending = {s: position for s, position in self.pending.items() if position >= self.added - self.capacity}
+        if previous is not None and previous < self.added - self.capacity:
+            previous = None
+
+        self.observations[rows] = states
+        self.actions[rows] = actions
+        self.rewards[rows] = rewards
+        self.dones[rows] = dones
+        self.next_index[rows] = -1
+        self.next_index[rows[:-1]] = rows[1:]
+        if previous is not None:
+            self.next_index[previous % self.capacity] = rows[0]
+        if not self.dones[rows[-1]]:
+            self.pending[stream] = positions[-1]
+
+    def sampleable(self, indices):
+        """Whether the rows at indices hold a transition with its next state (or done)"""
+        rows = np.minimum(indices, self.capacity - 1)
+        return (indices < min(self.added, self.capacity)) & (self.dones[rows] | (self.next_index[rows] >= 0))
+
+    def sample_indices(self, batch_size):
+        """batch_size rows of transitions that can be sampled, uniformly and with replacement (a batch may
+        hold a transition twice, unlike random.sample), sorted (memmap reads in order)"""
+        size = min(self.added, self.capacity)
+        indices = self.random.integers(0, size, batch_size)
+        invalid = ~self.sampleable(indices)
+        while invalid.any():  # only the last transition of each stream, rare
+            indices[invalid] = self.random.integers(0, size, invalid.sum())
+            invalid = ~self.sampleable(indices)
+        return np.sort(indices)
+
+    def batch(self, indices):
+        """(states, actions, rewards, next_states, dones) CPU tensors of the transitions at indices"""
+        next_indices = np.where(self.next_index[indices] >= 0, self.next_index[indices], indices)
+        return (torch.from_numpy(self.observations[indices].astype(np.float32)),
+                torch.from_numpy(self.actions[indices]),
+                torch.from_numpy(self.rewards[indices]),
+                torch.from_numpy(self.observations[next_indices].astype(np.float32)),
+                torch.from_numpy(self.dones[indices].astype(np.float32)))
+
+    def sample(self, batch_size):
+        return self.batch(self.sample_indices(batch_size))
+
+
+class SumTree:
+    """Binary tree in an array where each node is the sum of its two children, over capacity leaf values.
+    Node 1 is the root, the children of node i are 2i and 2i + 1, the leaves start at self.leaves.
+    Updates and searches handle a batch of leaves at once, level by level, in O(batch log capacity)."""
+    def __init__(self, capacity):
+        self.leaves = 1 << max(capacity - 1, 1).bit_length()  # a power of two, complete tree
+        self.depth = self.leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaves)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, values):
+        nodes = np.asarray(indices) + self.leaves
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes //= 2  # repeated parents are just summed again
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Leaf index of each value in [0, total()): the first leaf whose cumulated sum exceeds it"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0)
+            nodes = left + go_right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """ReplayBuffer sampling transitions with probability priority**alpha / sum, the priorities being the
+    absolute TD errors given to update_priorities (new transitions get the highest priority so far).
+    weights gives the importance-sampling weights (N P(i))**-beta / max, normalized by the batch maximum,
+    beta goes up by beta_increment per sampled batch until 1."""
+    def __init__(self, capacity, state_size, alpha=0.6, beta=0.4, beta_increment=1e-4, epsilon=1e-3, **kwargs):
+        super(PrioritizedReplayBuffer, self).__init__(capacity, state_size, **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon  # so that no transition gets priority 0
+        self.max_priority = 1.0
+        self.priorities = SumTree(capacity)
+
+    def add(self, states, actions, rewards, dones, stream=0):
+        count = min(len(states), self.capacity)
+        super(PrioritizedReplayBuffer, self).add(states, actions, rewards, dones, stream)
+        rows = (self.added - count + np.arange(count)) % self.capacity
+        self.priorities.update(rows, self.max_priority ** self.alpha)
+
+    def sample_indices(self, batch_size):
+        """batch_size rows drawn by priority, one in each of batch_size equal slices of the total (stratified),
+        with replacement like ReplayBuffer.sample_indices"""
+        self.beta = min(self.beta + self.beta_increment, 1.0)
+        segment = self.priorities.total() / batch_size
+        indices = self.priorities.find((np.arange(batch_size) + self.random.random(batch_size)) * segment)
+        invalid = ~self.sampleable(indices)
+        while invalid.any():  # the last transition of each stream, or rounding past the last leaf
+            indices[invalid] = self.priorities.find(self.random.random(invalid.sum()) * self.priorities.total())
+            invalid = ~self.sampleable(indices)
+        return np.sort(indices)
+
+    def weights(self, indices):
+        """Importance-sampling weights of the rows at indices, a float32 CPU tensor"""
+        probabilities = self.priorities.tree[indices + self.priorities.leaves] / self.priorities.total()
+        weights = (min(self.added, self.capacity) * probabilities) ** -self.beta
+        return torch.from_numpy((weights / weights.max()).astype(np.float32))
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.priorities.update(indices, priorities ** self.alpha)
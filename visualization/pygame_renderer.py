@@ -1,5 +1,6 @@
 import pygame
 import math
+import numpy as np
 
 class Camera:
     def __init__(self, width, height):
@@ -9,12 +10,14 @@ class Camera:
         self.filtered_scale = 1
 
     def update(self, player):
-        total_size = player["total_size"]
+        self.follow(player["total_size"], player['x'], player['y'])
+
+    def follow(self, total_size, x, y):
         scale = math.pow(min(64 / total_size, 1), 0.4)
         self.filtered_scale = (9 * self.filtered_scale + scale) / 10
 
-        self.position[0] = player['x'] - self.width / (2* self.filtered_scale)
-        self.position[1] = player['y'] - self.height / (2* self.filtered_scale)
+        self.position[0] = x - self.width / (2* self.filtered_scale)
+        self.position[1] = y - self.height / (2* self.filtered_scale)
 
 class PygameRenderer:
     def __init__(self, game_config):
@@ -31,21 +34,27 @@ class PygameRenderer:
         self.camera = Camera(self.width, self.height)
         self.font = pygame.font.Font(None, 24)
 
+        # Drawing caches, the text is not scaled so names only depend on the name
+        self.name_surfaces = {}  # name -> rendered text
+        self.spike_offsets = {}  # (spikes, radius) -> world offsets of the virus polygon points
+        self.discs = {}  # (color, screen radius) -> pre-drawn disc, blitted for pellets
+
     def draw_grid(self, grid_spacing):
         start_x = max(0, int(self.camera.position[0] // grid_spacing) * grid_spacing)
         start_y = max(0, int(self.camera.position[1] // grid_spacing) * grid_spacing)
         end_x = min(self.game_width, int(start_x + self.width / self.camera.filtered_scale) + grid_spacing)
         end_y = min(self.game_height, int(start_y + self.height / self.camera.filtered_scale) + grid_spacing)
 
+        # The lines are axis aligned and one pixel wide, filling them as rectangles sets the same pixels
         for x in range(start_x, end_x, grid_spacing):
-            start = self.world_to_screen((x, start_y))
-            end = self.world_to_screen((x, end_y))
-            pygame.draw.line(self.screen, (200, 200, 200), start, end)
+            left, top = self.world_to_screen((x, start_y))
+            _, bottom = self.world_to_screen((x, end_y))
+            self.screen.fill((200, 200, 200), (left, top, 1, bottom - top + 1))
 
         for y in range(start_y, end_y, grid_spacing):
-            start = self.world_to_screen((start_x, y))
-            end = self.world_to_screen((end_x, y))
-            pygame.draw.line(self.screen, (200, 200, 200), start, end)
+            left, top = self.world_to_screen((start_x, y))
+            right, _ = self.world_to_screen((end_x, y))
+            self.screen.fill((200, 200, 200), (left, top, right - left + 1, 1))
 
     def draw_game_border(self):
         top_left = self.world_to_screen((0, 0))
@@ -73,10 +82,31 @@ class PygameRenderer:
         radius = int(cell_state['radius'] * self.camera.filtered_scale)
         pygame.draw.circle(self.screen, cell_state['color'], pos, radius)
         
-        name_surface = self.font.render(cell_state['name'], True, (0, 0, 0))
+        name_surface = self.name_surface(cell_state['name'])
         name_rect = name_surface.get_rect(center=pos)
         self.screen.blit(name_surface, name_rect)
 
+    def name_surface(self, name):
+        surface = self.name_surfaces.get(name)
+        if surface is None:
+            surface = self.name_surfaces[name] = self.font.render(name, True, (0, 0, 0))
+        return surface
+
+    def disc(self, color, radius):
+        """Surface with the pixels pygame.draw.circle(screen, color, center, radius) sets, around (radius, radius)"""
+        key = (color, radius)
+        surface = self.discs.get(key)
+        if surface is None:
+            if len(self.discs) > 4096:  # radii change with the zoom
+                self.discs.clear()
+            surface = pygame.Surface((2 * radius + 2, 2 * radius + 2))
+            background = (0, 0, 0) if color != (0, 0, 0) else (255, 255, 255)
+            surface.fill(background)
+            surface.set_colorkey(background)
+            pygame.draw.circle(surface, color, (radius, radius), radius)
+            self.discs[key] = surface
+        return surface
+
 
 
     def draw_player(self, player_state):
@@ -91,15 +121,19 @@ class PygameRenderer:
 
     def draw_viruses(self, viruses):
         for v in viruses:
-            x, y, spikes, radius = v['x'], v['y'], v['spikes'], v['radius']
-            points = []
+            self.draw_virus(v['x'], v['y'], v['spikes'], v['radius'], v['color'])
+
+    def draw_virus(self, x, y, spikes, radius, color):
+        offsets = self.spike_offsets.get((spikes, radius))
+        if offsets is None:
+            offsets = []
             for i in range(spikes * 2):
                 angle = i * math.pi / spikes
                 r = radius * (0.97 if i % 2 == 0 else 1.03)
-                px = x + r * math.cos(angle)
-                py = y + r * math.sin(angle)
-                points.append(self.world_to_screen((px, py)))
-            pygame.draw.polygon(self.screen, v['color'], points)
+                offsets.append((r * math.cos(angle), r * math.sin(angle)))
+            offsets = self.spike_offsets[(spikes, radius)] = np.array(offsets).reshape(-1, 2)
+        points = ((np.array([x, y]) + offsets - self.camera.position) * self.camera.filtered_scale).astype(int)
+        pygame.draw.polygon(self.screen, color, points.tolist())
 
     def render(self, game_state):
         self.screen.fill((255, 255, 255))  # White background
@@ -123,5 +157,63 @@ class PygameRenderer:
 
         pygame.display.flip()
 
+    def on_screen(self, entities, reach):
+        """Indices of the entities within reach (screen pixels, scalar or per entity) of the screen,
+        with their screen coordinates and radii. Nothing outside of it would set a pixel."""
+        scale = self.camera.filtered_scale
+        xs = ((entities.x - self.camera.position[0]) * scale).astype(int)
+        ys = ((entities.y - self.camera.position[1]) * scale).astype(int)
+        visible = np.flatnonzero((xs + reach >= 0) & (xs - reach < self.width) &
+                                 (ys + reach >= 0) & (ys - reach < self.height))
+        return visible, xs[visible].tolist(), ys[visible].tolist()
+
+    def draw_food_arrays(self, food):
+        """Culled to the screen, and each pellet is a blit of a cached disc, all in one blits call"""
+        radii = np.maximum(1, (food.radius * self.camera.filtered_scale).astype(int))
+        visible, xs, ys = self.on_screen(food, radii + 1)
+        colors = list(map(tuple, food.palette.tolist()))
+        discs = [self.disc(colors[color], radius) for color, radius in zip(food.color[visible].tolist(), radii[visible].tolist())]
+        self.screen.blits([(disc, (x - radius, y - radius)) for disc, x, y, radius in
+                           zip(discs, xs, ys, radii[visible].tolist())], doreturn=False)
+
+    def draw_virus_arrays(self, viruses):
+        visible, _, _ = self.on_screen(viruses, (viruses.radius * 1.03 * self.camera.filtered_scale).astype(int) + 2)
+        colors = viruses.palette[viruses.color[visible]].tolist()
+        for x, y, radius, color in zip(viruses.x[visible].tolist(), viruses.y[visible].tolist(),
+                                       viruses.radius[visible].tolist(), colors):
+            self.draw_virus(x, y, int(radius/2), radius, color)
+
+    def draw_cell_arrays(self, cells, names):
+        name_surfaces = [self.name_surface(name) for name in names]
+        name_reach = np.array([max(surface.get_size()) for surface in name_surfaces], dtype=int).reshape(-1)
+        radii = (cells.radius * self.camera.filtered_scale).astype(int)
+        visible, xs, ys = self.on_screen(cells, np.maximum(radii, name_reach[cells.color]) + 1)
+        colors = cells.palette[cells.color[visible]].tolist()
+        for x, y, radius, color, owner in zip(xs, ys, radii[visible].tolist(), colors, cells.color[visible].tolist()):
+            pygame.draw.circle(self.screen, color, (x, y), radius)
+
+            name_surface = name_surfaces[owner]
+            name_rect = name_surface.get_rect(center=(x, y))
+            self.screen.blit(name_surface, name_rect)
+
+    def render_arrays(self, state, follow=0):
+        """Same picture as render, from the read-only arrays of Game.get_state_arrays().
+        Only what can reach the screen is drawn, the culling is one vectorized test per entity type.
+        The camera follows the player of index follow."""
+        self.screen.fill((255, 255, 255))  # White background
+
+        players = state.players
+        if players.names:
+            self.camera.follow(float(players.total_size[follow]), float(players.x[follow]), float(players.y[follow]))
+
+        self.draw_grid(self.grid_spacing)
+        self.draw_game_border()
+        self.draw_food_arrays(state.food)
+        self.draw_food_arrays(state.ejected_food)
+        self.draw_virus_arrays(state.viruses)
+        self.draw_cell_arrays(state.cells, players.names)
+
+        pygame.display.flip()
+
     def close(self):
         pygame.quit()
\ No newline at end of file
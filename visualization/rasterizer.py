@@ -0,0 +1,94 @@
+import math
+import numpy as np
+import config
+
+game_config = config.GameConfig()
+
+"""
+Off-screen rasterizer for pixel observations, no pygame needed.
+
+The image is the view get_RL_state uses (centred on the player's first cell, zoomed out with
+the sum of its cell radii), drawn from Game.get_state_arrays() / ArrayGame.get_state_arrays()
+into a (CHANNELS, height, width) uint8 array. A pixel is 255 when its centre is inside a disc
+of the channel. Discs smaller than a pixel still set the pixel under their centre.
+All the discs of an image are stamped at once: every (disc, pixel of its clipped bounding box)
+pair is generated with NumPy and tested in one pass.
+"""
+
+OWN_CELLS, OTHER_CELLS, FOOD, VIRUSES = range(4)
+CHANNELS = 4
+
+
+def stamp_discs(image, channels, xs, ys, rx, ry):
+    """Sets to 255 the pixels of image (channels, height, width) whose centre is inside one of the discs of their channel.
+    xs, ys are centres and rx, ry radii along x and y, all in pixel units (the pixel (i, j) spans [j, j+1) x [i, i+1))."""
+    height, width = image.shape[1:]
+    first_x = np.maximum(np.floor(xs - rx), 0).astype(np.int64)
+    last_x = np.minimum(np.floor(xs + rx), width - 1).astype(np.int64)
+    first_y = np.maximum(np.floor(ys - ry), 0).astype(np.int64)
+    last_y = np.minimum(np.floor(ys + ry), height - 1).astype(np.int64)
+    box_width = np.maximum(last_x - first_x + 1, 0)
+    counts = box_width * np.maximum(last_y - first_y + 1, 0)
+    if not counts.any():
+        return image
+
+    disc = np.repeat(np.arange(len(xs)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    px = first_x[disc] + local % box_width[disc]
+    py = first_y[disc] + local // box_width[disc]
+    inside = (((px + 0.5 - xs[disc]) / rx[disc])**2 + ((py + 0.5 - ys[disc]) / ry[disc])**2 <= 1)
+    # the pixel under the centre, for discs that miss every pixel centre
+    inside |= (px == np.floor(xs[disc])) & (py == np.floor(ys[disc]))
+    image[channels[disc[inside]], py[inside], px[inside]] = 255
+    return image
+
+
+class Rasterizer:
+    def __init__(self, size=game_config.PIXEL_OBSERVATION_SIZE):
+        self.height, self.width = size
+        self.image = np.zeros((CHANNELS, self.height, self.width), dtype=np.uint8)  # reused by render
+
+    def view(self, state, player_index):
+        """(view_left, view_top, view_width, view_height) of get_RL_state for a player"""
+        total_size = float(state.players.total_size[player_index])
+        view_width = game_config.WIDTH / math.pow(min(64 / total_size, 1), 0.4)
+        view_height = game_config.HEIGHT / math.pow(min(64 / total_size, 1), 0.4)
+        first_cell = np.searchsorted(state.cells.color, player_index)  # cells are grouped by owner, in order
+        return (state.cells.x[first_cell] - view_width / 2, state.cells.y[first_cell] - view_height / 2,
+                view_width, view_height)
+
+    def render(self, state, player_index, out=None):
+        """Channels OWN_CELLS, OTHER_CELLS, FOOD (pellets and ejected food) and VIRUSES of a player's view.
+        state comes from get_state_arrays(). Written into out (CHANNELS, height, width) uint8 if given,
+        e.g. a slice of a batch, otherwise into self.image, overwritten by the next call."""
+        if out is None:
+            out = self.image
+        out[...] = 0
+        view_left, view_top, view_width, view_height = self.view(state, player_index)
+        scale_x = self.width / view_width
+        scale_y = self.height / view_height
+
+        cells = state.cells
+        groups = [(np.where(cells.color == player_index, OWN_CELLS, OTHER_CELLS), cells),
+                  (FOOD, state.food), (FOOD, state.ejected_food), (VIRUSES, state.viruses)]
+        channels, xs, ys, radii = [], [], [], []
+        for channel, entities in groups:
+            # only what overlaps the view
+            x, y, radius = entities.x, entities.y, entities.radius
+            reach = np.flatnonzero((view_left - radius <= x) & (x <= view_left + view_width + radius) &
+                                   (view_top - radius <= y) & (y <= view_top + view_height + radius))
+            channels.append(np.broadcast_to(channel, len(x))[reach])
+            xs.append(x[reach])
+            ys.append(y[reach])
+            radii.append(radius[reach])
+        radii = np.concatenate(radii)
+        return stamp_discs(out, np.concatenate(channels), (np.concatenate(xs) - view_left) * scale_x,
+                           (np.concatenate(ys) - view_top) * scale_y, radii * scale_x, radii * scale_y)
+
+    def render_many(self, state, player_indices, out=None):
+        """render of several players as out (len(player_indices), CHANNELS, height, width)"""
+        if out is None:
+            out = np.zeros((len(player_indices), CHANNELS, self.height, self.width), dtype=np.uint8)
+        for image, player_index in zip(out, player_indices):
+            self.render(state, player_index, out=image)
+        return out